@@ -7,11 +7,25 @@
 
 # Usage: cat grammar.txt | python3 ./cgrammar.py > compiled-grammar.txt
 
+# Optionally, order the rules within each state by how often they matched in a
+# profile of a training corpus, so that the parser tries the most likely rule
+# first (see python/lexprofile.py):
+#   cat grammar.txt | python3 ./cgrammar.py --profile profile.json > compiled-grammar.txt
+
+import argparse
+import json
 import sys
 import binascii
 
 HEADER = 'bach-cg1' # [8] Bach compiled grammar format 1
 
+# Special fixed IDs for terminal sets (see bach.unpack.CompiledGrammar)
+TERMINAL_SET_NONE_ID = 0 # empty set
+TERMINAL_SET_EOF_ID  = 1 # end of file
+TERMINAL_SET_SS_ID   = 2 # runtime shorthand separators
+TERMINAL_SET_DSS_ID  = 3 # disallowed shorthand separators
+TERMINAL_SET_SC_ID   = 8 # special characters
+
 
 class IDMapper():
     def __init__(self):
@@ -61,6 +75,8 @@ class ProductionRule():
             lookaheadTerminalId, invertLookaheadTerminal,
             capture, captureStart, captureEnd, captureAs):
         assert len(nonterminalIds) <= 3
+        self.description = '' # see describeRule
+        self.aliases = set() # descriptions of the rule(s) this was optimised from
         self.terminalSetId  = terminalSetId # non-terminal produced by rule
         self.invertTerminalSet = invertTerminalSet
         self.nonterminalIds = nonterminalIds # zero or more (max 3) non-terminals
@@ -74,6 +90,11 @@ class ProductionRule():
         # lower five (four) bits:  capture semantic
         # Set high bit of ID to invert e.g. NOT an element of set
 
+    def effect(self):
+        # What the rule does when it matches
+        return (tuple(self.nonterminalIds), self.capture, self.captureStart,
+            self.captureEnd, self.captureAs)
+
     def pack(self):
         def inv(value, inverter):
             assert value <= 127
@@ -123,7 +144,7 @@ class ProductionRules():
         except KeyError:
             return []
     def states(self):
-        return len(self.rules)
+        return sum(1 for x in self.rules.values() if x)
     def totalRules(self):
         total = 0
         for i in self.rules:
@@ -232,6 +253,238 @@ def unquote(s):
     
 
 
+def symbolClasses(terminals, disallowedShorthand):
+    # Every character the parser can see is equivalent, for the purposes of
+    # matching a rule, to one of these: a character in the terminal string, or
+    # any other character (None); either of which may also be configured at
+    # runtime as a shorthand separator, unless it is disallowed.
+    for c in sorted(set(terminals)) + [None]:
+        yield (c, False)
+        if c is None or c not in disallowedShorthand:
+            yield (c, True)
+
+
+class Classifier():
+    """Answers questions about terminal sets exhaustively at compile time, for
+    any runtime configuration of shorthands, by modelling every character as
+    one of a small number of classes (see symbolClasses)"""
+
+    def __init__(self, terminals, terminalSetMapper):
+        self.terminals = terminals
+        self.setsById = dict(terminalSetMapper.get(name) for name in terminalSetMapper.ids)
+        dss = self.setsById[TERMINAL_SET_DSS_ID]
+        self.currents = list(symbolClasses(terminals, terminals[dss.start:dss.end]))
+        self.lookaheads = self.currents + [None] # None is End of File
+
+    def matches(self, setId, invert, symbol):
+        # Mirrors bach.Production.matchTerminalPair for a symbol class
+        if symbol is None:
+            return setId == TERMINAL_SET_EOF_ID and not invert
+        if setId == TERMINAL_SET_EOF_ID:
+            return invert
+
+        c, shorthand = symbol
+        if setId == TERMINAL_SET_SS_ID:
+            member = shorthand
+        else:
+            ts = self.setsById[setId]
+            member = (c is not None) and (c in self.terminals[ts.start:ts.end])
+            if setId == TERMINAL_SET_SC_ID:
+                member = member or shorthand
+
+        return member != invert
+
+    def members(self, setId, invert, domain):
+        return frozenset(x for x in domain if self.matches(setId, invert, x))
+
+    def currentsOf(self, rule):
+        return self.members(rule.terminalSetId, rule.invertTerminalSet, self.currents)
+
+    def lookaheadsOf(self, rule):
+        return self.members(rule.lookaheadTerminalId, rule.invertLookaheadTerminal, self.lookaheads)
+
+    def find(self, symbols, domain):
+        # Returns (ID, invert?) of a terminal set, or the inverse of one,
+        # matching exactly the given symbols from domain, or None
+        for setId in sorted(self.setsById):
+            for invert in (False, True):
+                if self.members(setId, invert, domain) == symbols:
+                    return setId, invert
+        return None
+
+
+def describeRule(symbolNames, setNames, state, rule):
+    # Normalised description of a rule, matching bach.profile.describe()
+    inv = '¬' if rule.invertTerminalSet else ''
+    result = ' '.join([symbolNames[state], '=>', inv + setNames[rule.terminalSetId]] + \
+        [symbolNames[x] for x in rule.nonterminalIds])
+    if (rule.lookaheadTerminalId, rule.invertLookaheadTerminal) != (TERMINAL_SET_NONE_ID, True):
+        result += ' ; lookahead %s %s' % ('not in' if rule.invertLookaheadTerminal else 'in',
+            setNames[rule.lookaheadTerminalId])
+    return result
+
+
+def proveDeterministic(classifier, productionRules):
+    # Prove that no two rules within a state can match the same current and
+    # lookahead character. Then the parser can try rules in any order and the
+    # first match is the only match. Raises a SyntaxError with a
+    # counterexample otherwise.
+
+    for state in productionRules.rules:
+        rules = productionRules.get(state)
+        for i, a in enumerate(rules):
+            for b in rules[i+1:]:
+                currents = classifier.currentsOf(a) & classifier.currentsOf(b)
+                lookaheads = classifier.lookaheadsOf(a) & classifier.lookaheadsOf(b)
+                if currents and lookaheads:
+                    current = sorted(currents, key=repr)[0]
+                    lookahead = sorted(lookaheads, key=repr)[0]
+                    raise SyntaxError("Ambiguous rules (%s | %s) both match current %s, lookahead %s" % (
+                        a.description, b.description, repr(current),
+                        'EOF' if lookahead is None else repr(lookahead)))
+
+
+# Optimisation passes. Each modifies productionRules in place and returns a
+# list of human-readable changes. State IDs never change (some are fixed, and
+# bach.unpack.CompiledGrammar.SYMBOL_NAMES mirrors grammar.txt), so a removed
+# state is left in place with no rules.
+
+def removeDeadRules(classifier, productionRules):
+    # Remove rules that can't match any current and lookahead character
+    changes = []
+    for state, rules in productionRules.rules.items():
+        for rule in list(rules):
+            if not (classifier.currentsOf(rule) and classifier.lookaheadsOf(rule)):
+                changes.append("removed dead rule %s" % rule.description)
+                rules.remove(rule)
+    return changes
+
+
+def mergeRules(classifier, productionRules):
+    # Merge two rules within a state that have the same effect and differ only
+    # in their current or only in their lookahead terminal set, when the union
+    # of those sets is itself a terminal set (or the inverse of one)
+    changes = []
+    for state, rules in productionRules.rules.items():
+        merged = True
+        while merged:
+            merged = False
+            for i, a in enumerate(rules):
+                for b in rules[i+1:]:
+                    if a.effect() != b.effect(): continue
+
+                    ca, cb = classifier.currentsOf(a), classifier.currentsOf(b)
+                    la, lb = classifier.lookaheadsOf(a), classifier.lookaheadsOf(b)
+
+                    if ca == cb:
+                        found = classifier.find(la | lb, classifier.lookaheads)
+                        if found:
+                            a.lookaheadTerminalId, a.invertLookaheadTerminal = found
+                    elif la == lb:
+                        found = classifier.find(ca | cb, classifier.currents)
+                        if found:
+                            a.terminalSetId, a.invertTerminalSet = found
+                    else:
+                        found = None
+
+                    if found:
+                        changes.append("merged rules %s | %s" % (a.description, b.description))
+                        a.aliases |= b.aliases
+                        rules.remove(b)
+                        merged = True
+                        break
+                if merged: break
+    return changes
+
+
+def mergeStates(classifier, productionRules, numStates, endStates):
+    # Merge equivalent states by partition refinement: two states are
+    # equivalent if both or neither are end states, and their rules match the
+    # same characters with the same effect and push equivalent states. Every
+    # reference to a state is replaced by the lowest ID equivalent to it (so
+    # the start state remains 0) and the others become unreachable.
+
+    def signature(state, block):
+        return (state in endStates, frozenset(
+            (classifier.currentsOf(x), classifier.lookaheadsOf(x),
+                x.capture, x.captureStart, x.captureEnd, x.captureAs,
+                tuple(block[nt] for nt in x.nonterminalIds))
+            for x in productionRules.get(state)))
+
+    block = [0] * numStates
+    numBlocks = 1
+    while True:
+        signatures = {}
+        block = [signatures.setdefault(signature(i, block), len(signatures)) for i in range(numStates)]
+        if len(signatures) == numBlocks: break
+        numBlocks = len(signatures)
+
+    representative = {}
+    for i in range(numStates):
+        representative.setdefault(block[i], i)
+
+    changes = []
+    for i in range(numStates):
+        if representative[block[i]] != i:
+            changes.append("merged state %d into equivalent state %d" % (i, representative[block[i]]))
+
+    for rules in productionRules.rules.values():
+        for rule in rules:
+            rule.nonterminalIds = [representative[block[nt]] for nt in rule.nonterminalIds]
+
+    endStates[:] = sorted(set(representative[block[i]] for i in endStates))
+    return changes
+
+
+def removeUnreachableStates(productionRules, endStates):
+    # Remove the rules of every state that can't be reached from the start
+    reachable = set([0])
+    todo = [0]
+    while todo:
+        for rule in productionRules.get(todo.pop()):
+            for nt in rule.nonterminalIds:
+                if nt not in reachable:
+                    reachable.add(nt)
+                    todo.append(nt)
+
+    changes = []
+    for state, rules in productionRules.rules.items():
+        if state not in reachable and rules:
+            changes.append("removed unreachable state %d (%d rules)" % (state, len(rules)))
+            productionRules.rules[state] = []
+
+    endStates[:] = [x for x in endStates if x in reachable]
+    return changes
+
+
+def markAnyLookahead(classifier, productionRules):
+    # Give every rule whose lookahead matches any character (but not End of
+    # File) the canonical encoding "not in special:none", which the parser
+    # recognises so that it can skip the lookahead test
+    anyLookahead = frozenset(classifier.currents)
+    changes = []
+    marked = 0
+    for rules in productionRules.rules.values():
+        for rule in rules:
+            if classifier.lookaheadsOf(rule) != anyLookahead: continue
+            marked += 1
+            if (rule.lookaheadTerminalId, rule.invertLookaheadTerminal) != (TERMINAL_SET_NONE_ID, True):
+                changes.append("any lookahead for %s" % rule.description)
+                rule.lookaheadTerminalId, rule.invertLookaheadTerminal = TERMINAL_SET_NONE_ID, True
+    changes.append("%d rules marked as having any lookahead" % marked)
+    return changes
+
+
+
+ap = argparse.ArgumentParser(
+    description='Compiles grammar.txt from stdin to a bach-cg1 representation on stdout')
+ap.add_argument('--profile', metavar='FILE',
+    help='order rules within each state by hits in a JSON profile (see python/lexprofile.py --dump)')
+ap.add_argument('--no-optimise', action='store_true',
+    help='emit the grammar exactly as written')
+args = ap.parse_args()
+
+
 productionSymbolMapper = IDMapper()
 captureSemanticMapper  = IDMapper()
 terminalSetMapper      = TerminalSets()
@@ -360,9 +613,61 @@ for line in sys.stdin:
     else:
         raise SyntaxError
 
-print("# State Transitions")
 assert productionRules.totalRules() == rules
 
+symbolNames = dict((id, name) for name, id in productionSymbolMapper.ids.items())
+setNames = dict((id, name) for name, (id, _) in terminalSetMapper.ids.items())
+
+def redescribe():
+    for state, rules in productionRules.rules.items():
+        for rule in rules:
+            rule.description = describeRule(symbolNames, setNames, state, rule)
+            rule.aliases.add(rule.description)
+
+redescribe()
+classifier = Classifier(terminals, terminalSetMapper)
+
+print("# Proving rules within each state are disjoint...")
+proveDeterministic(classifier, productionRules)
+print("#    OK")
+
+if not args.no_optimise:
+    print("# Optimisations:")
+    passes = [
+        lambda: removeDeadRules(classifier, productionRules),
+        lambda: mergeRules(classifier, productionRules),
+        lambda: mergeStates(classifier, productionRules, productionSymbolMapper.entries(), endStates),
+        lambda: removeUnreachableStates(productionRules, endStates),
+        lambda: markAnyLookahead(classifier, productionRules),
+    ]
+    for optimise in passes:
+        for change in optimise():
+            print("#    %s" % change)
+        redescribe()
+
+    # Still deterministic?
+    proveDeterministic(classifier, productionRules)
+    print("#    %d rules (was %d)" % (productionRules.totalRules(), rules))
+
+if args.profile:
+    print("# Ordering rules by profile")
+    with open(args.profile, 'r', encoding='utf-8') as f:
+        hits = json.load(f)['productionHits']
+
+    # Safe to reorder, as proved above. Sort is stable, so ties (e.g. rules
+    # absent from the profile) keep the order of grammar.txt. A profile may
+    # have been taken with or without optimisations, so count hits for any
+    # rule a rule was optimised from.
+    def hitsOf(rule):
+        return sum(hits.get(x, 0) for x in rule.aliases)
+
+    for i in productionRules.rules:
+        productionRules.rules[i].sort(key=lambda x: -hitsOf(x))
+        for rule in productionRules.rules[i]:
+            print("#    %10d  %s" % (hitsOf(rule), rule.description))
+
+print("# State Transitions")
+
 numRulesForState = {}
 offsetForState = {}
 offset = 0
@@ -379,7 +684,7 @@ print("# Summary:")
 print("#    HEADER: %s" % HEADER)
 print("#    %d Parser States / %d Production Symbols" % \
     (productionRules.states(), productionSymbolMapper.entries()))
-print("#    %d State Transitions / Rules" % rules)
+print("#    %d State Transitions / Rules" % productionRules.totalRules())
 print("#    %d sets of terminal characters defined by a mapping into %d chars" \
     % (terminalSetMapper.entries(), len(terminals)))
 
@@ -1 +1,3 @@
-from .bach import Parser, ParseError, Document
+from .bach import Parser, ParseError, LimitError, Limits, Document, FrozenDocument, Literal
+from .css import select
+from .tail import follow
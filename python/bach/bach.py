@@ -1,7 +1,23 @@
 import io
+import bach.columns
+import bach.compare
+import bach.compressed
 import bach.io
+import bach.path
+import bach.pipeline
+import bach.profile
+import bach.query
+import bach.scan
+import bach.stream
+import bach.structural
 import bach.translate
+import bisect
 import enum
+import itertools
+import sys
+import tempfile
+import threading
+import types
 
 from functools import reduce
 from bach.unpack import CompiledGrammar, CompiledProduction
@@ -18,6 +34,16 @@ class ParseError(RuntimeError):
 
 
 
+class LimitError(ParseError):
+    """A ParseError for input beyond one of a Parser's Limits, named by .limit
+    e.g. "maxDepth" """
+
+    def __init__(self, reason, limit, startPos, endPos):
+        self.limit = limit
+        super().__init__("%s (%s)" % (reason, limit), startPos, endPos)
+
+
+
 @enum.unique
 class CaptureSemantic(enum.Enum):
     """Semantics captured at the level of the grammar that lets us know how
@@ -51,6 +77,15 @@ class Position():
         self.line += 1
         self.column = 1
 
+    def advanceOver(self, text, start, end):
+        # as if advancing over each character of text[start:end] in turn
+        newline = text.rfind('\n', start, end)
+        if newline == -1:
+            self.column += (end - start) - text.count('\r', start, end)
+        else:
+            self.line += text.count('\n', start, end)
+            self.column = 1 + (end - newline - 1) - text.count('\r', newline + 1, end)
+
     def copy(self):
         return Position(self.line, self.column)
 
@@ -59,14 +94,150 @@ class Position():
 
 
 
+class Limits():
+    """Maximums for a Parser to enforce e.g. on untrusted input, each None
+    for no limit:
+
+        maxDepth:      nesting depth of subdocuments (the root's children are
+                       at depth 1)
+        maxStack:      size of the automaton stack
+        maxLiteral:    length of a literal, or of any other token e.g. a label
+        maxAttributes: number of attributes of a document (each shorthand and
+                       each repeat of an attribute counts)
+        maxNodes:      number of documents and literal children in all
+        maxInput:      number of characters of input
+
+    Each is counted as tokens are lexed, and exceeding one raises a
+    LimitError at that point (or, from validate(), returns it). A token is
+    measured as it's captured, so a long one is stopped as soon as it's too
+    long. parse(src, lazy=True) and keep=... lex a level of the tree at a
+    time, so they can't enforce maxDepth, maxStack or maxNodes, and raise a
+    ValueError if any of those are set."""
+
+    def __init__(self, maxDepth=None, maxStack=None, maxLiteral=None, maxAttributes=None,
+            maxNodes=None, maxInput=None):
+        self.maxDepth      = maxDepth
+        self.maxStack      = maxStack
+        self.maxLiteral    = maxLiteral
+        self.maxAttributes = maxAttributes
+        self.maxNodes      = maxNodes
+        self.maxInput      = maxInput
+
+    def __repr__(self):
+        return "<bach.Limits %s>" % ', '.join('%s=%s' % x for x in vars(self).items() if x[1] is not None)
+
+
+
+# N.B. Performance - looking up a member of an Enum is slow, so LimitCounter
+# and Parser.dispatch() look these up once
+LABEL, ATTRIBUTE, LITERAL, ASSIGN, SUBDOC_START, SUBDOC_END, SHORTHAND_SYMBOL = \
+    CaptureSemantic.label, CaptureSemantic.attribute, CaptureSemantic.literal, CaptureSemantic.assign, \
+    CaptureSemantic.subdocStart, CaptureSemantic.subdocEnd, CaptureSemantic.shorthandSymbol
+
+
+
+class LimitCounter():
+    # The counts of one run of a lexer, checked against Limits as each token
+    # is lexed. N.B. Performance - this is called for every token, so a limit
+    # that isn't set is sys.maxsize, rather than tested for None.
+
+    def __init__(self, limits):
+        def limit(x):
+            return sys.maxsize if x is None else x
+        self.maxDepth      = limit(limits.maxDepth)
+        self.maxStack      = limit(limits.maxStack)
+        self.maxLiteral    = limit(limits.maxLiteral)
+        self.maxAttributes = limit(limits.maxAttributes)
+        self.maxNodes      = limit(limits.maxNodes)
+
+        self.attributes = [0]   # count for each open document; the first opens implicitly
+        self.nodes      = 1
+        self.literal    = 0     # length so far of a literal in pieces
+        self.value      = False # True if the next literal is an attribute value
+
+    def token(self, token, stackSize):
+        semantic = token.semantic
+
+        if token.partial:
+            self.literal += len(token.lexeme)
+            if self.literal > self.maxLiteral:
+                self.exceeded("Token longer than %d characters", 'maxLiteral', token)
+            return
+
+        if len(token.lexeme) + self.literal > self.maxLiteral:
+            self.exceeded("Token longer than %d characters", 'maxLiteral', token)
+        self.literal = 0
+
+        if semantic is LITERAL:
+            if self.value:
+                self.value = False
+            else:
+                self.node(token)
+
+        elif semantic is ATTRIBUTE or semantic is SHORTHAND_SYMBOL:
+            attributes = self.attributes
+            attributes[-1] += 1
+            if attributes[-1] > self.maxAttributes:
+                self.exceeded("More than %d attributes", 'maxAttributes', token)
+
+        elif semantic is ASSIGN:
+            self.value = True
+
+        elif semantic is SUBDOC_START:
+            # the automaton stack only grows by a subdocument, or by a
+            # literal in one (by at most 1)
+            if stackSize + 1 > self.maxStack:
+                self.exceeded("Automaton stack larger than %d", 'maxStack', token)
+            self.attributes.append(0)
+            if len(self.attributes) - 1 > self.maxDepth:
+                self.exceeded("Subdocuments nested deeper than %d", 'maxDepth', token)
+            self.node(token)
+
+        elif semantic is SUBDOC_END:
+            self.attributes.pop()
+
+    def node(self, token):
+        # a subdocument skipped over by lexLevel() is a node too
+        self.nodes += 1
+        if self.nodes > self.maxNodes:
+            self.exceeded("More than %d nodes", 'maxNodes', token)
+
+    def exceeded(self, reason, limit, token):
+        raise LimitError(reason % getattr(self, limit), limit, token.start, token.end)
+
+
+
+class LimitedStream():
+    # A text stream that raises a LimitError once more than `limit`
+    # characters have been read from it
+
+    def __init__(self, fp, limit):
+        self.fp    = fp
+        self.limit = limit
+        self.count = 0
+        self.pos   = Position(1, 0)
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        if self.count + len(data) > self.limit:
+            self.pos.advanceOver(data, 0, self.limit - self.count + 1)
+            raise LimitError("Input longer than %d characters" % self.limit, 'maxInput', None, self.pos)
+        self.count += len(data)
+        self.pos.advanceOver(data, 0, len(data))
+        return data
+
+
+
 class Token():
 
-    def __init__(self, semantic, lexeme, start, end, state=None):
+    def __init__(self, semantic, lexeme, start, end, state=None, span=None, partial=False):
         self.semantic = semantic    # type CaptureSemantic
         self.lexeme   = lexeme      # type str
         self.start    = start       # type Position
         self.end      = end         # type Position
         self.state    = state       # type Number; for debugging
+        self.span     = span        # type (start, end) offsets in the source, if known
+        self.partial  = partial     # type bool; True if the rest follows in more Tokens
 
     def __repr__(self):
         return "<bach.Token %s, type %s, from %s to %s (from state %d)>" % \
@@ -76,6 +247,14 @@ class Token():
 
 class Document():
 
+    # Recorded by Parser.parse(src, spans=True) (or lazy=True): the source str
+    # and this subdocument's (start, end) offsets in it, from "(" to after ")"
+    src  = None
+    span = None
+
+    _hash   = None  # see structuralHash(), cached only if _frozen
+    _frozen = False
+
     def __init__(self):
         self.label = None    # A str
         self.splitAttributes = {} # A dict of attribute names to a list of non-None str values
@@ -88,6 +267,35 @@ class Document():
         return bach.translate.toElementTree(etreeClass, self)
 
 
+    def walk(self):
+        # every Document in this tree, depth-first in document order, from self
+        return bach.query.walk(self)
+
+
+    def iter(self, label=None):
+        # every Document in this tree with the given label (or any, if None)
+        return bach.query.iterLabel(self, label)
+
+
+    def sourceText(self):
+        # the raw source of this subtree, unmodified, or None if its span wasn't
+        # recorded e.g. to forward a subdocument verbatim without serializing
+        if self.span is None: return None
+        start, end = self.span
+        return self.src[start:end]
+
+
+    def structuralHash(self):
+        # a hash of the label, merged attributes and children of this tree,
+        # cached on a FrozenDocument; see bach.compare
+        return bach.compare.structuralHash(self)
+
+
+    def equals(self, other):
+        # structural equality, short-circuited by the hashes
+        return bach.compare.equal(self, other)
+
+
     def setLabel(self, label):
         assert self.label is None
         self.label = label
@@ -109,6 +317,7 @@ class Document():
             self.splitAttributes[attributeName] = [value]
         else:
             self.splitAttributes[attributeName].append(value)
+        self._attributes = None
 
 
     @property
@@ -127,6 +336,158 @@ class Document():
 
 
 
+class Literal(str):
+    """A literal child of a Document that also records its source and its
+    (start, end) offsets in it, from the opening quote to after the closing
+    quote. Escape sequences are already resolved in the str value itself.
+    See Parser.parse(src, spans=True)."""
+
+    def __new__(cls, value, src, span):
+        self = super().__new__(cls, value)
+        self.src  = src
+        self.span = span
+        return self
+
+    def sourceText(self):
+        # the literal as written, with its quotes and escape sequences
+        start, end = self.span
+        return self.src[start:end]
+
+
+
+class FrozenDocument(Document):
+    """An immutable Document, from Parser.parse(src, frozen=True). Its children
+    are a tuple, and its attributes and splitAttributes are read-only.
+
+    Within one parse, structurally identical subtrees (the same label,
+    attributes in the same order, and children) are the same FrozenDocument,
+    and equal literals and attribute values are the same str, so a
+    repetitive document is stored once per distinct subtree."""
+
+    _frozen = True
+
+    def __init__(self, label, splitAttributes, children):
+        self.label = label
+        self.splitAttributes = types.MappingProxyType(splitAttributes)
+        self._attributes = types.MappingProxyType(
+            dict((k, ' '.join(v)) for k, v in splitAttributes.items()))
+        self.children = children
+
+    def setLabel(self, label):
+        raise TypeError("A FrozenDocument is immutable")
+
+    def addChild(self, child):
+        raise TypeError("A FrozenDocument is immutable")
+
+    def addAttribute(self, shorthand, attributeName, attributeValue, startPos, endPos):
+        raise TypeError("A FrozenDocument is immutable")
+
+    def __repr__(self):
+        return "<bach.FrozenDocument: .label=%s .attributes=%s .children=%s>" % \
+            (repr(self.label), dict(self.attributes), self.children)
+
+
+
+class Interner():
+    # The canonical FrozenDocuments and strs of one frozen parse
+
+    def __init__(self):
+        self.strings   = {} # str => itself
+        self.documents = {} # (label, attributes, children) => FrozenDocument
+
+    def string(self, s):
+        return self.strings.setdefault(s, s)
+
+    def document(self, document):
+        # The FrozenDocument for a Document whose children are already
+        # canonical, so can be keyed by identity
+        string = self.string
+        splitAttributes = dict((string(k), tuple(string(x) for x in v)) \
+            for k, v in document.splitAttributes.items())
+        children = tuple(document.children)
+
+        key = (document.label, tuple(splitAttributes.items()), children)
+        try:
+            return self.documents[key]
+        except KeyError:
+            pass
+
+        result = FrozenDocument(string(document.label), splitAttributes, children)
+        self.documents[key] = result
+        return result
+
+
+
+class LazyDocument(Document):
+    """A subdocument recorded only as a span of the source, until its
+    attributes or children are first accessed. Then (only) the top level of the
+    span is lexed and parsed, with each of its own subdocuments in turn
+    becoming a LazyDocument. See Parser.parse(src, lazy=True).
+
+    The label is read up front without running the automaton. A syntax error
+    inside the span raises a ParseError on first access."""
+
+    def __init__(self, parser, src, start, end, pos):
+        self.parser = parser
+        self.src    = src
+        self.span   = (start, end) # offsets in src, from "(" to after ")"
+        self.pos    = pos          # Position of "("
+
+        self._children = None
+        self._splitAttributes = None
+        self._attributes = None
+
+        self.label = parser.readLabel(src, start, end)
+
+
+    def materialize(self):
+        if self._children is not None: return
+
+        src = self.src
+        start, end = self.span
+        pos = self.pos.copy()
+
+        self._children = []
+        self._splitAttributes = {}
+
+        # lex from just after "(" in state SDS, which ends with an empty stack
+        # when the closing parenthesis is matched by SD => rb
+        state = bach.io.stack([self.parser.atomaton.SYMBOL_NAMES.index('SDS')])
+
+        try:
+            tokens = self.parser.lexLevel(src, start + 1, end, state, pos)
+            self.parser.buildLevel(self, tokens, src)
+        except:
+            self._children = None
+            self._splitAttributes = None
+            raise
+
+        if state.peek() is not None:
+            raise ParseError("Unexpected end of subdocument in state %d" % state.peek(), self.pos, pos)
+
+
+    def setLabel(self, label):
+        assert self.label == label
+
+
+    @property
+    def children(self):
+        if self._children is None: self.materialize()
+        return self._children
+
+
+    @property
+    def splitAttributes(self):
+        if self._splitAttributes is None: self.materialize()
+        return self._splitAttributes
+
+
+    def __repr__(self):
+        return "<bach.LazyDocument: .label=%s .span=%s%s>" % (repr(self.label), self.span,
+            " (materialized)" if self._children is not None else "")
+
+
+
 class Production():
 
     def __init__(self, terminalIdPair, lookaheadIdPair, nonterminals, captureMode):
@@ -140,6 +501,18 @@ class Production():
         # capture?, capture start?, capture end?, capture semantic ID
         self.captureMode = captureMode
 
+        # cgrammar.py marks a rule with any lookahead (except End of File) as
+        # "not in special:none", so the lookahead needs no set membership test
+        self.anyLookahead = \
+            (lookaheadIdPair == (CompiledGrammar.TERMINAL_SET_NONE_ID, True))
+
+        # for validate(), which doesn't build tokens: (semantic of a capture
+        # started here or None, capture ended here?), or None if neither
+        self.boundary = None
+        if captureMode[1] or captureMode[2]:
+            self.boundary = (CaptureSemantic(captureMode[3]) if captureMode[1] else None,
+                bool(captureMode[2]))
+
 
     def capture(self):
         return self.captureMode[0]
@@ -191,24 +564,54 @@ class Production():
 
 
     def match(self, parser, current, lookahead):
-        return \
-            self.matchTerminalPair(parser, self.terminalIdPair, current) and \
-            self.matchTerminalPair(parser, self.lookaheadIdPair, lookahead)
+        if not self.matchTerminalPair(parser, self.terminalIdPair, current):
+            return False
+        elif self.anyLookahead:
+            return lookahead is not None
+        else:
+            return self.matchTerminalPair(parser, self.lookaheadIdPair, lookahead)
 
 
 class Parser():
+    """A Parser may be shared by any number of threads. Its configuration and
+    grammar tables are immutable once it is constructed, and all the state of
+    a parse is local to that call.
+
+    The Documents it returns are plain objects, without locks: don't modify a
+    tree in one thread while another reads it, and materialize a lazy tree
+    (e.g. with list(document.walk())) before sharing it. A parser constructed
+    with profile=True counts into a single Profile, so isn't thread-safe."""
+
     atomaton = CompiledGrammar()
 
-    def __init__(self, shorthands={}):
+    # immutable transition tables, shared by every Parser with the same
+    # shorthand symbols; see transitionTable()
+    tables = {}
+    tablesLock = threading.Lock()
+
+    def __init__(self, shorthands=None, profile=False, limits=None):
         """Configure and construct a new parser for a Bach document.
 
         Pass a dict of shorthand charater => expanded string as the second
         parameter to extend the syntax of the parser with custom shorthand
-        attributes."""
+        attributes.
+
+        Pass profile=True to count visits to each state of the automaton and
+        hits for each production rule (see profileReport()), in every lexer:
+        lex() is replaced by an instrumented copy, and the table of
+        transitions that the others look up by one that counts each lookup.
+        Without it, lexing pays nothing for this.
+
+        Pass limits, a Limits or a dict of its arguments e.g.
+        limits={"maxDepth": 100, "maxInput": 10**8}, to raise a LimitError for
+        input that exceeds any of them."""
+
+        if shorthands is None:
+            shorthands = {}
 
         # Construct a table for runtime-configurable shorthand syntax
-        # as a mapping of shorthand symbol to Shorthand objects
-        self.shorthands = shorthands
+        # as a read-only mapping of shorthand symbol to expansion
+        self.shorthands = types.MappingProxyType(dict(shorthands))
         for symbol in shorthands:
             assert isinstance(shorthands[symbol], str)
             assert len(shorthands[symbol]) >= 1, \
@@ -223,18 +626,93 @@ class Parser():
         # a string of all the shorthand symbols        
         self.shorthandSymbolString = ''.join(shorthands)
 
-        # a list of all sets of terminal symbols, ordered by set ID,
+        # a tuple of all sets of terminal symbols, ordered by set ID,
         # and patched with runtime-configured values
-        self.terminalSets = list(self.atomaton.terminalSets(self.shorthandSymbolString))
+        self.terminalSets = tuple(self.atomaton.terminalSets(self.shorthandSymbolString))
 
         # a string of all terminal symbols for quick membership tests
         self.terminals = ''.join(set(self.atomaton.terminals() + self.shorthandSymbolString))
 
-        # a list of all production rule lists, ordered by state ID
-        self.states = list(self.atomaton.states(Production))
+        # a tuple of all production rule tuples, ordered by state ID
+        self.states = tuple(tuple(x) for x in self.atomaton.states(Production))
     
-        # a list of special allowable end states (in addition to None)
-        self.endStates = self.atomaton.endStates
+        # a set of special allowable end states (in addition to None)
+        self.endStates = frozenset(self.atomaton.endStates)
+
+        # Every character that isn't a terminal symbol is a member of exactly
+        # the same terminal sets, so any one of them can stand in for the rest
+        self.otherSymbol = next(chr(i) for i in range(ord('a'), 0x110000) \
+            if chr(i) not in self.terminals)
+
+        # a mapping of every (state, current, lookahead) to the first matching
+        # Production (or None), keyed on terminal symbols or otherSymbol
+        self.transitions = self.transitionTable()
+
+        # maximums to enforce, or None
+        if isinstance(limits, dict):
+            limits = Limits(**limits)
+        self.limits = limits
+
+        # counters for the lexers to collect, or None
+        self.profile = None
+        if profile:
+            self.profile = bach.profile.Profile(self.atomaton, self.states)
+            self.lex = self.lexProfiled
+            self.transitions = bach.profile.CountingTransitions(self.transitions, self.profile)
+
+
+    def transition(self, state, current, lookahead):
+        # Find the first production rule from state that matches current and
+        # lookahead, where both are a terminal symbol, otherSymbol, or (for the
+        # lookahead only) None at the end of the stream
+
+        for production in self.states[state]:
+            if production.match(self, current, lookahead):
+                return production
+        return None
+
+
+    def transitionTable(self):
+        # The (read-only) table of transition() for every possible key, built
+        # by the first Parser with a given set of shorthand symbols
+        key = ''.join(sorted(self.shorthandSymbolString))
+
+        with Parser.tablesLock:
+            table = Parser.tables.get(key)
+            if table is None:
+                symbols = self.terminals + self.otherSymbol
+                table = types.MappingProxyType(dict(((state, c, la), self.transition(state, c, la)) \
+                    for state in range(len(self.states)) \
+                    for c in symbols \
+                    for la in tuple(symbols) + (None,)))
+                Parser.tables[key] = table
+
+        return table
+
+
+    def counter(self):
+        # a new LimitCounter for a run of a lexer, or None without limits
+        return None if self.limits is None else LimitCounter(self.limits)
+
+
+    def limitInput(self, src, line=1):
+        # src, made to raise a LimitError if it's longer than limits.maxInput
+        # (reporting lines from `line`, for a str)
+        maxInput = None if self.limits is None else self.limits.maxInput
+        if maxInput is None:
+            return src
+
+        if isinstance(src, str):
+            if len(src) > maxInput:
+                pos = Position(line, 0)
+                pos.advanceOver(src, 0, maxInput + 1)
+                raise LimitError("Input longer than %d characters" % maxInput, 'maxInput', None, pos)
+            return src
+
+        if hasattr(src, 'read'):
+            return LimitedStream(src, maxInput)
+
+        return LimitedStream(io.StringIO(''.join(itertools.islice(src, maxInput + 1))), maxInput)
 
 
     def lex(self, reader):
@@ -253,6 +731,9 @@ class Parser():
         capture = []
         captureAs = CaptureSemantic.none
 
+        counter = self.counter()
+        maxLiteral = None if self.limits is None else self.limits.maxLiteral
+
         # Iterate over the current character and a single lookahead - LL(1)
         for (current, lookahead) in bach.io.pairwise(reader):
 
@@ -287,36 +768,29 @@ class Parser():
                         capture = []
                         startPos = pos.copy()
                         captureAs = production.captureAs()
-                    
+
                     if production.capture():
                         capture.append(current)
+                        if maxLiteral is not None and len(capture) > maxLiteral:
+                            raise LimitError("Token longer than %d characters" % maxLiteral, 'maxLiteral',
+                                startPos, pos)
 
                     if production.captureEnd():
                         assert startPos is not None
-                        yield Token(captureAs, ''.join(capture), startPos.copy(), pos.copy(), currentState)
+                        token = Token(captureAs, ''.join(capture), startPos.copy(), pos.copy(), currentState)
+                        if counter is not None:
+                            counter.token(token, len(state.entries) + len(production.nonterminals) - 1)
+                        yield token
                         startPos = None
 
-                    
+
                     state.pop()
-                    
+
                     for nt in production.nonterminals:
                         state.push(nt)
 
-                    # Check that our grammar isn't ambiguous!
-                    """
-                    for production2 in self.states[currentState]:
-                        if production == production2: continue
-                        if production2.match(self, current, lookahead):
-                            print("Warning: ambiguous production in state %d:\n| (%d) %s\n| (%d) %s" % \
-                                (currentState,
-                                self.states[currentState].index(production),
-                                production,
-                                self.states[currentState].index(production2),
-                                production2)
-                            )
-                    """
-
-                    # In case it is ambiguous, use the first rule
+                    # cgrammar.py proves that the rules within a state are
+                    # disjoint, so the first match is the only match
                     break
 
 
@@ -333,75 +807,1029 @@ class Parser():
             raise ParseError("Unexpected end of file in state %d" % finalState, startPos, pos)
 
 
-    def parse(self, src, bufsize=bach.io.DEFAULT_BUFFER_SIZE):
-        
-        reader = bach.io.reader(src, bufsize)()
-        tokens = self.lex(reader)
+    def lexProfiled(self, reader):
+        # An instrumented copy of lex(), used instead of lex() by a parser
+        # constructed with profile=True. Keep the two in sync!
 
-        # Initialise a stack of documents for parsing into a tree-type structure
-        # The first document opens implicitly
-        state = bach.io.stack([Document()])
+        profile = self.profile
+        stateVisits    = profile.stateVisits
+        rulesTried     = profile.rulesTried
+        productionHits = profile.productionHits
+        characters     = 0
+        tokens         = 0
+        peakStackDepth = 1
 
-        # For each classified token and a single lookahead in advance
-        it = bach.io.pairwise(tokens)
-        for token, lookahead in it:
+        state = bach.io.stack([0])
 
-            #print("Token, lookahead:")
-            #print(repr(token))
-            #print(repr(lookahead))
-            #print("---")
+        pos = Position(1, 0)
+        startPos = None
 
-            if token.semantic is CaptureSemantic.label:
-                state.peek().setLabel(token.lexeme)
+        capture = []
+        captureAs = CaptureSemantic.none
 
-            elif token.semantic is CaptureSemantic.literal:
-                state.peek().addChild(token.lexeme)
+        counter = self.counter()
+        maxLiteral = None if self.limits is None else self.limits.maxLiteral
 
-            elif token.semantic is CaptureSemantic.subdocStart:
-                # open a new subdocument
-                d = Document()
-                state.peek().addChild(d)
-                state.push(d)
+        try:
+            for (current, lookahead) in bach.io.pairwise(reader):
 
-            elif token.semantic is CaptureSemantic.subdocEnd:
-                d = state.pop()
-                assert d is not None # should be already enforced by grammar
-        
-            elif token.semantic is CaptureSemantic.attribute:
+                characters += 1
+
+                if current == '\n':
+                    pos.advanceLine()
+                elif current == '\r':
+                    pass
+                else:
+                    pos.advanceColumn()
 
-                if lookahead and lookahead.semantic is CaptureSemantic.assign:
-                    _, _ = next(it)
-                    value, _ = next(it)
+                matchedRule = False
+                currentState = state.peek()
+                assert currentState is not None
 
-                    # should be already enforced by grammar
-                    assert value.semantic is CaptureSemantic.literal
+                stateVisits[currentState] += 1
+
+                for index, production in enumerate(self.states[currentState]):
+
+                    rulesTried[currentState] += 1
+
+                    if production.match(self, current, lookahead):
+
+                        matchedRule = True
+                        productionHits[currentState][index] += 1
+
+                        if production.captureStart():
+                            capture = []
+                            startPos = pos.copy()
+                            captureAs = production.captureAs()
+
+                        if production.capture():
+                            capture.append(current)
+                            if maxLiteral is not None and len(capture) > maxLiteral:
+                                raise LimitError("Token longer than %d characters" % maxLiteral, 'maxLiteral',
+                                    startPos, pos)
+
+                        # N.B. the stack depth is counted before the token is
+                        # yielded, as the consumer may stop at it
+                        depth = len(state.entries) + len(production.nonterminals) - 1
+                        if depth > peakStackDepth:
+                            peakStackDepth = depth
+
+                        if production.captureEnd():
+                            assert startPos is not None
+                            tokens += 1
+                            token = Token(captureAs, ''.join(capture), startPos.copy(), pos.copy(), currentState)
+                            if counter is not None:
+                                counter.token(token, depth)
+                            yield token
+                            startPos = None
+
+                        state.pop()
+
+                        for nt in production.nonterminals:
+                            state.push(nt)
+
+                        break
+
+                if not matchedRule:
+                    helpCurrent = hex(ord(current))
+                    helpLookahead = hex(ord(lookahead)) if lookahead is not None else 'EOF'
+                    raise ParseError("Unexpected input %s, %s in state %d" % \
+                        (helpCurrent, helpLookahead, currentState), startPos, pos)
+
+            finalState = state.peek()
+            if finalState is not None and finalState not in self.endStates:
+                raise ParseError("Unexpected end of file in state %d" % finalState, startPos, pos)
+
+        finally:
+            profile.characters += characters
+            profile.tokens += tokens
+            profile.peakStackDepth = max(profile.peakStackDepth, peakStackDepth)
+
+
+    def profileReport(self):
+        """Returns a human-readable report of the counters collected by a
+        parser constructed with profile=True, annotated with the symbol names
+        from grammar.txt. Use self.profile.dump(fp) for a machine-readable
+        copy, and self.profile.reset() to start again."""
+
+        assert self.profile is not None, "Parser was not constructed with profile=True"
+        return self.profile.report()
+
+
+    def validate(self, src, bufsize=bach.io.DEFAULT_BUFFER_SIZE, prefetch=bach.io.DEFAULT_PREFETCH):
+        """Check that src is a syntactically valid Bach document without
+        building any tokens or a document tree. A stream is read as for
+        parse(), with prefetch.
+
+        Returns None on success, or the first ParseError otherwise."""
+
+        try:
+            src = self.limitInput(src)
+        except LimitError as e:
+            return e
+
+        reader = bach.io.reader(src, bufsize, prefetch)()
+
+        # N.B. Performance - this only runs the acceptance check of the
+        # automaton, so the stack is a plain list, the position is tracked in
+        # plain integers, and each (state, current, lookahead) is looked up in
+        # a table instead of being matched against the production rules.
+        #
+        # The grammar accepts an assignment after any token e.g. `.a="x"`,
+        # but build() only after an attribute, so the semantic of the last
+        # token is tracked too, at the boundaries of captures. Only with
+        # limits are tokens captured, to count them as lex() does.
+        #
+        # Each error is the one parse() would raise: a misplaced assignment
+        # is only rejected once the token after it is lexed, as by
+        # dispatch(), so an error in that token comes first.
+
+        terminals   = self.terminals
+        other       = self.otherSymbol
+        transitions = self.transitions
+
+        state = [0]
+        line, column = 1, 0
+        start = None # (line, column) where the current capture started
+        capturing = last = misplaced = None
+
+        counter = self.counter()
+        maxLiteral = None if self.limits is None else self.limits.maxLiteral
+        capture = []
+
+        for (current, lookahead) in bach.io.pairwise(reader):
+
+            if current == '\n':
+                line += 1
+                column = 1
+            elif current != '\r':
+                column += 1
+
+            c = current if current in terminals else other
+            la = lookahead if lookahead is None or lookahead in terminals else other
+
+            currentState = state.pop()
+
+            production = transitions[(currentState, c, la)]
+
+            if production is None:
+                helpCurrent = hex(ord(current))
+                helpLookahead = hex(ord(lookahead)) if lookahead is not None else 'EOF'
+                return ParseError("Unexpected input %s, %s in state %d" % \
+                    (helpCurrent, helpLookahead, currentState), start and Position(*start), Position(line, column))
+
+            state.extend(production.nonterminals)
+
+            # (counted first, as lex() counts a token before it's dispatched)
+            if counter is not None:
+                try:
+                    if production.captureStart():
+                        startPos = Position(line, column)
+                        countedAs = production.captureAs()
+                        capture = []
+                    if production.capture():
+                        capture.append(current)
+                        if maxLiteral is not None and len(capture) > maxLiteral:
+                            raise LimitError("Token longer than %d characters" % maxLiteral, 'maxLiteral',
+                                startPos, Position(line, column))
+                    if production.captureEnd():
+                        token = Token(countedAs, ''.join(capture), startPos, Position(line, column), currentState)
+                        counter.token(token, len(state))
+                except LimitError as e:
+                    return e
+
+            boundary = production.boundary
+            if boundary is not None:
+                starts, ends = boundary
+                if starts is not None:
+                    if starts is ASSIGN and last is not ATTRIBUTE:
+                        misplaced = line, column
+                    capturing = starts
+                    start = line, column
+                if ends:
+                    if misplaced is not None and capturing is not ASSIGN:
+                        pos = Position(*misplaced)
+                        return ParseError("Unexpected %s" % ASSIGN, pos, pos)
+                    last = capturing
+                    start = None
+
+        # special case - e.g. allow EOF at D without trailing whitespace
+        if state and state[-1] not in self.endStates:
+            return ParseError("Unexpected end of file in state %d" % state[-1], start and Position(*start),
+                Position(line, column))
+
+        if misplaced is not None:
+            pos = Position(*misplaced)
+            return ParseError("Unexpected %s" % ASSIGN, pos, pos)
+
+        return None
+
+
+    def readLabel(self, src, start, end):
+        # The label of the subdocument at src[start] == "(", read without
+        # running the automaton: SDS => ws SDS, SDS => ¬sc ...
+        specialCharacters = self.terminalSets[self.atomaton.TERMINAL_SET_SC_ID]
+        i = start + 1
+        while i < end and src[i] in ' \t\r\n':
+            i += 1
+        j = i
+        while j < end and src[j] not in specialCharacters:
+            j += 1
+        return src[i:j]
+
+
+    def lexLevel(self, src, start, end, state, pos, skip=True, literals=None):
+        # Like lex(), but over src[start:end] of a str, from a given automaton
+        # stack and Position, both of which are updated in place. Yields only
+        # the tokens of one level of the tree: each subdocument inside is
+        # skipped over with bach.scan.matchParenthesis, yielding a single
+        # subdocStart Token whose span is its (start, end) offsets in src.
+        # With skip=False, every token is yielded, as for lex(). Each Token's
+        # span is set. Given the literals of a bach.structural.StructuralIndex,
+        # the automaton jumps over each one that's valid.
+
+        terminals   = self.terminals
+        other       = self.otherSymbol
+        transitions = self.transitions
+
+        length = len(src)
+        startPos = None
+        capture = []
+        captureAs = CaptureSemantic.none
+
+        counter = self.counter()
+        maxLiteral = None if self.limits is None else self.limits.maxLiteral
+
+        index = start
+        while index < end:
+
+            current = src[index]
+            lookahead = src[index + 1] if index + 1 < length else None
+
+            if current == '\n':
+                pos.advanceLine()
+            elif current == '\r':
+                pass
+            else:
+                pos.advanceColumn()
+
+            currentState = state.peek()
+            assert currentState is not None
+
+            # as for validate()
+            c = current if current in terminals else other
+            la = lookahead if lookahead is None or lookahead in terminals else other
+            production = transitions[(currentState, c, la)]
+
+            if production is None:
+                helpCurrent = hex(ord(current))
+                helpLookahead = hex(ord(lookahead)) if lookahead is not None else 'EOF'
+                raise ParseError("Unexpected input %s, %s in state %d" % \
+                    (helpCurrent, helpLookahead, currentState), startPos, pos)
 
-                    state.peek().addAttribute(
-                        None, token.lexeme, value.lexeme, token.start, value.end)
+            state.pop()
+            for nt in production.nonterminals:
+                state.push(nt)
+
+            if literals is not None and index in literals and production.captureStart() \
+                    and production.captureAs() is CaptureSemantic.literal:
+                literalEnd = literals[index]
+                lexeme = bach.structural.literalValue(src, index, literalEnd)
+                if lexeme is not None:
+                    # LDQ, LSQ or LBQ (now on top of the stack) stays there
+                    # for the body of the literal, which is jumped over, and
+                    # the closing quote is lexed as usual, with its lookahead
+                    capture = [lexeme]
+                    startPos = pos.copy()
+                    startIndex = index
+                    captureAs = CaptureSemantic.literal
+                    pos.advanceOver(src, index + 1, literalEnd - 1)
+                    if maxLiteral is not None and len(lexeme) > maxLiteral:
+                        raise LimitError("Token longer than %d characters" % maxLiteral, 'maxLiteral',
+                            startPos, pos)
+                    index = literalEnd - 1
+                    continue
+
+            if production.captureStart():
+                capture = []
+                startPos = pos.copy()
+                startIndex = index
+                captureAs = production.captureAs()
+
+            if production.capture():
+                capture.append(current)
+                if maxLiteral is not None and len(capture) > maxLiteral:
+                    raise LimitError("Token longer than %d characters" % maxLiteral, 'maxLiteral',
+                        startPos, pos)
+
+            if production.captureEnd():
+
+                if captureAs is CaptureSemantic.subdocStart and skip:
+                    close = bach.scan.matchParenthesis(src, index, end)
+                    if close is None or close + 1 == length:
+                        # unmatched, or without the lookahead that ")" needs,
+                        # so lex the rest in full to raise the same error as
+                        # lex() (or leave the stack for the caller to)
+                        for _ in self.lexLevel(src, index + 1, end, state, pos, skip=False):
+                            pass
+                        return
+
+                    # SDS (now on top of the stack) stands for the whole
+                    # subdocument, up to and including the closing parenthesis
+                    state.pop()
+                    pos.advanceOver(src, index + 1, close + 1)
+                    token = Token(captureAs, '(', startPos, pos.copy(), currentState, (index, close + 1))
+                    if counter is not None:
+                        counter.node(token)
+                    yield token
+                    index = close
 
                 else:
-                    # No assignment - attribute with empty value
-                    state.peek().addAttribute(
-                        None, token.lexeme, "", token.start, token.end)
+                    token = Token(captureAs, ''.join(capture), startPos, pos.copy(), currentState,
+                        (startIndex, index + 1))
+                    if counter is not None:
+                        counter.token(token, len(state.entries))
+                    yield token
+
+                startPos = None
+
+            index += 1
+
+
+    def lexChunked(self, src, bufsize, chunkSize=None, prefetch=bach.io.DEFAULT_PREFETCH):
+        # Like lex(), but over src a buffer at a time, with the transitions
+        # table as for lexLevel(), and with each run of the body of a literal
+        # matched at once by a regular expression, leaving the automaton where
+        # it was (LDQ, LSQ or LBQ on top of the stack). With chunkSize, a
+        # literal child (but not an attribute value) of more than chunkSize
+        # characters is yielded in pieces of about that size, as Tokens with
+        # partial=True followed by a last one without.
+
+        terminals   = self.terminals
+        other       = self.otherSymbol
+        transitions = self.transitions
+
+        names  = self.atomaton.SYMBOL_NAMES
+        bodies = {
+            names.index('LDQ'): bach.structural.LITERAL_BODY['"'],
+            names.index('LSQ'): bach.structural.LITERAL_BODY["'"],
+            names.index('LBQ'): bach.structural.LITERAL_BODY['['],
+        }
+        values = (names.index('LD'), names.index('LSD')) # states before a value
+        escape = bach.structural.ESCAPE
+
+        state = bach.io.stack([0])
+        pos = Position(1, 0)
+        startPos = None
+        capture = []
+        captured = 0
+        captureAs = CaptureSemantic.none
+        chunked = False
+
+        counter = self.counter()
+        maxLiteral = None if self.limits is None else self.limits.maxLiteral
+
+        text = ''
+        for data in itertools.chain(bach.stream.chunks(src, bufsize, prefetch), (None,)):
+
+            # each character but the last is lexed once the next is read
+            if data is None:
+                limit = len(text)
+            else:
+                text += data
+                limit = len(text) - 1
+            length = len(text)
+
+            index = 0
+            while index < limit:
+
+                body = bodies.get(state.peek())
+                if body is not None:
+                    # up to the last character, at the end, which the
+                    # automaton rejects as it does for lex()
+                    stop = limit if data is not None else limit - 1
+                    if chunked:
+                        stop = min(stop, index + chunkSize + 1 - captured)
+                    if maxLiteral is not None:
+                        stop = min(stop, index + maxLiteral + 1 - captured)
+                    end = body.match(text, index, stop).end()
+                    if end > index:
+                        piece = text[index:end]
+                        if '\\' in piece:
+                            piece = escape.sub(r'\1', piece)
+                        capture.append(piece)
+                        captured += len(piece)
+                        pos.advanceOver(text, index, end)
+                        index = end
+
+                        if maxLiteral is not None and captured > maxLiteral:
+                            raise LimitError("Token longer than %d characters" % maxLiteral, 'maxLiteral',
+                                startPos, pos)
+
+                        if chunked and captured > chunkSize:
+                            token = Token(captureAs, ''.join(capture), startPos, pos.copy(),
+                                state.peek(), partial=True)
+                            if counter is not None:
+                                counter.token(token, len(state.entries))
+                            yield token
+                            capture = []
+                            captured = 0
+                        continue
+
+                current = text[index]
+                lookahead = text[index + 1] if index + 1 < length else None
+
+                if current == '\n':
+                    pos.advanceLine()
+                elif current == '\r':
                     pass
-        
-            elif token.semantic is CaptureSemantic.shorthandSymbol:
+                else:
+                    pos.advanceColumn()
+
+                currentState = state.peek()
+                assert currentState is not None
+
+                # as for validate()
+                c = current if current in terminals else other
+                la = lookahead if lookahead is None or lookahead in terminals else other
+                production = transitions[(currentState, c, la)]
+
+                if production is None:
+                    helpCurrent = hex(ord(current))
+                    helpLookahead = hex(ord(lookahead)) if lookahead is not None else 'EOF'
+                    raise ParseError("Unexpected input %s, %s in state %d" % \
+                        (helpCurrent, helpLookahead, currentState), startPos, pos)
+
+                state.pop()
+                for nt in production.nonterminals:
+                    state.push(nt)
+
+                if production.captureStart():
+                    capture = []
+                    captured = 0
+                    startPos = pos.copy()
+                    captureAs = production.captureAs()
+                    chunked = chunkSize is not None and captureAs is CaptureSemantic.literal \
+                        and currentState not in values
+
+                if production.capture():
+                    capture.append(current)
+                    # (at most the length so far, with runs of a literal)
+                    if maxLiteral is not None and len(capture) > maxLiteral:
+                        raise LimitError("Token longer than %d characters" % maxLiteral, 'maxLiteral',
+                            startPos, pos)
+
+                if production.captureEnd():
+                    token = Token(captureAs, ''.join(capture), startPos, pos.copy(), currentState)
+                    if counter is not None:
+                        counter.token(token, len(state.entries))
+                    yield token
+                    startPos = None
+
+                index += 1
+
+            text = text[index:]
+
+        # special case - e.g. allow EOF at D without trailing whitespace
+        finalState = state.peek()
+        if finalState is not None and finalState not in self.endStates:
+            raise ParseError("Unexpected end of file in state %d" % finalState, startPos, pos)
+
+
+    def dispatch(self, tokens):
+        # The parts of a document that tokens (from any lexer) make, shared by
+        # build() and every other consumer of tokens, lazily yielding:
+        #
+        #     (LABEL, token)
+        #     (LITERAL, token)
+        #     (SUBDOC_START, token)
+        #     (SUBDOC_END, token)
+        #     (ATTRIBUTE, (shorthand, name, value, startPos, endPos))
+        #
+        # where an attribute is given as the arguments to addAttribute(), with
+        # any shorthand expanded. Only a token and its lookahead are held at
+        # once, as a token may be (part of) a large literal.
+
+        tokens = iter(tokens)
+        token = next(tokens, None)
 
+        while token is not None:
+            lookahead = next(tokens, None)
+            semantic = token.semantic
+
+            if semantic is LITERAL or semantic is SUBDOC_START or semantic is SUBDOC_END \
+                    or semantic is LABEL:
+                yield semantic, token
+
+            elif semantic is ATTRIBUTE:
+                if lookahead is not None and lookahead.semantic is ASSIGN:
+                    value = next(tokens)
+
+                    # should be already enforced by grammar
+                    assert value.semantic is LITERAL
+
+                    yield ATTRIBUTE, (None, token.lexeme, value.lexeme, token.start, value.end)
+                    lookahead = next(tokens, None)
+                else:
+                    # No assignment - attribute with empty value
+                    yield ATTRIBUTE, (None, token.lexeme, "", token.start, token.end)
+
+            elif semantic is SHORTHAND_SYMBOL:
                 # should already be enforced by grammar
                 assert token.lexeme in self.shorthandSymbolString
                 assert lookahead and lookahead.semantic is CaptureSemantic.shorthandAttrib, \
                     "%s: lookahead (%s) is an unexpected %s" % (token.lexeme, lookahead.lexeme, str(lookahead.semantic))
 
-                shorthand = self.shorthands[token.lexeme]
-                attrib, _ = next(it)
+                yield ATTRIBUTE, (self.shorthands[token.lexeme], None, lookahead.lexeme, token.start, lookahead.end)
+                lookahead = next(tokens, None)
+
+            else:
+                raise ParseError("Unexpected %s" % semantic, token.start, token.end)
+
+            token = lookahead
+
+
+    def events(self, src, bufsize=bach.io.DEFAULT_BUFFER_SIZE, threshold=None, spill=False,
+            prefetch=bach.io.DEFAULT_PREFETCH):
+        """Parse src (a str, text stream, or iterable of characters), lazily
+        yielding an (event, value) pair for each part of the document as it's
+        read, without building a tree:
+
+            ("start", label)              a subdocument (or the root) opens
+            ("attribute", (name, value))  with any shorthand expanded
+            ("literal", value)            a literal child
+            ("end", label)                a subdocument (or the root) closes
+
+        With threshold=N, a literal child of more than N characters is given
+        as an iterator of str chunks of about N characters, which are read
+        from src as it's consumed. It must be consumed before the next event,
+        or the rest is skipped. With spill=True too, such a literal is written
+        to a temporary file instead, and given as the file, open for reading
+        from the start; close it when done. Either way, only about N
+        characters of a literal child (plus a buffer of src) are in memory at
+        once, however big it is. An attribute value is always given whole as
+        a str, so it is held in memory in full, however big it is.
+
+        A stream is read as for parse(), with prefetch. N.B. With prefetch, it
+        may be read past the last event that's consumed."""
+
+        src = self.limitInput(src)
+        labels = []
+
+        parts = self.dispatch(self.lexChunked(src, bufsize, threshold, prefetch))
+
+        def chunks(token):
+            while True:
+                yield token.lexeme
+                if not token.partial:
+                    return
+                _, token = next(parts)
+
+        for semantic, part in parts:
+
+            if semantic is LABEL:
+                labels.append(part.lexeme)
+                yield ('start', part.lexeme)
+
+            elif semantic is LITERAL:
+                if not part.partial:
+                    yield ('literal', part.lexeme)
+                elif spill:
+                    fp = tempfile.TemporaryFile('w+', encoding='utf-8')
+                    for chunk in chunks(part):
+                        fp.write(chunk)
+                    fp.seek(0)
+                    yield ('literal', fp)
+                else:
+                    remaining = chunks(part)
+                    yield ('literal', remaining)
+                    for _ in remaining: pass
+
+            elif semantic is SUBDOC_START:
+                pass # i.e. until its label
 
-                state.peek().addAttribute(shorthand, None, attrib.lexeme, token.start, attrib.end)
+            elif semantic is SUBDOC_END:
+                yield ('end', labels.pop())
 
             else:
-                raise ParseError("Unexpected %s" % token.semantic, token.start, token.end)
+                shorthand, name, value, _, _ = part
+                yield ('attribute', (shorthand or name, value))
+
+        # The root document closes implicitly
+        if labels:
+            yield ('end', labels.pop())
+
+
+    def buildLevel(self, document, tokens, src, subdocument=None):
+        # Like build(), for the tokens of one level of the tree from
+        # lexLevel(), adding each subdocument as a LazyDocument, or whatever
+        # subdocument(start, end, pos) returns for its span (None to omit it)
+
+        if subdocument is None:
+            subdocument = lambda start, end, pos: LazyDocument(self, src, start, end, pos)
+
+        for semantic, part in self.dispatch(tokens):
+
+            if semantic is LABEL:
+                document.setLabel(part.lexeme)
+
+            elif semantic is LITERAL:
+                document.addChild(part.lexeme)
+
+            elif semantic is SUBDOC_START:
+                start, end = part.span
+                d = subdocument(start, end, part.start)
+                if d is not None:
+                    document.addChild(d)
+
+            elif semantic is SUBDOC_END:
+                pass # i.e. the closing parenthesis of a skipped subdocument
+
+            else:
+                document.addAttribute(*part)
+
+
+    def parseLazy(self, src, bufsize=bach.io.DEFAULT_BUFFER_SIZE):
+        # See parse(src, lazy=True)
+
+        if not isinstance(src, str):
+            src = ''.join(bach.io.reader(src, bufsize)())
+
+        document = Document()
+        state = bach.io.stack([0])
+        pos = Position(1, 0)
+
+        self.buildLevel(document, self.lexLevel(src, 0, len(src), state, pos), src)
+
+        # special case - e.g. allow EOF at D without trailing whitespace
+        finalState = state.peek()
+        if finalState is not None and finalState not in self.endStates:
+            raise ParseError("Unexpected end of file in state %d" % finalState, None, pos)
+
+        return document
+
+
+    def parseSubdocument(self, src, start, end, pos):
+        # Parse src[start:end], a subdocument from "(" to after ")" at
+        # Position pos, in full
+        state = bach.io.stack([self.atomaton.SYMBOL_NAMES.index('SDS')])
+        return self.build(self.lexLevel(src, start + 1, end, state, pos.copy(), skip=False), Document())
+
+
+    def parseProjection(self, src, keep, bufsize=bach.io.DEFAULT_BUFFER_SIZE):
+        # See parse(src, keep=...)
+
+        if not isinstance(src, str):
+            src = ''.join(bach.io.reader(src, bufsize)())
+
+        keep = frozenset(keep)
+        specialCharacters = self.terminalSets[self.atomaton.TERMINAL_SET_SC_ID]
+        SDS = self.atomaton.SYMBOL_NAMES.index('SDS')
+
+        # offsets of anything that looks like the start of a kept subdocument,
+        # to tell if a span has one inside it without lexing (some may really
+        # be inside a literal, which only costs an unnecessary descent)
+        candidates = bach.scan.findLabels(src, keep, specialCharacters)
+
+        root = Document()
+        pending = [] # (Document, start, end, Position) to parse one level of
+
+        def subdocument(start, end, pos):
+            if root.label in keep or self.readLabel(src, start, end) in keep:
+                return self.parseSubdocument(src, start, end, pos)
+
+            i = bisect.bisect_right(candidates, start)
+            if i < len(candidates) and candidates[i] < end:
+                d = Document()
+                pending.append((d, start, end, pos.copy()))
+                return d
+
+            return None
+
+        state = bach.io.stack([0])
+        pos = Position(1, 0)
+        self.buildLevel(root, self.lexLevel(src, 0, len(src), state, pos), src, subdocument)
+
+        # special case - e.g. allow EOF at D without trailing whitespace
+        finalState = state.peek()
+        if finalState is not None and finalState not in self.endStates:
+            raise ParseError("Unexpected end of file in state %d" % finalState, None, pos)
+
+        while pending:
+            d, start, end, pos = pending.pop()
+            state = bach.io.stack([SDS])
+            self.buildLevel(d, self.lexLevel(src, start + 1, end, state, pos), src, subdocument)
+
+        return root
+
+
+    def tokenizeColumns(self, src, bufsize=bach.io.DEFAULT_BUFFER_SIZE,
+            batchSize=bach.columns.DEFAULT_BATCH_SIZE):
+        """Lex src (read into memory in full, if not a str), lazily yielding
+        the tokens in batches of up to batchSize as bach.columns.TokenColumns,
+        for bulk consumers that don't need a Token object each."""
+
+        src = self.limitInput(src)
+        if not isinstance(src, str):
+            src = ''.join(bach.io.reader(src, bufsize)())
+
+        state = bach.io.stack([0])
+        pos = Position(1, 0)
+
+        batch = bach.columns.TokenColumns()
+        last = misplaced = None
+        for token in self.lexLevel(src, 0, len(src), state, pos, skip=False):
+            # as for dispatch(), which only accepts an assignment after an
+            # attribute, though the grammar accepts one after any token, and
+            # rejects it once the token after it is lexed
+            if misplaced is not None:
+                raise misplaced
+            if token.semantic is ASSIGN and last is not ATTRIBUTE:
+                misplaced = ParseError("Unexpected %s" % ASSIGN, token.start, token.end)
+                continue
+            last = token.semantic
+            batch.append(token)
+            if len(batch) >= batchSize:
+                yield batch
+                batch = bach.columns.TokenColumns()
+
+        # special case - e.g. allow EOF at D without trailing whitespace
+        finalState = state.peek()
+        if finalState is not None and finalState not in self.endStates:
+            raise ParseError("Unexpected end of file in state %d" % finalState, None, pos)
+
+        if misplaced is not None:
+            raise misplaced
+
+        if len(batch):
+            yield batch
+
+
+    def parseStream(self, src, delimiter=None, bufsize=bach.io.DEFAULT_BUFFER_SIZE,
+            prefetch=bach.io.DEFAULT_PREFETCH):
+        """Lazily parse src (a str, text stream, or iterable of characters)
+        holding many top-level documents ("records"), yielding the root of each
+        in turn. The stream is read a buffer at a time, as records are needed,
+        or with prefetch, as for parse() (so maybe past the last record that's
+        consumed).
+
+        Records are separated by a delimiter e.g. "\x1e" or "\n---\n", found
+        outside of any subdocument or literal, or, if delimiter is None, just
+        concatenated, with each new record starting at a line that begins with
+        its label. In a concatenated stream, an attribute without a value
+        can't be told apart from a label, so it mustn't begin a line at the
+        top level of a record. See bach.stream.
+
+        Each record is parsed as if by parse(), but errors report the line in
+        the whole stream. Limits apply to each record on its own."""
+
+        first = True
+        for text, line, literals in bach.stream.records(src, bufsize, delimiter,
+                self.shorthandSymbolString, prefetch):
+            self.limitInput(text, line)
+            state = bach.io.stack([0])
+            pos = Position(line, 0)
+
+            # the literals found by splitting are jumped over, as for
+            # parse(src, preindex=True), rather than scanned again
+            try:
+                tokens = self.lexLevel(text, 0, len(text), state, pos, skip=False, literals=literals)
+                document = self.build(tokens, Document())
+
+                # special case - e.g. allow EOF at D without trailing whitespace
+                finalState = state.peek()
+                if finalState is not None and finalState not in self.endStates:
+                    raise ParseError("Unexpected end of file in state %d" % finalState, None, pos)
+
+            except ParseError as e:
+                # an error on the line a concatenated record was split at is
+                # most likely from splitting a record in two
+                if delimiter is None and not first and type(e) is ParseError and e.end.line == line:
+                    raise ParseError("%s (in a record split from the one before it at line %d, as it "
+                        "begins with a label; indent the line if it isn't one, or use a delimiter)" % \
+                        (e.reason, line), e.start, e.end) from e
+                raise
+
+            first = False
+            yield document
+
+
+    def parseIndexed(self, src, bufsize=bach.io.DEFAULT_BUFFER_SIZE):
+        # See parse(src, preindex=True)
+
+        if not isinstance(src, str):
+            src = ''.join(bach.io.reader(src, bufsize)())
+
+        literals = bach.structural.index(src).literals
+        state = bach.io.stack([0])
+        pos = Position(1, 0)
+
+        document = self.build(self.lexLevel(src, 0, len(src), state, pos, skip=False, literals=literals),
+            Document())
+
+        # special case - e.g. allow EOF at D without trailing whitespace
+        finalState = state.peek()
+        if finalState is not None and finalState not in self.endStates:
+            raise ParseError("Unexpected end of file in state %d" % finalState, None, pos)
+
+        return document
+
+
+    def parseSpans(self, src, bufsize=bach.io.DEFAULT_BUFFER_SIZE):
+        # See parse(src, spans=True)
+
+        if not isinstance(src, str):
+            src = ''.join(bach.io.reader(src, bufsize)())
+
+        document = Document()
+        document.src = src
+        document.span = (0, len(src))
+
+        state = bach.io.stack([0])
+        pos = Position(1, 0)
+
+        self.build(self.lexLevel(src, 0, len(src), state, pos, skip=False), document, src)
+
+        # special case - e.g. allow EOF at D without trailing whitespace
+        finalState = state.peek()
+        if finalState is not None and finalState not in self.endStates:
+            raise ParseError("Unexpected end of file in state %d" % finalState, None, pos)
+
+        return document
+
+
+    def parse(self, src, bufsize=bach.io.DEFAULT_BUFFER_SIZE, lazy=False, keep=None, spans=False,
+            frozen=False, preindex=False, threads=False,
+            prefetch=bach.io.DEFAULT_PREFETCH):
+        """Parse src (a str, text stream, or iterable of characters) into a
+        tree of Documents, returning the root. A stream is read a buffer at a
+        time, as it's needed, or, with prefetch=N, ahead on a helper thread,
+        up to N buffers at a time, so that waiting on reads overlaps with
+        parsing, which pays off for a slow stream e.g. a pipe or a socket (see
+        bach.io.chunks). Streams in memory, and streams read into memory in
+        full first (as by some options below), are never read ahead.
+
+        With lazy=True, only the top level of the document is parsed up front.
+        Each subdocument is a LazyDocument, parsed the first time its
+        attributes or children are accessed, which saves lexing anything that
+        is never looked at. A stream is read into memory in full first.
+
+        With keep, a set of labels e.g. keep={"title", "author"}, only
+        subdocuments with those labels are parsed (and validated) in full.
+        Any other subdocument is skipped over by matching parentheses, without
+        running the automaton, unless it has a kept subdocument inside it; then
+        it is kept with its label, attributes and literals, but only those of
+        its subdocuments that lead to kept ones. The root is always parsed
+        (in full, if its label is kept). This also reads a stream in full.
+
+        With spans=True, each Document records its .src and its .span of
+        (start, end) offsets in it, and each literal child is a Literal, a str
+        that does the same. Their sourceText() is the raw source of a subtree
+        or literal, unmodified. Documents from lazy=True record spans too.
+
+        With frozen=True, the tree is made of immutable FrozenDocuments, with
+        each distinct subtree and literal stored only once (hash-consing).
+
+        With preindex=True, the extent of every literal is found ahead of
+        parsing by bach.structural (with NumPy, if it's installed and pays off)
+        and the automaton jumps over each one, which is faster for documents
+        with long literals. This also reads a stream in full.
+
+        With threads=True, on a free-threaded build of Python, lexing runs on
+        a helper thread, handing batches of tokens to tree building on this
+        one (see bach.pipeline). With the GIL, this does nothing. It applies
+        to a plain or frozen parse."""
+
+        assert [lazy, keep is not None, spans, frozen, preindex].count(True) <= 1, \
+            "lazy, keep, spans, frozen and preindex can't be combined"
+
+        limits = self.limits
+        if (lazy or keep is not None) and limits is not None and \
+                (limits.maxDepth, limits.maxStack, limits.maxNodes) != (None, None, None):
+            raise ValueError("maxDepth, maxStack and maxNodes can't be enforced with lazy or keep, "
+                "which parse a level of the tree at a time")
+
+        src = self.limitInput(src)
+
+        if lazy:
+            return self.parseLazy(src, bufsize)
+
+        if spans:
+            return self.parseSpans(src, bufsize)
+
+        if preindex:
+            return self.parseIndexed(src, bufsize)
+
+        if keep is not None:
+            return self.parseProjection(src, keep, bufsize)
+
+        reader = bach.io.reader(src, bufsize, prefetch)()
+        tokens = self.lex(reader)
+
+        if threads and bach.pipeline.freeThreaded():
+            tokens = bach.pipeline.threaded(tokens)
+
+        return self.build(tokens, Document(), interner=Interner() if frozen else None)
+
+
+    def parseFile(self, path, encoding='utf-8', bufsize=bach.io.DEFAULT_BUFFER_SIZE, **options):
+        """Parse the file at path, with any of the options of parse(). If it's
+        compressed with gzip, xz or bzip2 (told by its magic bytes, not its
+        name), it's decompressed on a helper thread, overlapping with lexing,
+        without a temporary file. See bach.compressed."""
+
+        with bach.compressed.openText(path, encoding, bufsize) as fp:
+            return self.parse(fp, bufsize, **options)
+
+
+    def build(self, tokens, document, src=None, interner=None):
+        # Build a tree from tokens, into `document`, and return it. If src is
+        # given, tokens are from lexLevel() over it, and spans are recorded.
+        # With an Interner, each subdocument is replaced by its canonical
+        # FrozenDocument once it ends, and the frozen root is returned.
+
+        # Initialise a stack of documents for parsing into a tree-type structure
+        # The first document opens implicitly
+        state = bach.io.stack([document])
+
+        # For each part of the tree the tokens make
+        for semantic, part in self.dispatch(tokens):
+
+            if semantic is LABEL:
+                state.peek().setLabel(part.lexeme)
+
+            elif semantic is LITERAL:
+                if interner is not None:
+                    state.peek().addChild(interner.string(part.lexeme))
+                elif src is None:
+                    state.peek().addChild(part.lexeme)
+                else:
+                    state.peek().addChild(Literal(part.lexeme, src, part.span))
+
+            elif semantic is SUBDOC_START:
+                # open a new subdocument
+                d = Document()
+                if src is not None:
+                    d.src = src
+                    d.span = part.span
+                state.peek().addChild(d)
+                state.push(d)
+
+            elif semantic is SUBDOC_END:
+                d = state.pop()
+                assert d is not None # should be already enforced by grammar
+                if src is not None:
+                    d.span = (d.span[0], part.span[1])
+                if interner is not None:
+                    state.peek().children[-1] = interner.document(d)
+
+            else:
+                state.peek().addAttribute(*part)
 
 
         # Return the root document
-        return state.peek(0)
+        if interner is not None:
+            return interner.document(document)
+        return document
+
+
+    def extract(self, src, paths, bufsize=bach.io.DEFAULT_BUFFER_SIZE, prefetch=bach.io.DEFAULT_PREFETCH):
+        """Parse src, lazily yielding a (path, match) pair for every
+        subdocument or literal that matches one of the given path patterns e.g.
+        "list/quote/author", "record[@type]" or "list/quote/text()" (see
+        bach.path), while the stream is being parsed.
+
+        Only the subdocuments on a path, and the matches themselves, are ever
+        built, so memory use doesn't grow with the size of the document.
+        A match is a Document or str; path is the pattern string it matched.
+        A stream is read as for parse(), with prefetch (so maybe past the last
+        match that's consumed)."""
 
+        extractor = bach.path.Extractor([bach.path.compile(x) for x in paths])
+
+        reader = bach.io.reader(self.limitInput(src), bufsize, prefetch)()
+        tokens = self.lex(reader)
+
+        # The first document opens implicitly
+        extractor.open()
+
+        # As in build(), for each part of the tree the tokens make
+        for semantic, part in self.dispatch(tokens):
+
+            if semantic is LABEL:
+                extractor.label(part.lexeme)
+
+            elif semantic is LITERAL:
+                yield from extractor.literal(part.lexeme)
+
+            elif semantic is SUBDOC_START:
+                extractor.open()
+
+            elif semantic is SUBDOC_END:
+                yield from extractor.close()
+
+            else:
+                extractor.attribute(*part)
 
+        # The root document closes implicitly
+        yield from extractor.close()
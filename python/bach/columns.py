@@ -0,0 +1,40 @@
+import array
+
+# Tokens in columns, for bulk consumers; see Parser.tokenizeColumns().
+#
+# The columns are plain arrays, so they can be wrapped without a copy by
+# anything that takes the buffer protocol e.g. with NumPy,
+#
+#     numpy.frombuffer(batch.semantics, dtype=numpy.uint8)
+#     numpy.frombuffer(batch.offsets, dtype=numpy.int64).reshape(-1, 2)
+
+DEFAULT_BATCH_SIZE = 65536 # tokens
+
+
+
+class TokenColumns():
+    """A batch of tokens, as columns:
+
+        semantics: array('B') of CaptureSemantic values
+        offsets:   array('q') of start, end offsets into the source for each
+                   token, interleaved (i.e. 2 per token)
+        lexemes:   list of str, with escape sequences in literals resolved
+
+    Offsets are to the whole token as written, so for a literal include its
+    quotes."""
+
+    def __init__(self):
+        self.semantics = array.array('B')
+        self.offsets   = array.array('q')
+        self.lexemes   = []
+
+    def append(self, token):
+        self.semantics.append(token.semantic.value)
+        self.offsets.extend(token.span)
+        self.lexemes.append(token.lexeme)
+
+    def __len__(self):
+        return len(self.semantics)
+
+    def __repr__(self):
+        return "<bach.columns.TokenColumns: %d tokens>" % len(self)
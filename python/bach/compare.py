@@ -0,0 +1,154 @@
+import difflib
+
+# Structural comparison of trees of Documents. A tree's structural hash
+# covers its label, (merged) attributes, and children, in order. It's cached
+# on a FrozenDocument, which can't change, and otherwise computed afresh by
+# each comparison, once for each Document in it.
+#
+# Like bach.query, everything here is non-recursive, so it copes with trees
+# of any depth.
+
+
+def structuralHash(document, hashes=None):
+    """The structural hash of a Document, computed at most once for each
+    Document in the tree. The hashes of mutable Documents are kept in
+    `hashes`, a dict of id(Document) => hash, for the length of one
+    comparison."""
+
+    if hashes is None:
+        hashes = {}
+
+    def known(d):
+        return d._hash if d._hash is not None else hashes.get(id(d))
+
+    # post-order: a Document's hash is computed after its children's
+    stack = [(document, False)]
+    while stack:
+        d, ready = stack.pop()
+
+        if ready:
+            h = hash((d.label, frozenset(d.attributes.items()),
+                tuple(x if isinstance(x, str) else known(x) for x in d.children)))
+            if d._frozen:
+                d._hash = h
+            else:
+                hashes[id(d)] = h
+        elif known(d) is None:
+            stack.append((d, True))
+            stack.extend((x, False) for x in d.children \
+                if not isinstance(x, str) and known(x) is None)
+
+    return known(document)
+
+
+def childKey(child, hashes):
+    # (is a literal?, hash) for matching up children in diff()
+    if isinstance(child, str):
+        return (True, hash(child))
+    return (False, structuralHash(child, hashes))
+
+
+def equal(a, b, hashes=None):
+    """True if two trees (or literals) are structurally equal, which is decided
+    without a walk if their hashes differ"""
+
+    if hashes is None:
+        hashes = {}
+
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+
+        if isinstance(a, str) or isinstance(b, str):
+            if not (isinstance(a, str) and isinstance(b, str) and a == b):
+                return False
+            continue
+
+        if a is b:
+            continue
+        if structuralHash(a, hashes) != structuralHash(b, hashes):
+            return False
+        if a.label != b.label or a.attributes != b.attributes or len(a.children) != len(b.children):
+            return False
+
+        stack.extend(zip(a.children, b.children))
+
+    return True
+
+
+def diff(a, b):
+    """Lazily yield (path, old, new) for each difference between two trees, in
+    document order, where path is a tuple of indexes into .children from the
+    root (to the child in `a`, or for an insertion, in `b`) and:
+
+        old is None: new was inserted
+        new is None: old was deleted
+        otherwise: old was changed to new; if both are Documents with the same
+            label, their attributes differ (and their children are compared
+            separately)
+
+    Identical subtrees, by hash, are skipped over without a walk. Children are
+    matched up with difflib, so an insertion or deletion doesn't make each
+    following sibling a difference."""
+
+    # stack of (path, old, new) pairs to compare, and of differences to yield
+    # (tagged with done=True), popped in document order
+    stack = [(False, (), a, b)]
+    hashes = {}
+
+    while stack:
+        done, path, old, new = stack.pop()
+
+        if done:
+            yield path, old, new
+            continue
+
+        if isinstance(old, str) or isinstance(new, str) or old.label != new.label:
+            if not equal(old, new, hashes):
+                yield path, old, new
+            continue
+
+        if structuralHash(old, hashes) == structuralHash(new, hashes) and equal(old, new, hashes):
+            continue
+
+        if old.attributes != new.attributes:
+            yield path, old, new
+
+        todo = []
+        for i, j in align(old.children, new.children, hashes):
+            if i is None:
+                todo.append((True, path + (j,), None, new.children[j]))
+            elif j is None:
+                todo.append((True, path + (i,), old.children[i], None))
+            else:
+                todo.append((False, path + (i,), old.children[i], new.children[j]))
+
+        stack.extend(reversed(todo))
+
+
+def align(a, b, hashes):
+    # Match up two lists of children as (index in a, index in b) pairs, in
+    # order, where an index is None for a child only in the other list. Equal
+    # children (by hash) are matched first, then, among the others, children
+    # with the same label (or literals), so a changed subdocument is compared
+    # rather than deleted and inserted.
+
+    matcher = difflib.SequenceMatcher(None,
+        [childKey(x, hashes) for x in a], [childKey(x, hashes) for x in b], autojunk=False)
+
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            # n.b. these still may differ, in a hash collision
+            yield from zip(range(i1, i2), range(j1, j2))
+            continue
+
+        labels = difflib.SequenceMatcher(None,
+            [None if isinstance(x, str) else x.label for x in a[i1:i2]],
+            [None if isinstance(x, str) else x.label for x in b[j1:j2]], autojunk=False)
+
+        for tag, k1, k2, l1, l2 in labels.get_opcodes():
+            if tag == 'equal' or (tag == 'replace' and k2 - k1 == l2 - l1):
+                yield from zip(range(i1 + k1, i1 + k2), range(j1 + l1, j1 + l2))
+            else:
+                yield from ((i, None) for i in range(i1 + k1, i1 + k2))
+                yield from ((None, j) for j in range(j1 + l1, j1 + l2))
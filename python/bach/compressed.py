@@ -0,0 +1,114 @@
+import bach.io
+import bach.pipeline
+import bz2
+import gzip
+import io
+import lzma
+
+# Reading Bach documents that may be compressed with gzip, xz or bzip2, told
+# apart by their magic bytes rather than by file name, so that this works for
+# stdin too. Decompression runs on a helper thread, handing chunks to the
+# lexer through a bounded queue (bach.pipeline), so that it overlaps with
+# lexing: zlib, lzma and bz2 release the GIL while they decompress, so this
+# pays off even on a build of Python with the GIL.
+
+MAGIC = (
+    (b'\x1f\x8b',         'gzip'),
+    (b'\xfd7zXZ\x00',     'xz'),
+    (b'BZh',              'bz2'),
+)
+
+DECOMPRESSORS = {
+    'gzip': lambda fp: gzip.GzipFile(fileobj=fp, mode='rb'),
+    'xz':   lambda fp: lzma.LZMAFile(fp, 'rb'),
+    'bz2':  lambda fp: bz2.BZ2File(fp, 'rb'),
+}
+
+DEFAULT_QUEUE_SIZE = 4 # chunks
+
+
+
+def detect(fp):
+    """The compression of a binary stream with peek() (e.g. sys.stdin.buffer
+    or a file opened with "rb"), "gzip", "xz" or "bz2", or None, found without
+    consuming anything"""
+
+    head = fp.peek(max(len(magic) for magic, _ in MAGIC))
+    for magic, compression in MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+
+class ChunkReader(io.RawIOBase):
+    # A raw binary stream over an iterable of bytes chunks, which is closed
+    # with the stream, as is each of `closing`
+
+    def __init__(self, chunks, closing=()):
+        self.chunks = iter(chunks)
+        self.closing = closing
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.pending:
+            self.pending = memoryview(next(self.chunks, b''))
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            close = getattr(self.chunks, 'close', None)
+            if close is not None:
+                close()
+            for x in self.closing:
+                x.close()
+        super().close()
+
+
+
+def chunks(fp, bufsize):
+    # bytes chunks of a binary stream, up to bufsize each
+    while True:
+        data = fp.read(bufsize)
+        if not data:
+            return
+        yield data
+
+
+def textStream(fp, encoding='utf-8', bufsize=bach.io.DEFAULT_BUFFER_SIZE,
+        queueSize=DEFAULT_QUEUE_SIZE, threads=True):
+    """A text stream of a binary stream with peek() e.g. sys.stdin.buffer,
+    which is decompressed if it's compressed with gzip, xz or bzip2 (see
+    detect). With threads=True, it's decompressed on a helper thread, up to
+    queueSize chunks of bufsize bytes ahead of reading. Closing the text stream
+    closes fp."""
+
+    compression = detect(fp)
+
+    if compression is not None:
+        decompressed = DECOMPRESSORS[compression](fp)
+        source = chunks(decompressed, bufsize)
+        if threads:
+            source = bach.pipeline.threaded(source, 1, queueSize)
+        fp = io.BufferedReader(ChunkReader(source, (decompressed, fp)), bufsize)
+
+    return io.TextIOWrapper(fp, encoding=encoding)
+
+
+def openText(path, encoding='utf-8', bufsize=bach.io.DEFAULT_BUFFER_SIZE,
+        queueSize=DEFAULT_QUEUE_SIZE, threads=True):
+    """Open the file at path as a text stream, decompressed as by textStream()
+    if need be"""
+
+    fp = open(path, 'rb')
+    try:
+        return textStream(fp, encoding, bufsize, queueSize, threads)
+    except:
+        fp.close()
+        raise
@@ -0,0 +1,336 @@
+import functools
+import bach.query
+
+# CSS selectors for Bach documents, compiled to matcher closures over
+# Document.label and Document.attributes without any conversion to XML.
+
+# Supported:
+#     label  *  .class  #id  [attr]  [attr=v]  [attr~=v]  [attr|=v]
+#     [attr^=v]  [attr$=v]  [attr*=v]  A B  A > B  A + B  A ~ B  A, B
+#
+# Identifiers may contain any character except whitespace and the special
+# characters below, or a backslash-escaped special character e.g. d\:id or
+# section\.1 (the colon of a namespace prefix like d:id is fine unescaped).
+
+SPECIAL = ' \t\r\n>+~,.#[]*=|^$"\'\\'
+CACHE_SIZE = 256
+
+
+
+class SelectorError(ValueError):
+    def __init__(self, reason, selector, offset):
+        self.reason   = reason
+        self.selector = selector
+        self.offset   = offset
+        super().__init__("Bad selector %s (at character %d): %s" % (repr(selector), offset, reason))
+
+
+
+class SelectorParser():
+    """Parses a selector string into a list of complex selectors, each a list
+    of (combinator, compound) pairs, where a compound is a list of simple
+    selectors as tuples e.g. ('label', 'p') or ('attribute', 'class', '~=',
+    'fancy'), and the combinator of the first compound is None."""
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.index = 0
+
+    def error(self, reason):
+        raise SelectorError(reason, self.selector, self.index)
+
+    def peek(self):
+        if self.index < len(self.selector):
+            return self.selector[self.index]
+        return None
+
+    def skipWhitespace(self):
+        start = self.index
+        while self.peek() is not None and self.peek() in ' \t\r\n':
+            self.index += 1
+        return self.index > start
+
+    def identifier(self):
+        result = []
+        while True:
+            c = self.peek()
+            if c == '\\':
+                self.index += 1
+                if self.peek() is None: self.error("Incomplete escape sequence")
+                result.append(self.peek())
+            elif c is None or c in SPECIAL:
+                break
+            else:
+                result.append(c)
+            self.index += 1
+        if not result: self.error("Expected an identifier")
+        return ''.join(result)
+
+    def string(self):
+        quote = self.peek()
+        self.index += 1
+        result = []
+        while True:
+            c = self.peek()
+            if c is None: self.error("Unterminated string")
+            self.index += 1
+            if c == quote: break
+            if c == '\\':
+                if self.peek() is None: self.error("Incomplete escape sequence")
+                c = self.peek()
+                self.index += 1
+            result.append(c)
+        return ''.join(result)
+
+    def attribute(self):
+        self.index += 1 # [
+        self.skipWhitespace()
+        name = self.identifier()
+        self.skipWhitespace()
+
+        if self.peek() == ']':
+            self.index += 1
+            return ('attribute', name, None, None)
+
+        if self.peek() == '=':
+            op = '='
+            self.index += 1
+        elif self.selector[self.index:self.index+2] in ('~=', '|=', '^=', '$=', '*='):
+            op = self.selector[self.index:self.index+2]
+            self.index += 2
+        else:
+            self.error("Expected an attribute operator or ]")
+
+        self.skipWhitespace()
+        if self.peek() in ('"', "'"):
+            value = self.string()
+        else:
+            value = self.identifier()
+        self.skipWhitespace()
+
+        if self.peek() != ']': self.error("Expected ]")
+        self.index += 1
+        return ('attribute', name, op, value)
+
+    def compound(self):
+        result = []
+
+        if self.peek() == '*':
+            self.index += 1
+            result.append(('any',))
+        elif self.peek() is not None and self.peek() not in SPECIAL or self.peek() == '\\':
+            result.append(('label', self.identifier()))
+
+        while True:
+            c = self.peek()
+            if c == '.':
+                self.index += 1
+                result.append(('attribute', 'class', '~=', self.identifier()))
+            elif c == '#':
+                self.index += 1
+                result.append(('attribute', 'id', '=', self.identifier()))
+            elif c == '[':
+                result.append(self.attribute())
+            else:
+                break
+
+        if not result: self.error("Expected a selector")
+        return result
+
+    def complex(self):
+        result = [(None, self.compound())]
+
+        while True:
+            whitespace = self.skipWhitespace()
+            c = self.peek()
+            if c is None or c == ',':
+                return result
+            elif c in '>+~':
+                self.index += 1
+                self.skipWhitespace()
+                result.append((c, self.compound()))
+            elif whitespace:
+                result.append((' ', self.compound()))
+            else:
+                self.error("Unexpected character %s" % repr(c))
+
+    def parse(self):
+        result = []
+        while True:
+            self.skipWhitespace()
+            result.append(self.complex())
+            if self.peek() is None:
+                return result
+            self.index += 1 # ,
+
+
+
+def compileSimple(simple):
+    # A closure that tests a Document against one simple selector
+
+    kind = simple[0]
+
+    if kind == 'any':
+        return lambda d: True
+
+    if kind == 'label':
+        label = simple[1]
+        return lambda d: d.label == label
+
+    _, name, op, value = simple
+
+    if op is None:
+        return lambda d: name in d.attributes
+    elif op == '=':
+        return lambda d: d.attributes.get(name) == value
+    elif op == '~=':
+        return lambda d: value in d.attributes.get(name, '').split()
+    elif op == '|=':
+        return lambda d: d.attributes.get(name) == value or \
+            d.attributes.get(name, '').startswith(value + '-')
+    elif op == '^=':
+        return lambda d: bool(value) and d.attributes.get(name, '').startswith(value)
+    elif op == '$=':
+        return lambda d: bool(value) and d.attributes.get(name, '').endswith(value)
+    elif op == '*=':
+        return lambda d: bool(value) and value in d.attributes.get(name, '')
+
+
+def compileCompound(compound):
+    tests = [compileSimple(x) for x in compound]
+    if len(tests) == 1:
+        return tests[0]
+    return lambda d: all(test(d) for test in tests)
+
+
+def compileComplex(complexSelector):
+    # A closure (position, structure) => bool, where structure is that of a
+    # bach.query.Index of the tree, matching right-to-left. Each step tests
+    # one compound selector then hands the relevant neighbour(s) of the
+    # Document to the closure for the compound to its left. Neighbours are by
+    # position, so this is right for a Document shared by parts of a frozen
+    # tree too.
+
+    matcher = None
+    for combinator, compound in complexSelector:
+        test = compileCompound(compound)
+        matcher = combine(combinator, test, matcher)
+    return matcher
+
+
+def combine(combinator, test, left):
+
+    if combinator is None:
+        return lambda i, structure: test(structure[0][i])
+
+    if combinator == '>':
+        def match(i, structure):
+            if not test(structure[0][i]): return False
+            parent = structure[1][i]
+            return parent is not None and left(parent, structure)
+
+    elif combinator == ' ':
+        def match(i, structure):
+            if not test(structure[0][i]): return False
+            parents = structure[1]
+            parent = parents[i]
+            while parent is not None:
+                if left(parent, structure): return True
+                parent = parents[parent]
+            return False
+
+    elif combinator == '+':
+        def match(i, structure):
+            if not test(structure[0][i]): return False
+            sibling = structure[2][i]
+            return sibling is not None and left(sibling, structure)
+
+    elif combinator == '~':
+        def match(i, structure):
+            if not test(structure[0][i]): return False
+            previous = structure[2]
+            sibling = previous[i]
+            while sibling is not None:
+                if left(sibling, structure): return True
+                sibling = previous[sibling]
+            return False
+
+    return match
+
+
+def candidates(compound, index, useIndex):
+    # Positions of the Documents that could match the rightmost compound
+    # selector, in document order, using the most selective part of the
+    # index (if useIndex)
+
+    if useIndex:
+        for simple in compound:
+            if simple[0] == 'attribute' and simple[1:3] == ('id', '='):
+                return index.attributePositions('id', simple[3])
+        for simple in compound:
+            if simple[0] == 'attribute' and simple[1:3] == ('class', '~='):
+                return index.wordPositions('class', simple[3])
+        for simple in compound:
+            if simple[0] == 'label':
+                return index.labelPositions(simple[1])
+        for simple in compound:
+            if simple[0] == 'attribute':
+                return index.attributePositions(simple[1])
+
+    return range(len(index.structure()[0]))
+
+
+
+class Selector():
+    """A compiled selector; see compile()"""
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.parsed = SelectorParser(selector).parse()
+        self.matchers = [(x[-1][1], compileComplex(x)) for x in self.parsed]
+
+
+    def select(self, document, index=None):
+        """A list of every Document in the tree that matches, in document
+        order, using `index` (a bach.query.Index of the same tree) if given.
+        As for walk(), a Document shared by parts of a frozen tree is listed
+        once for each part that matches."""
+
+        # Combinators need the structure of an index. Its other parts are
+        # only built when they are first used.
+        context = index if index is not None else bach.query.Index(document)
+        structure = context.structure()
+        documents = structure[0]
+
+        if len(self.matchers) == 1:
+            compound, match = self.matchers[0]
+            return [documents[i] for i in candidates(compound, context, index is not None) \
+                if match(i, structure)]
+
+        # A group: each position at most once, in document order
+        matched = set()
+        for compound, match in self.matchers:
+            matched.update(i for i in candidates(compound, context, index is not None) \
+                if match(i, structure))
+        return [documents[i] for i in sorted(matched)]
+
+
+    def __repr__(self):
+        return "<bach.css.Selector %s>" % repr(self.selector)
+
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def compile(selector):
+    """Compile a selector string, caching the most recently used"""
+    return Selector(selector)
+
+
+def select(document, selector, index=None):
+    """Select every Document in a tree matching a CSS selector string e.g.
+    bach.select(document, "section > p span.fancy"), in document order.
+
+    Pass a bach.query.Index of the same tree as `index` to look up candidates
+    by id, class or label, instead of testing every Document."""
+
+    return compile(selector).select(document, index)
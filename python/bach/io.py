@@ -1,23 +1,28 @@
 DEFAULT_BUFFER_SIZE = (64*1024) # 64kb
 
+# Streams are read as they're needed, by default, or, if given a prefetch of
+# N buffers, ahead on a helper thread with up to N in flight, in reads whose
+# size adapts to the observed throughput: see chunks(). That only pays off
+# for a slow stream e.g. a pipe or a socket; for a small or in-memory one,
+# starting the thread costs more than it saves.
+DEFAULT_PREFETCH = 0 # buffers
+MAX_BUFFER_SIZE = (16*1024*1024) # 16mb
+ADAPT_READS = 4 # reads to measure the throughput of each size over
+
+import bach.pipeline
+import io
+import time
 from itertools import tee, zip_longest
 
 
 
-def reader(src, bufsize):
+def reader(src, bufsize, prefetch=DEFAULT_PREFETCH):
     """Depending on the type of `src`, return the best lazy reader, a
        function that returns some iterable."""
 
     def readStream():
-        while True:
-            data = src.read(bufsize)
-            if not data:
-                return
-            elif not len(data):
-                yield data
-                return
-            else:
-                yield from data
+        for data in chunks(src, bufsize, prefetch):
+            yield from data
 
     def identity():
         return src
@@ -29,13 +34,66 @@ def reader(src, bufsize):
         return identity
     elif hasattr(src, "read"):
         return readStream
-    elif hasattr(src, __iter__):
+    elif hasattr(src, "__iter__"):
         return readIterable
     else:
         raise TypeError("src must be a text stream, str, or iterable")
 
 
 
+def adaptiveChunks(src, bufsize, maxBufsize=MAX_BUFFER_SIZE):
+    """Lazily yield chunks read from a stream, starting with reads of bufsize,
+    then doubling or halving the size of each read (between bufsize and
+    maxBufsize) for as long as that improves the throughput, measured over
+    ADAPT_READS reads at each size. So reads grow where each one has a high
+    latency, as over a network, and stay small where they don't."""
+
+    minBufsize = bufsize
+    factor = 2
+    lastRate = None
+    total, elapsed, reads = 0, 0.0, 0
+
+    while True:
+        started = time.perf_counter()
+        data = src.read(bufsize)
+        elapsed += time.perf_counter() - started
+        if not data:
+            return
+        yield data
+
+        total += len(data)
+        reads += 1
+        if reads < ADAPT_READS:
+            continue
+
+        # hill-climb: keep going while it's better, and turn back if it's worse
+        rate = total / max(elapsed, 1e-9)
+        if lastRate is not None and rate < lastRate:
+            factor = 1 / factor
+        lastRate = rate
+        bufsize = min(max(int(bufsize * factor), minBufsize), maxBufsize)
+        total, elapsed, reads = 0, 0.0, 0
+
+
+def chunks(src, bufsize, prefetch=DEFAULT_PREFETCH):
+    """Lazily yield chunks read from a stream by adaptiveChunks(), on a helper
+    thread up to `prefetch` chunks ahead, so that waiting on reads overlaps
+    with whatever is done with each chunk, or, if prefetch is 0 (or the stream
+    is in memory, so reads don't wait), as they're needed, in reads of
+    bufsize. N.B. with prefetch, the stream may be read past what is used, up
+    to the end."""
+
+    if not prefetch or isinstance(src, (io.StringIO, io.BytesIO)):
+        while True:
+            data = src.read(bufsize)
+            if not data:
+                return
+            yield data
+
+    yield from bach.pipeline.threaded(adaptiveChunks(src, bufsize), 1, prefetch)
+
+
+
 def pairwise(iterable):
     """For [a, b, c, ...] lazily return [(a, b), (b, c), (c, ...), (..., None)]
 
@@ -51,8 +109,8 @@ def pairwise(iterable):
 class stack():
     """Generic implementation of a stack interface backed by a list"""
 
-    def __init__(self, xs=[]):
-        self.entries = xs
+    def __init__(self, xs=None):
+        self.entries = [] if xs is None else xs
 
     def peek(self, index=-1):
         try:
@@ -0,0 +1,197 @@
+import bach
+import functools
+
+# Simple path patterns for extracting parts of a document while it is parsed,
+# see Parser.extract().
+#
+# A path is a list of steps separated by "/", starting at the root document,
+# e.g. "list/quote/author". Each step is a label, or * for any label, with
+# optional attribute tests e.g. "record[@type]" or "record[@type='a']". The
+# last step may be "text()" to match the literals of the document before it
+# e.g. "list/quote/text()". A leading "/" is optional.
+
+CACHE_SIZE = 256
+
+
+
+class PathError(ValueError):
+    def __init__(self, reason, path):
+        self.reason = reason
+        self.path   = path
+        super().__init__("Bad path %s: %s" % (repr(path), reason))
+
+
+
+class Step():
+
+    def __init__(self, label, predicates, text=False):
+        self.label      = label      # str, or None for any label
+        self.predicates = predicates # list of (attribute name, value or None)
+        self.text       = text       # True for text()
+
+    def matchesLabel(self, label):
+        return self.label is None or self.label == label
+
+    def matchesAttributes(self, attributes):
+        for name, value in self.predicates:
+            if name not in attributes:
+                return False
+            if value is not None and attributes[name] != value:
+                return False
+        return True
+
+
+
+class Path():
+
+    def __init__(self, path):
+        self.path  = path
+        self.steps = list(self.parseSteps(path))
+
+        if not self.steps:
+            raise PathError("Empty path", path)
+        if self.steps[0].text:
+            raise PathError("text() must follow a document step", path)
+        if any(x.text for x in self.steps[:-1]):
+            raise PathError("text() must be the last step", path)
+
+
+    def parseSteps(self, path):
+        for step in path[1:].split('/') if path.startswith('/') else path.split('/'):
+
+            if step == 'text()':
+                yield Step(None, [], text=True)
+                continue
+
+            label, _, rest = step.partition('[')
+            if not label:
+                raise PathError("Empty step", self.path)
+
+            predicates = []
+            while rest:
+                test, _, rest = rest.partition(']')
+                if not test.startswith('@'):
+                    raise PathError("Expected [@attribute] or [@attribute='value']", self.path)
+
+                name, eq, value = test[1:].partition('=')
+                if eq:
+                    if len(value) < 2 or value[0] not in '"\'' or value[-1] != value[0]:
+                        raise PathError("Attribute values must be quoted", self.path)
+                    value = value[1:-1]
+                else:
+                    value = None
+
+                predicates.append((name, value))
+
+                if rest.startswith('['):
+                    rest = rest[1:]
+                elif rest:
+                    raise PathError("Unexpected %s" % repr(rest), self.path)
+
+            yield Step(None if label == '*' else label, predicates)
+
+
+    def __repr__(self):
+        return "<bach.path.Path %s>" % repr(self.path)
+
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def compile(path):
+    return Path(path)
+
+
+
+class Frame():
+    # An open subdocument while extracting
+
+    def __init__(self, parent):
+        self.parent   = parent
+        self.document = None  # Document, or None if not retained
+        self.active   = []    # (path index, step index) matched by this label
+        self.build    = False # True to retain the whole subtree
+        self.pending  = []    # (path index, match) waiting on this frame's attributes
+
+
+
+class Extractor():
+    """Evaluates paths against the events of a parse, retaining only the
+    subdocuments on a path (with just their label and attributes) and the
+    matched subtrees themselves.
+
+    Attributes may appear anywhere in a subdocument, so an attribute test can
+    only be decided when that subdocument ends. Until then a match below it is
+    held back, which means matches may be found out of document order."""
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.stack = [] # open Frames; a frame at depth i matches step i
+
+
+    def open(self):
+        parent = self.stack[-1] if self.stack else None
+        self.stack.append(Frame(parent))
+
+
+    def label(self, label):
+        frame = self.stack[-1]
+        parent = frame.parent
+
+        if parent is None:
+            candidates = [(p, 0) for p in range(len(self.paths))]
+        else:
+            candidates = [(p, k + 1) for p, k in parent.active \
+                if k + 1 < len(self.paths[p].steps) and not self.paths[p].steps[k + 1].text]
+
+        frame.active = [(p, k) for p, k in candidates \
+            if self.paths[p].steps[k].matchesLabel(label)]
+
+        frame.build = (parent is not None and parent.build) or \
+            any(k == len(self.paths[p].steps) - 1 for p, k in frame.active)
+
+        if frame.build or frame.active:
+            frame.document = bach.Document()
+            frame.document.setLabel(label)
+            if parent is not None and parent.build:
+                parent.document.addChild(frame.document)
+
+
+    def attribute(self, shorthand, attributeName, attributeValue, startPos, endPos):
+        frame = self.stack[-1]
+        if frame.document is not None:
+            frame.document.addAttribute(shorthand, attributeName, attributeValue, startPos, endPos)
+
+
+    def literal(self, value):
+        frame = self.stack[-1]
+
+        if frame.build:
+            frame.document.addChild(value)
+
+        for p, k in frame.active:
+            if k == len(self.paths[p].steps) - 2 and self.paths[p].steps[-1].text:
+                yield from self.defer(p, value, len(self.stack) - 1)
+
+
+    def close(self):
+        frame = self.stack.pop()
+        depth = len(self.stack)
+
+        # frame's attributes are now complete
+        waiting = [(p, frame.document) for p, k in frame.active if k == len(self.paths[p].steps) - 1]
+        waiting.extend(frame.pending)
+
+        for p, match in waiting:
+            if self.paths[p].steps[depth].matchesAttributes(frame.document.attributes):
+                yield from self.defer(p, match, depth - 1)
+
+
+    def defer(self, p, match, depth):
+        # Yield (path, match) if no step of the path up to `depth` tests
+        # attributes, otherwise wait for the deepest such frame to end
+        steps = self.paths[p].steps
+        for i in range(depth, -1, -1):
+            if steps[i].predicates:
+                self.stack[i].pending.append((p, match))
+                return
+        yield self.paths[p].path, match
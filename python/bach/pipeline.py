@@ -0,0 +1,72 @@
+import queue
+import sys
+import threading
+
+# Running the stages of a parse on separate threads, connected by bounded
+# queues of batches of items (e.g. tokens), so that the stages overlap. This
+# only pays off on a free-threaded build of Python (3.13t or later): with the
+# GIL, the threads would just take turns, so Parser.parse(src, threads=True)
+# runs inline instead.
+#
+# Any iterator is a stage, so stages chain e.g. a writer consuming tokens
+# on a thread of its own: threaded(write(threaded(parser.lex(src)))).
+
+DEFAULT_BATCH_SIZE = 4096 # items
+DEFAULT_QUEUE_SIZE = 8    # batches
+
+
+
+def freeThreaded():
+    """True if this Python is running without the GIL"""
+    isGilEnabled = getattr(sys, '_is_gil_enabled', None)
+    return isGilEnabled is not None and not isGilEnabled()
+
+
+def threaded(iterable, batchSize=DEFAULT_BATCH_SIZE, queueSize=DEFAULT_QUEUE_SIZE):
+    """Lazily yield the items of iterable, which is consumed on a helper thread
+    in batches of up to batchSize, through a queue of at most queueSize
+    batches. An exception raised by the iterable is raised here instead.
+
+    The thread starts on the first next(), and stops (after at most one more
+    batch) if the result is closed before the end."""
+
+    q = queue.Queue(queueSize)
+    stop = threading.Event()
+
+    def put(kind, value):
+        while not stop.is_set():
+            try:
+                q.put((kind, value), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            batch = []
+            for item in iterable:
+                batch.append(item)
+                if len(batch) >= batchSize:
+                    if not put('batch', batch): return
+                    batch = []
+            if batch and not put('batch', batch): return
+            put('end', None)
+        except BaseException as e:
+            put('error', e)
+
+    thread = threading.Thread(target=produce, name='bach.pipeline', daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            kind, value = q.get()
+            if kind == 'batch':
+                yield from value
+            elif kind == 'end':
+                return
+            else:
+                raise value
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,143 @@
+import json
+from bach.unpack import CompiledGrammar
+
+
+
+def describe(grammar, state, production):
+    """Describe a production rule from a given state in the syntax of
+    grammar.txt e.g. `LDQ => ¬dqesc LDQ` or `WS => ws ; lookahead in ws`.
+
+    The result doesn't depend on the order or IDs of rules in the compiled
+    grammar, so it is also used as a key for a rule in a dumped profile."""
+
+    names = grammar.SYMBOL_NAMES
+    sets  = grammar.TERMINAL_SET_NAMES
+
+    setId, invert = production.terminalIdPair
+    result = [names[state], '=>', ('¬' if invert else '') + sets[setId]]
+    result.extend(names[x] for x in reversed(production.nonterminals))
+    result = ' '.join(result)
+
+    # "lookahead not in special:none" => any lookahead, so omit it
+    setId, invert = production.lookaheadIdPair
+    if (setId, invert) != (CompiledGrammar.TERMINAL_SET_NONE_ID, True):
+        result += ' ; lookahead %s %s' % ('not in' if invert else 'in', sets[setId])
+
+    return result
+
+
+
+class Profile():
+    """Counters collected by the lexers of a parser constructed with
+    profile=True, accumulated over every document it lexes. The body of a
+    literal that a lexer jumps over (e.g. with parse(src, preindex=True)) or
+    matches at once (events()) isn't counted, and the peak stack depth is only
+    measured by Parser.lex()."""
+
+    def __init__(self, grammar, states):
+        self.grammar = grammar
+        self.states  = states # a list of production rule lists, by state ID
+        self.reset()
+
+
+    def reset(self):
+        self.characters     = 0
+        self.tokens         = 0
+        self.peakStackDepth = 0
+
+        # by state ID
+        self.stateVisits = [0] * len(self.states)
+        self.rulesTried  = [0] * len(self.states) # calls to Production.match
+
+        # by state ID, then by index of the rule in that state
+        self.productionHits = [[0] * len(rules) for rules in self.states]
+
+
+    def productions(self):
+        # yields (state ID, rule index, production, hits) for every rule
+        for state, rules in enumerate(self.states):
+            for index, production in enumerate(rules):
+                yield state, index, production, self.productionHits[state][index]
+
+
+    def dump(self, fp):
+        """Write the counters to a file-like object as JSON, keyed by symbol
+        names and rules as written in grammar.txt (e.g. for cgrammar.py)"""
+
+        names = self.grammar.SYMBOL_NAMES
+
+        json.dump({
+            'characters':     self.characters,
+            'tokens':         self.tokens,
+            'peakStackDepth': self.peakStackDepth,
+            'stateVisits':    dict(zip(names, self.stateVisits)),
+            'rulesTried':     dict(zip(names, self.rulesTried)),
+            'productionHits': dict((describe(self.grammar, state, production), hits) \
+                for state, index, production, hits in self.productions()),
+        }, fp, indent=4, ensure_ascii=False)
+
+
+    def report(self):
+        """Returns a human-readable report of the counters, hottest states
+        first"""
+
+        names = self.grammar.SYMBOL_NAMES
+
+        lines = ["Bach lexer profile: %d characters, %d tokens, peak stack depth %s" % \
+            (self.characters, self.tokens, self.peakStackDepth or "not measured")]
+
+        order = sorted(range(len(self.states)), key=lambda i: -self.stateVisits[i])
+        for state in order:
+            visits, tried = self.stateVisits[state], self.rulesTried[state]
+            if not visits: continue
+
+            lines.append("")
+            lines.append("state %-8s %10d visits %10d rules tried (%.2f per visit)" % \
+                ("%s (%d)" % (names[state], state), visits, tried, tried / visits))
+
+            for index, production in enumerate(self.states[state]):
+                lines.append("    %10d hits  [%d] %s" % (self.productionHits[state][index],
+                    index, describe(self.grammar, state, production)))
+
+        return '\n'.join(lines)
+
+
+
+def matches(production):
+    # what a production rule matches, which is distinct within a state
+    return tuple(production.terminalIdPair), tuple(production.lookaheadIdPair)
+
+
+
+class CountingTransitions():
+    """A table of transitions, as from Parser.transitionTable(), that counts
+    each lookup into a Profile as Parser.lexProfiled() counts a character,
+    for the lexers that look up a transition rather than try each rule."""
+
+    def __init__(self, table, profile):
+        self.table   = table
+        self.profile = profile
+
+        # the index of each rule in its state, by what it matches, as the
+        # table may be shared with parsers that have their own Productions
+        self.indices = [dict((matches(production), index) for index, production in enumerate(rules)) \
+            for rules in profile.states]
+
+    def __getitem__(self, key):
+        production = self.table[key]
+
+        profile = self.profile
+        state = key[0]
+
+        profile.characters += 1
+        profile.stateVisits[state] += 1
+        if production is None:
+            profile.rulesTried[state] += len(profile.states[state])
+        else:
+            index = self.indices[state][matches(production)]
+            profile.rulesTried[state] += index + 1
+            profile.productionHits[state][index] += 1
+            if production.captureEnd():
+                profile.tokens += 1
+
+        return production
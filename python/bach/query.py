@@ -0,0 +1,215 @@
+
+
+def walk(document):
+    """Lazily yield every Document in a tree, depth-first in document order,
+    starting with `document` itself. A Document shared by more than one part
+    of a frozen tree is yielded for each.
+
+    This is non-recursive, so it copes with trees of any depth."""
+
+    # N.B. children are a mixed list of Documents and str literals
+
+    yield document
+    stack = [iter(document.children)]
+
+    while stack:
+        for child in stack[-1]:
+            if not isinstance(child, str):
+                yield child
+                stack.append(iter(child.children))
+                break
+        else:
+            stack.pop()
+
+
+def walkWithParents(document):
+    """Like walk(), but yield (Document, parent Document) pairs, where the
+    parent of `document` itself is None."""
+
+    yield document, None
+    stack = [(document, iter(document.children))]
+
+    while stack:
+        parent, it = stack[-1]
+        for child in it:
+            if not isinstance(child, str):
+                yield child, parent
+                stack.append((child, iter(child.children)))
+                break
+        else:
+            stack.pop()
+
+
+def iterLabel(document, label=None):
+    """Lazily yield every Document in a tree with the given label, in document
+    order, including `document` itself. If label is None, yield everything."""
+
+    if label is None:
+        return walk(document)
+    return (x for x in walk(document) if x.label == label)
+
+
+
+class Index():
+    """An index over a tree of Documents for repeated lookups by label, by
+    attribute, and of parents.
+
+    Each part of the index is built lazily, with a single walk of the tree, the
+    first time it is needed. An index reflects the tree at that time, so build
+    a new Index if the tree is modified afterwards.
+
+    The index is of positions in the tree, numbered in document order. In a
+    frozen tree (see Parser.parse(src, frozen=True)), structurally identical
+    subtrees are one shared FrozenDocument, which is then at more than one
+    position: it's found once for each, as by walk(), and its parent can only
+    be looked up by position."""
+
+    def __init__(self, document):
+        self.document = document
+        self._structure = None  # (documents, parents, previous), see structure()
+        self._shared = None     # id(Document) of those at more than one position
+        self._positions = None  # id(Document) => its position
+        self._labels = None     # label => [position]
+        self._attributes = None # attribute name => [position]
+        self._values = None     # (attribute name, value) => [position]
+        self._words = None      # (attribute name, word in value) => [position]
+
+
+    def structure(self):
+        """(documents, parents, previous): lists, by position, of each
+        Document, the position of its parent, and the position of its
+        previous sibling Document, or None for none"""
+
+        if self._structure is None:
+            documents, parents, previous = [self.document], [None], [None]
+            stack = [[0, iter(self.document.children), None]] # position, children, last child
+
+            while stack:
+                frame = stack[-1]
+                for child in frame[1]:
+                    if not isinstance(child, str):
+                        position = len(documents)
+                        documents.append(child)
+                        parents.append(frame[0])
+                        previous.append(frame[2])
+                        frame[2] = position
+                        stack.append([position, iter(child.children), None])
+                        break
+                else:
+                    stack.pop()
+
+            self._structure = (documents, parents, previous)
+
+        return self._structure
+
+
+    def labelPositions(self, label):
+        """The position of every Document with the given label, in order"""
+
+        if self._labels is None:
+            self._labels = {}
+            for i, d in enumerate(self.structure()[0]):
+                try:
+                    self._labels[d.label].append(i)
+                except KeyError:
+                    self._labels[d.label] = [i]
+
+        return self._labels.get(label, [])
+
+
+    def attributePositions(self, name, value=None):
+        """The position of every Document, in order, that has the given
+        attribute, or if value is not None, the given attribute with exactly
+        that (merged) value"""
+
+        if self._attributes is None:
+            self._attributes = {}
+            self._values = {}
+            for i, d in enumerate(self.structure()[0]):
+                for k, v in d.attributes.items():
+                    try:
+                        self._attributes[k].append(i)
+                    except KeyError:
+                        self._attributes[k] = [i]
+                    try:
+                        self._values[(k, v)].append(i)
+                    except KeyError:
+                        self._values[(k, v)] = [i]
+
+        if value is None:
+            return self._attributes.get(name, [])
+        return self._values.get((name, value), [])
+
+
+    def wordPositions(self, name, word):
+        """The position of every Document, in order, whose value for the
+        given attribute contains `word` as one of its whitespace-separated
+        words"""
+
+        if self._words is None:
+            self._words = {}
+            for i, d in enumerate(self.structure()[0]):
+                for k, v in d.attributes.items():
+                    for w in set(v.split()):
+                        try:
+                            self._words[(k, w)].append(i)
+                        except KeyError:
+                            self._words[(k, w)] = [i]
+
+        return self._words.get((name, word), [])
+
+
+    def label(self, label):
+        """A list of every Document with the given label, in document order"""
+        documents = self.structure()[0]
+        return [documents[i] for i in self.labelPositions(label)]
+
+
+    def attribute(self, name, value=None):
+        """A list of every Document, in document order, that has the given
+        attribute, or if value is not None, the given attribute with exactly
+        that (merged) value e.g. index.attribute('class', 'a b')"""
+        documents = self.structure()[0]
+        return [documents[i] for i in self.attributePositions(name, value)]
+
+
+    def word(self, name, word):
+        """A list of every Document, in document order, whose value for the
+        given attribute contains `word` as one of its whitespace-separated
+        words e.g. index.word('class', 'a') matches class="a b"."""
+        documents = self.structure()[0]
+        return [documents[i] for i in self.wordPositions(name, word)]
+
+
+    def position(self, document):
+        """The position of a Document in the tree. Raises a ValueError for a
+        Document at more than one position (in a frozen tree)."""
+
+        if self._positions is None:
+            self._positions = {}
+            self._shared = set()
+            for i, d in enumerate(self.structure()[0]):
+                if self._positions.setdefault(id(d), i) != i:
+                    self._shared.add(id(d))
+
+        if id(document) in self._shared:
+            raise ValueError("%r is at more than one position in the tree" % document)
+        return self._positions[id(document)]
+
+
+    def parent(self, document):
+        """The parent of a Document in the tree, or None for the root"""
+
+        documents, parents, _ = self.structure()
+        parent = parents[self.position(document)]
+        return None if parent is None else documents[parent]
+
+
+    def ancestors(self, document):
+        """Lazily yield the parent, grandparent, etc. of a Document"""
+
+        documents, parents, _ = self.structure()
+        parent = parents[self.position(document)]
+        while parent is not None:
+            yield documents[parent]
+            parent = parents[parent]
@@ -0,0 +1,82 @@
+import re
+
+# Fast scanning of Bach source text without running the automaton, using the
+# regular expression engine to jump between characters of interest.
+
+
+# Characters that can open or close a subdocument or a literal
+STRUCTURAL = re.compile(r'''[()"'\[]''')
+
+# The remainder of a literal after its opening quote, with escapes
+LITERAL_REMAINDER = {
+    '"': re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S),
+    "'": re.compile(r"[^'\\]*(?:\\.[^'\\]*)*'", re.S),
+    '[': re.compile(r'[^\]\\]*(?:\\.[^\]\\]*)*\]', re.S),
+}
+
+# As much of the remainder of a literal as has been read, up to its closing
+# quote, for scanning a stream without rescanning a literal open at the end
+# of what's read so far (which stops at the end, or at a backslash there)
+LITERAL_PARTIAL = {
+    '"': re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.S),
+    "'": re.compile(r"[^'\\]*(?:\\.[^'\\]*)*", re.S),
+    '[': re.compile(r'[^\]\\]*(?:\\.[^\]\\]*)*', re.S),
+}
+
+
+
+def matchParenthesis(text, start, end=None):
+    """Given the index of an opening parenthesis in text, return the index of
+    the matching closing parenthesis, or None if there is none before end.
+
+    Parentheses inside 'single', "double" and [bracket] quoted literals, with
+    their escape sequences, are skipped over. Comments only appear in the head
+    of a document, before any subdocument, so a "#" here is never a comment
+    (but may be a shorthand attribute).
+
+    This only finds the extent of a subdocument; its syntax isn't checked."""
+
+    if end is None:
+        end = len(text)
+
+    search = STRUCTURAL.search
+    depth = 0
+    index = start
+
+    while True:
+        m = search(text, index, end)
+        if m is None:
+            return None
+
+        c = m.group()
+        index = m.end()
+
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                return index - 1
+        else:
+            m = LITERAL_REMAINDER[c].match(text, index, end)
+            if m is None:
+                return None
+            index = m.end()
+
+
+def findLabels(text, labels, specialCharacters):
+    """A sorted list of the index of every "(" in text that is followed by
+    optional whitespace and one of the given labels, ending at one of
+    specialCharacters or the end of text.
+
+    Matches inside literals are included too, so treat each one as a
+    possibility only."""
+
+    if not labels:
+        return []
+
+    pattern = r'\([ \t\r\n]*(?:%s)(?=[%s]|$)' % (
+        '|'.join(re.escape(x) for x in sorted(labels, key=len, reverse=True)),
+        re.escape(specialCharacters))
+
+    return [m.start() for m in re.finditer(pattern, text)]
@@ -0,0 +1,249 @@
+import array
+import bach.io
+import bach.tail
+import hashlib
+import os
+import struct
+import sys
+from bach.bach import CaptureSemantic, ParseError, Parser, Position
+
+# A sidecar index of the top-level subdocuments ("records") of a Bach file
+# e.g. "file.bach.idx" for "file.bach", built in one pass over it, so that
+# any record can then be parsed on its own by seeking straight to it.
+#
+# The index file is, in little-endian order:
+#
+#     MAGIC
+#     HEADER:  size of the source in bytes, its SHA-256, number of records,
+#              and size of the labels in bytes
+#     labels:  each distinct label, in UTF-8, separated by "\n" (which can't
+#              be part of a label)
+#     records: for each record, 5 signed 64-bit integers: byte offset and
+#              length of its source, from "(" to ")", the line and column it
+#              starts at, and the number of its label in the labels
+
+MAGIC = b'BACHIDX\x01'
+HEADER = struct.Struct('<Q32sQQ')
+FIELDS = 5 # per record
+
+
+
+class RecordIndex():
+    """The sidecar index of the records of a Bach file; see build() and
+    load(). len() is the number of records, and labels[n] is the label of
+    record n."""
+
+    def __init__(self, size, checksum, labelNames, records):
+        self.size       = size       # of the source, in bytes
+        self.checksum   = checksum   # SHA-256 digest of the source
+        self.labelNames = labelNames # list of distinct labels
+        self.records    = records    # array('q') of FIELDS per record
+
+    @property
+    def labels(self):
+        return [self.labelNames[x] for x in self.records[FIELDS - 1::FIELDS]]
+
+    def find(self, label):
+        # the numbers of the records with a given label
+        if label not in self.labelNames:
+            return []
+        i = self.labelNames.index(label)
+        return [n for n, x in enumerate(self.records[FIELDS - 1::FIELDS]) if x == i]
+
+    def save(self, path):
+        records = self.records
+        if sys.byteorder != 'little':
+            records = array.array('q', records)
+            records.byteswap()
+        labels = '\n'.join(self.labelNames).encode('utf-8')
+
+        with open(path, 'wb') as fp:
+            fp.write(MAGIC)
+            fp.write(HEADER.pack(self.size, self.checksum, len(self), len(labels)))
+            fp.write(labels)
+            records.tofile(fp)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fp:
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a Bach sidecar index" % path)
+            size, checksum, count, labelsSize = HEADER.unpack(fp.read(HEADER.size))
+            labels = fp.read(labelsSize).decode('utf-8')
+            records = array.array('q')
+            records.fromfile(fp, count * FIELDS)
+
+        if sys.byteorder != 'little':
+            records.byteswap()
+        return cls(size, checksum, labels.split('\n') if labels else [], records)
+
+    def __len__(self):
+        return len(self.records) // FIELDS
+
+    def __repr__(self):
+        return "<bach.sidecar.RecordIndex: %d records, %d labels>" % (len(self), len(self.labelNames))
+
+
+
+def build(path, parser=None, check=True, bufsize=bach.io.DEFAULT_BUFFER_SIZE, encoding='utf-8'):
+    """The RecordIndex of the Bach file at path, found in one pass, reading it
+    a buffer at a time. The whole document is parsed, except, with
+    check=False, inside each record, which is then only checked when read."""
+
+    if parser is None:
+        parser = Parser()
+
+    digest = hashlib.sha256()
+    labelIds = {}
+    records = array.array('q')
+
+    state = bach.io.stack([0])
+    pos = Position(1, 0)
+    offset = 0 # in bytes, of text[index] below
+    scanner = bach.tail.Scanner(encoding)
+    last = None # semantic of the last token
+    misplaced = None # a ParseError for an assignment, raised at the next token
+
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(bufsize)
+            digest.update(chunk)
+
+            # lex up to the end of the last complete record, as for
+            # bach.follow, until the end
+            end = scanner.feed(chunk, final=not chunk)
+            if chunk and not end:
+                continue
+            text = scanner.text
+
+            index = 0
+            for token in parser.lexLevel(text, 0, end, state, pos):
+                # as for Parser.dispatch(), which only accepts an assignment
+                # after an attribute, though the grammar accepts one after any
+                # token, and rejects it once the token after it is lexed
+                if misplaced is not None:
+                    raise misplaced
+                if token.semantic is CaptureSemantic.assign and last is not CaptureSemantic.attribute:
+                    misplaced = ParseError("Unexpected %s" % token.semantic, token.start, token.end)
+                    continue
+                last = token.semantic
+                if token.semantic is not CaptureSemantic.subdocStart:
+                    continue
+                i, j = token.span
+                if check:
+                    parser.parseSubdocument(text, i, j, token.start)
+
+                label = parser.readLabel(text, i, j)
+                labelId = labelIds.setdefault(label, len(labelIds))
+
+                offset += len(text[index:i].encode(encoding))
+                length = len(text[i:j].encode(encoding))
+                records.extend((offset, length, token.start.line, token.start.column, labelId))
+                offset += length
+                index = j
+
+            offset += len(text[index:end].encode(encoding))
+            scanner.consume(end)
+
+            if not chunk:
+                break
+
+    # special case - e.g. allow EOF at D without trailing whitespace
+    finalState = state.peek()
+    if finalState is not None and finalState not in parser.endStates:
+        raise ParseError("Unexpected end of file in state %d" % finalState, None, pos)
+
+    if misplaced is not None:
+        raise misplaced
+
+    return RecordIndex(offset, digest.digest(), list(labelIds), records)
+
+
+def create(path, indexPath=None, parser=None, check=True, bufsize=bach.io.DEFAULT_BUFFER_SIZE,
+        encoding='utf-8'):
+    """Build the RecordIndex of the Bach file at path, save it beside it (at
+    path + ".idx", by default) and return it"""
+
+    index = build(path, parser, check, bufsize, encoding)
+    index.save(path + '.idx' if indexPath is None else indexPath)
+    return index
+
+
+
+class IndexedFile():
+    """A Bach file opened with its sidecar index, to parse any of its records
+    on their own, by seeking to them:
+
+        with bach.sidecar.IndexedFile("file.bach") as f:
+            f.record(41)
+            for document in f.find("entry"):
+                ...
+
+    The index must be of the file as it is now. Only its size is compared
+    unless verify=True, which reads the whole file to compare its checksum.
+    Errors in a record report its line in the whole file."""
+
+    def __init__(self, path, indexPath=None, parser=None, verify=False, encoding='utf-8'):
+        self.index = RecordIndex.load(path + '.idx' if indexPath is None else indexPath)
+        self.parser = Parser() if parser is None else parser
+        self.encoding = encoding
+        self.fp = open(path, 'rb')
+
+        try:
+            if os.fstat(self.fp.fileno()).st_size != self.index.size:
+                raise ValueError("%s has changed since it was indexed" % path)
+
+            if verify:
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: self.fp.read(bach.io.DEFAULT_BUFFER_SIZE), b''):
+                    digest.update(chunk)
+                if digest.digest() != self.index.checksum:
+                    raise ValueError("%s has changed since it was indexed" % path)
+        except:
+            self.fp.close()
+            raise
+
+    def fields(self, n):
+        # the index entry of record n, counting from the end if negative
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError("record %d of %d" % (n, len(self)))
+        return self.index.records[n * FIELDS:(n + 1) * FIELDS]
+
+    def sourceText(self, n):
+        """The source of record n, from "(" to ")" """
+        offset, length, _, _, _ = self.fields(n)
+        self.fp.seek(offset)
+        return self.fp.read(length).decode(self.encoding)
+
+    def record(self, n):
+        """Parse record n (counting from 0, and from the end if negative) into
+        a Document"""
+
+        _, _, line, column, _ = self.fields(n)
+
+        # with a lookahead after the closing parenthesis, standing in for
+        # the rest of the file
+        text = self.sourceText(n) + '\n'
+        return self.parser.parseSubdocument(text, 0, len(text) - 1, Position(line, column))
+
+    def find(self, label):
+        """Lazily parse each record with a given label, in order"""
+        for n in self.index.find(label):
+            yield self.record(n)
+
+    def close(self):
+        self.fp.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return "<bach.sidecar.IndexedFile: %s, %d records>" % (self.fp.name, len(self))
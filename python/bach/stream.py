@@ -0,0 +1,169 @@
+import bach.io
+import bach.scan
+import bach.structural
+import re
+
+# Splitting a stream of many top-level Bach documents ("records") into the
+# text of each one, as it is read, for Parser.parseStream().
+#
+# Records are either separated by a delimiter (outside of any subdocument or
+# literal) or just concatenated, in which case a new record starts at a line
+# that begins, at the very first column, with a label (or a comment, if "#"
+# isn't a shorthand). A line that begins with an attribute assignment e.g.
+# title="..." continues the record, as a label can't be followed by "=", but
+# an attribute without a value can't be told apart from a label, so in a
+# concatenated stream it must be indented (or not start a line).
+#
+#     log level=info
+#         "Started"
+#     log level=warn
+#         "Low disk space" (disk free="2%")
+
+# Characters at the start of a line that continue the current record
+CONTINUATION = ' \t\r\n()"\'[]='
+
+# Special characters, which end a label or attribute name, besides shorthand
+# symbols
+SPECIAL = '#= \t\r\n()"\'[]<>\\'
+
+
+
+def chunks(src, bufsize, prefetch=bach.io.DEFAULT_PREFETCH):
+    # str chunks of src, a str, text stream, or iterable of characters
+    if isinstance(src, str):
+        yield src
+    elif hasattr(src, 'read'):
+        yield from bach.io.chunks(src, bufsize, prefetch)
+    else:
+        yield ''.join(src)
+
+
+def records(src, bufsize, delimiter=None, shorthands='', prefetch=bach.io.DEFAULT_PREFETCH):
+    """Lazily yield (text, line, literals) for each record in src, where line
+    is the line number its text starts on, and literals maps the offset in
+    text of the opening quote of each literal found on the way to the offset
+    after its closing quote, for the lexer to jump over (see
+    Parser.lexLevel). Records of only whitespace are skipped. A stream is
+    read as by bach.io.chunks(), and each character is scanned once.
+
+    This only finds the extent of each record; its syntax isn't checked."""
+
+    if delimiter:
+        pattern = re.compile(r'''[()"'\[]|''' + re.escape(delimiter))
+    else:
+        pattern = re.compile(r'''[()"'\[\n]''')
+
+    continuation = CONTINUATION + shorthands
+    name = re.compile(r'[^%s]*[ \t\r]*' % re.escape(SPECIAL + shorthands))
+    close = {'"': '"', "'": "'", '[': ']'}
+
+    source = chunks(src, bufsize, prefetch)
+    buffer = ''
+
+    start = 0       # offset in buffer of the current record
+    index = None    # offset in buffer to scan from, or None before the header
+    searched = 0    # offset in buffer the header's label line is searched from
+    depth = 0
+    line = 1
+    quote = None    # opening the literal that's open at index, if any
+    opened = None   # offset in the record of its opening quote
+    literals = {}
+
+    def more():
+        # Read another chunk into the buffer, dropping what's before the
+        # current record, or return False at the end of the stream
+        nonlocal buffer, start, index, searched
+        data = next(source, None)
+        if data is None:
+            return False
+        if start:
+            buffer = buffer[start:]
+            if index is not None:
+                index -= start
+            searched = max(searched - start, 0)
+            start = 0
+        buffer += data
+        return True
+
+    while True:
+
+        if index is None:
+            # skip over the comments at the head of the record, once the line
+            # after them (with the label) is complete
+            headerEnd = bach.structural.headerEnd(buffer, start)
+            if buffer.find('\n', max(headerEnd, searched)) == -1:
+                searched = len(buffer)
+                if more():
+                    continue
+            index = headerEnd
+            depth = 0
+
+        if quote is not None:
+            # the rest of a literal, from where the last read left off
+            index = bach.scan.LITERAL_PARTIAL[quote].match(buffer, index).end()
+            if index == len(buffer) or buffer[index] != close[quote]:
+                # not read in full yet (or unterminated, so left for the
+                # parser to reject)
+                if more():
+                    continue
+                break
+            index += 1
+            literals[opened] = index - start
+            quote = None
+
+        m = pattern.search(buffer, index)
+
+        if m is None:
+            if delimiter:
+                # a delimiter may be split across reads
+                index = max(index, len(buffer) - len(delimiter) + 1)
+            if more():
+                continue
+            break
+
+        c = m.group()
+        index = m.end()
+
+        if c == '(':
+            depth += 1
+
+        elif c == ')':
+            depth -= 1
+
+        elif c in close:
+            quote = c
+            opened = m.start() - start
+
+        elif depth == 0:
+            if delimiter:
+                end, nextStart = m.start(), m.end()
+            else:
+                # a newline: does the next line start a new record?
+                if index == len(buffer):
+                    index = m.start()
+                    if more():
+                        continue
+                    break
+                if buffer[index] in continuation:
+                    continue
+                # or an attribute assignment, once enough of it is read to
+                # tell (a name then "=")
+                nameEnd = name.match(buffer, index).end()
+                if nameEnd == len(buffer):
+                    index = m.start()
+                    if more():
+                        continue
+                    index = m.end()
+                elif nameEnd > index and buffer[nameEnd] == '=':
+                    continue
+                end = nextStart = index
+
+            text = buffer[start:end]
+            if text.strip():
+                yield text, line, literals
+            line += buffer.count('\n', start, nextStart)
+            start, index, searched, literals = nextStart, None, nextStart, {}
+
+    text = buffer[start:]
+    if text.strip():
+        yield text, line, literals
@@ -0,0 +1,188 @@
+import bach.scan
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# A structural index of a Bach source text, found ahead of parsing ("stage
+# 1", as in simdjson): the extent of every literal. Parser.parse(src,
+# preindex=True) then jumps the automaton over each literal instead of
+# visiting every character in it ("stage 2").
+#
+# With NumPy, every character is classified at once into masks of quotes,
+# brackets and backslashes. Characters escaped by an odd-length run of
+# backslashes are masked out, and, when the only quotes are "double" quotes,
+# each pair of the rest is a literal (as a prefix-XOR of the mask would
+# mark). Otherwise, the three quote styles are resolved by a pass over just
+# those positions. Without NumPy, or when literals are few or long enough
+# that the regular expression engine is faster, the same index is found with
+# bach.scan (see index()).
+#
+# N.B. offsets are into the str, not its UTF-8 encoding; NumPy classifies
+# the code points of its UTF-32 encoding.
+
+# A line of the comments and blank lines at the head of a document
+HEADER_LINE = re.compile(r'(?:[ \t\r]*|#[^\n]*)\n')
+
+# The contents of a valid literal, between its quotes (unrolled, so that the
+# regular expression engine doesn't keep state for every character)
+LITERAL_BODY = {
+    '"': re.compile(r'[^"\\]*(?:\\["\\][^"\\]*)*'),
+    "'": re.compile(r"[^'\\]*(?:\\['\\][^'\\]*)*"),
+    '[': re.compile(r'[^\]\\]*(?:\\[\]\\][^\]\\]*)*'),
+}
+
+LITERAL_CLOSE = {'"': '"', "'": "'", '[': ']'}
+
+# The opening quote of a literal, outside of literals
+LITERAL_OPEN = re.compile(r'["\'\[]')
+
+ESCAPE = re.compile(r'\\(.)', re.S)
+
+DOUBLE_QUOTE, SINGLE_QUOTE, LEFT_BRACE, RIGHT_BRACE, BACKSLASH = 34, 39, 91, 93, 92
+
+# index() uses NumPy for text with at least this many quotes per character
+NUMPY_DENSITY = 1 / 32
+
+
+
+class StructuralIndex():
+
+    def __init__(self, literals, headerEnd):
+        self.literals  = literals  # dict of offset of opening quote => offset after closing quote
+        self.headerEnd = headerEnd # offset after any header comments
+
+    def __repr__(self):
+        return "<bach.structural.StructuralIndex: %d literals>" % len(self.literals)
+
+
+
+def headerEnd(text, start=0):
+    # The offset after the comments and blank lines at the head of a document
+    # (starting at text[start]), where a "#" is a comment rather than (later
+    # on) a shorthand attribute
+    index = start
+    while True:
+        m = HEADER_LINE.match(text, index)
+        if m is None:
+            return index
+        index = m.end()
+
+
+def index(text, useNumpy=None):
+    """The StructuralIndex of text, with NumPy or with regular expressions.
+    By default, NumPy is used if it's installed and text is mostly short
+    "double" quoted literals, where classifying every character at once pays
+    off, and regular expressions otherwise, which match each literal at once.
+
+    This only finds where literals are, without checking the syntax; an
+    unterminated literal ends the index."""
+
+    if useNumpy is None:
+        useNumpy = numpy is not None and "'" not in text and '[' not in text and \
+            text.count('"') >= len(text) * NUMPY_DENSITY
+
+    if useNumpy:
+        return indexNumpy(text)
+    return indexRegex(text)
+
+
+def indexRegex(text):
+    start = headerEnd(text)
+    literals = {}
+
+    search = LITERAL_OPEN.search
+    index = start
+
+    while True:
+        m = search(text, index)
+        if m is None:
+            break
+
+        index = m.end()
+        m = bach.scan.LITERAL_REMAINDER[m.group()].match(text, index)
+        if m is None:
+            break
+        literals[index - 1] = m.end()
+        index = m.end()
+
+    return StructuralIndex(literals, start)
+
+
+def indexNumpy(text):
+    start = headerEnd(text)
+    codes = numpy.frombuffer(text.encode('utf-32-le'), dtype=numpy.uint32)
+    length = len(codes)
+
+    # escaped: after an odd-length run of backslashes
+    backslash = codes == BACKSLASH
+    positions = numpy.arange(length)
+    lastOther = numpy.maximum.accumulate(numpy.where(backslash, -1, positions))
+    run = positions - lastOther # length of the run of backslashes ending here
+    escaped = numpy.zeros(length, dtype=bool)
+    escaped[1:] = (run[:-1] & 1) == 1
+
+    unescaped = ~escaped
+    unescaped[:start] = False
+
+    doubleQuote = (codes == DOUBLE_QUOTE) & unescaped
+    otherQuote  = ((codes == SINGLE_QUOTE) | (codes == LEFT_BRACE) | (codes == RIGHT_BRACE)) & unescaped
+
+    if not otherQuote.any():
+        # each quote opens a literal or closes the one it opened, and an
+        # unterminated one ends the index
+        quotes = numpy.flatnonzero(doubleQuote)
+        if len(quotes) % 2:
+            quotes = quotes[:-1]
+        literals = dict(zip(quotes[0::2].tolist(), (quotes[1::2] + 1).tolist()))
+        return StructuralIndex(literals, start)
+
+    # otherwise, resolve which quotes open and close literals at just the
+    # candidate positions
+    candidates = numpy.flatnonzero(doubleQuote | otherQuote)
+    characters = codes[candidates]
+    closers = {
+        DOUBLE_QUOTE: candidates[characters == DOUBLE_QUOTE],
+        SINGLE_QUOTE: candidates[characters == SINGLE_QUOTE],
+        LEFT_BRACE:   candidates[characters == RIGHT_BRACE],
+    }
+
+    literals = {}
+    offsets = candidates.tolist()
+    characters = characters.tolist()
+
+    i = 0
+    while i < len(offsets):
+        c, offset = characters[i], offsets[i]
+
+        if c == RIGHT_BRACE:
+            i += 1 # stray, so left for the automaton to reject
+        else:
+            close = closers[c]
+            k = numpy.searchsorted(close, offset, 'right')
+            if k == len(close):
+                break
+            end = int(close[k]) + 1
+            literals[offset] = end
+            i = int(numpy.searchsorted(candidates, end, 'left'))
+
+    return StructuralIndex(literals, start)
+
+
+def literalValue(text, start, end):
+    """The value of the literal text[start:end], quotes included, with its
+    escape sequences resolved, or None if it isn't a valid literal"""
+
+    quote = text[start]
+    if end - start < 2 or text[end - 1] != LITERAL_CLOSE[quote]:
+        return None
+    if LITERAL_BODY[quote].fullmatch(text, start + 1, end - 1) is None:
+        return None
+
+    body = text[start + 1:end - 1]
+    if '\\' in body:
+        body = ESCAPE.sub(r'\1', body)
+    return body
+
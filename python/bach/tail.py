@@ -0,0 +1,243 @@
+import bach.io
+import bach.scan
+import bach.structural
+from bach.bach import CaptureSemantic, ParseError, Parser, Position
+import codecs
+import json
+import os
+import time
+
+# Following a Bach document that grows as it is written to e.g. a log, where
+# each entry is appended as a top-level subdocument of the root:
+#
+#     log
+#     (entry level=info "Started")
+#     (entry level=warn "Low disk space")
+#
+# Only the complete subdocuments read so far are lexed, so a partial entry at
+# the end is left until the rest of it has been written. Between entries, the
+# whole state of the parse is just the byte offset, the automaton stack and
+# the Position, so that is all a checkpoint has to save.
+
+DEFAULT_INTERVAL = 1.0 # seconds
+
+
+
+class Checkpoint():
+    """Where to resume following a file: after `offset` bytes of the file
+    identified by (device, inode), with the automaton `stack` and the
+    Position (line, column) there."""
+
+    def __init__(self, device=None, inode=None, offset=0, stack=None, line=1, column=0):
+        self.device = device
+        self.inode  = inode
+        self.offset = offset
+        self.stack  = [0] if stack is None else stack
+        self.line   = line
+        self.column = column
+
+    @classmethod
+    def load(cls, path):
+        # the Checkpoint saved at path, or a new one if there isn't one yet
+        try:
+            with open(path, 'r') as fp:
+                return cls(**json.load(fp))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, path):
+        # atomically, so a crash leaves either the old or the new checkpoint
+        temp = path + '.tmp'
+        with open(temp, 'w') as fp:
+            json.dump(vars(self), fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp, path)
+
+    def __repr__(self):
+        return "<bach.tail.Checkpoint: offset %d, line %d>" % (self.offset, self.line)
+
+
+
+class Scanner():
+    """The text of a Bach document read a chunk of bytes at a time, and how
+    much of it is complete top-level subdocuments, as for follow() and
+    bach.sidecar. Each chunk is decoded once, by one incremental decoder, and
+    scanned once, from where the last scan stopped.
+
+    With header=True the text is from the start of the document, so its
+    header comments are skipped first, once the line after them is read."""
+
+    def __init__(self, encoding='utf-8', header=True):
+        self.decoder  = codecs.getincrementaldecoder(encoding)()
+        self.text     = ''
+        self.header   = 0 if header else None # where the header's left to skip from
+        self.index    = 0     # in text, that the scan is up to
+        self.depth    = 0     # of the subdocuments open there
+        self.quote    = None  # opening the literal open there, if any
+        self.complete = 0     # in text, after the last complete subdocument
+
+    def feed(self, data, final=False):
+        """Decode more of the document, returning the offset in text after
+        the last complete top-level subdocument (also after a stray ")", so
+        the parser gets to reject it), or, if final, after all of it. A
+        subdocument is only complete once the character after it (its
+        lookahead) has been read too."""
+        self.text += self.decoder.decode(data, final)
+        if final:
+            return len(self.text)
+        self.scan()
+        return self.complete
+
+    def consume(self, end):
+        """Drop text[:end], once it's been lexed"""
+        self.text = self.text[end:]
+        self.index -= end
+        self.complete = max(self.complete - end, 0)
+
+    def scan(self):
+        text = self.text
+
+        if self.header is not None:
+            # a complete line of the header won't change, so isn't rescanned
+            start = bach.structural.headerEnd(text, self.header)
+            if text.find('\n', max(start, self.index)) == -1:
+                self.header = start
+                self.index = len(text) # until the label is complete
+                return
+            self.header = None
+            self.index = start
+
+        search = bach.scan.STRUCTURAL.search
+        index, depth, quote = self.index, self.depth, self.quote
+
+        while True:
+            if quote is not None:
+                index = bach.scan.LITERAL_PARTIAL[quote].match(text, index).end()
+                if index == len(text) or text[index] == '\\':
+                    break # the rest of it isn't read yet
+                index += 1
+                quote = None
+                continue
+
+            m = search(text, index)
+            if m is None:
+                index = len(text)
+                break
+
+            c = m.group()
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                if m.end() == len(text):
+                    index = m.start() # until its lookahead is read
+                    break
+                depth = max(depth - 1, 0)
+                if depth == 0:
+                    self.complete = m.end()
+            else:
+                quote = c
+            index = m.end()
+
+        self.index, self.depth, self.quote = index, depth, quote
+
+
+
+def follow(path, parser=None, checkpoint=None, wait=True, interval=DEFAULT_INTERVAL,
+        bufsize=bach.io.DEFAULT_BUFFER_SIZE, encoding='utf-8'):
+    """Lazily yield each top-level subdocument of the Bach document at path,
+    fully parsed, as it is appended to the file. Anything else at the top level
+    (the root's label, attributes and literals) is checked, but not yielded.
+
+    When there's no complete subdocument left to read, this waits, polling the
+    file every `interval` seconds, or, with wait=False, returns. If the file is
+    replaced (e.g. rotated) or truncated, the new one is followed from the
+    start.
+
+    With checkpoint, the path of a JSON file, following resumes from where it
+    last got to, without reading anything before it. The checkpoint is saved
+    after each read, and when the result is closed, up to the last subdocument
+    that was yielded and then resumed from. So each subdocument is yielded at
+    least once, though it may be yielded again after a crash."""
+
+    if parser is None:
+        parser = Parser()
+
+    at = Checkpoint.load(checkpoint) if checkpoint is not None else Checkpoint()
+    fp = None
+
+    try:
+        while True:
+
+            if fp is None:
+                fp = open(path, 'rb')
+                stat = os.fstat(fp.fileno())
+                if (at.device, at.inode) != (stat.st_dev, stat.st_ino) or stat.st_size < at.offset:
+                    at = Checkpoint(stat.st_dev, stat.st_ino)
+                fp.seek(at.offset)
+                scanner = Scanner(encoding, header=at.stack == [0])
+
+            chunk = fp.read(bufsize)
+            end = scanner.feed(chunk)
+
+            if end:
+                text = scanner.text
+                state = bach.io.stack(list(at.stack))
+                pos = Position(at.line, at.column)
+                offset = at.offset
+                index = 0
+
+                def advance(to):
+                    # the Checkpoint after text[:to]
+                    nonlocal offset, index
+                    offset += len(text[index:to].encode(encoding))
+                    index = to
+                    return Checkpoint(at.device, at.inode, offset, list(state.entries),
+                        pos.line, pos.column)
+
+                last = misplaced = None # each read ends after a subdocument
+                for token in parser.lexLevel(text, 0, end, state, pos):
+                    # as for Parser.dispatch(), which only accepts an
+                    # assignment after an attribute, though the grammar
+                    # accepts one after any token, and rejects it once the
+                    # token after it is lexed
+                    if misplaced is not None:
+                        raise misplaced
+                    if token.semantic is CaptureSemantic.assign and last is not CaptureSemantic.attribute:
+                        misplaced = ParseError("Unexpected %s" % token.semantic, token.start, token.end)
+                        continue
+                    last = token.semantic
+                    if token.semantic is not CaptureSemantic.subdocStart:
+                        continue
+                    i, j = token.span
+                    yield parser.parseSubdocument(text, i, j, token.start)
+                    at = advance(j) # once the consumer is done with it
+
+                at = advance(end)
+                scanner.consume(end)
+
+                if checkpoint is not None:
+                    at.save(checkpoint)
+                continue
+
+            if chunk:
+                continue # maybe the rest of a subdocument
+
+            if not wait:
+                return
+
+            time.sleep(interval)
+
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue # mid-rotation
+            if (stat.st_dev, stat.st_ino) != (at.device, at.inode) or stat.st_size < fp.tell():
+                fp.close()
+                fp = None
+
+    finally:
+        if fp is not None:
+            fp.close()
+        if checkpoint is not None:
+            at.save(checkpoint)
@@ -15,10 +15,20 @@ class CompiledGrammar():
     TERMINAL_SET_DSS_ID  = 3 # disallowed shorthand separators
     TERMINAL_SET_SC_ID   = 8 # special characters
 
+    # Human-readable names, for debugging and profiling only, ordered by ID
+    # -- These MUST match the sections [Production Symbols] and [Terminal Sets]
+    #    in grammar.txt
+    SYMBOL_NAMES = ['S', 'IWS', 'WS', 'LF', 'C', 'LSQ', 'LDQ', 'LBQ', 'LSQESC',
+        'LDQESC', 'LBQESC', 'D', 'LD', 'ALD', 'XSCC', 'SDS', 'SD', 'LSD', 'ALSD',
+        'DSH', 'SDSH', 'RB']
+    TERMINAL_SET_NAMES = ['special:none', 'special:eof', 'ss', '_dss', 'iws',
+        'ws', 'bs', 'lf', 'sc', 'oqt', 'asgn', 'scmt', 'rb', 'lb', 'dq', 'sq',
+        'lbrace', 'rbrace', 'dqesc', 'sqesc', 'rbraceesc']
+
     packed = """
-626163682d6367311614233d20090d0a282922275b5d3c3e5c275c5b5c2215000000001414010f02
+626163682d6367311614233d20090d0a282922275b5d3c3e5c275c5d5c2215000000001414010f02
 0502060e0f05060014080b01020001070806070809090a0a0b0b0c12140e1010120007070209030c
-010d020f0312031503180119011a011b0c27042b012c022e04320c3e044201430245024701040300
+010d020f0312031503180119011a011b0c27042b012c022e04320c3e044201430245004500040300
 ff07000401030087000700ffff80000b04030087000b0300ff070088020bff05e1880e0bff88c104
 ffffff84000401ffff040005ffffff850005ffffff01000502ffff050007ffffff800087ffffff07
 008704ffff87000fffffff80209305ffff8080060805ff80000effffff80209206ffff8080060906
@@ -26,10 +36,10 @@ ff800011ffffff80209407ffff8080060a07ff800013ffffff808012ffffff808014ffffff808005
 0bffff850005ffffff010005020bff050002130bff88e788020bff05e2880e0bff88c2880dffff0a
 e20a0cffff80e40d0f0bff80e50e060bff80430f050bff804310070bff8043050cffff80000e060b
 ff80430f050bff804310070bff80430a0cffff80e488ffffff08a0880effff8880050fffff800088
-0210ff05e1880e10ff88c18810ffff0ce1021410ff88e7880210ff05e2880e10ff88c28810ffff0c
+0210ff05e1880e10ff88c18810ffff0ce1021310ff88e7880210ff05e2880e10ff88c28810ffff0c
 e28812ffff0ae20a11ffff80e40d0f10ff80e50cffffff80e60510ffff80000e0610ff80430f0510
 ff8043100710ff80430511ffff80000e0610ff80430f0510ff8043100710ff80430a11ffff80e488
-ffffff08e8880effff88c888ffffff08e8880effff88c80cffffff8000010b55
+ffffff08e8880effff88c8010b63
 """
 
     def __init__(self):
@@ -150,6 +160,9 @@ ffffff08e8880effff88c888ffffff08e8880effff88c80cffffff8000010b55
         numEndStates = data[index]
         self.endStates = [x for x in data[index+1:index+1+numEndStates]]
 
+        assert len(self.SYMBOL_NAMES) == self.numStates
+        assert len(self.TERMINAL_SET_NAMES) == self.numTerminalSets
+
 
 
 class CompiledProduction():
@@ -14,6 +14,13 @@ E.g.
     >>>> <?xml version='1.0' encoding='utf-8'?>
     >>>> <document class="className"/>
 
+The input may be compressed with gzip, xz or bzip2 (see bach.compressed) e.g.
+    cat input.bach.gz | python3 bach2xml.py > output.xml
+
+Reading the input ahead of parsing it, up to 4 buffers at a time, e.g. from a
+slow pipe:
+    curl -s https://example.com/input.bach | python3 bach2xml.py --prefetch 4 > output.xml
+
 Example configuring input and output encodings (either are optional; defaults to utf-8)
     cat input.bach | python3 bach2xml.py -i "Latin-1" -o "utf-8" > output.xml
     cat input.bach | python3 bach2xml.py --input-encoding "Latin-1" --output-encoding "utf-8" > output.xml
@@ -21,7 +28,7 @@ Example configuring input and output encodings (either are optional; defaults to
 
 import argparse
 import bach
-import io
+import bach.compressed
 import sys
 from lxml import etree as ET
 
@@ -35,6 +42,8 @@ ap.add_argument('-o', '--output-encoding',  default='utf-8',
     help='specify the output character encoding (defaults to utf-8, must be utf-8 or utf-16)')
 ap.add_argument('-s', '--shorthand', nargs="+", default=[],
     help='add shorthand attribute mappings e.g. --shorthand ".class" "#id" "?flag"')
+ap.add_argument('--prefetch', type=int, default=0, metavar='N',
+    help='read up to N buffers of input ahead on a helper thread, e.g. from a slow pipe (defaults to 0, reading as needed)')
 
 args = ap.parse_args()
 assert args.output_encoding.upper() in ['UTF-8', 'UTF-16']
@@ -51,10 +60,11 @@ for i in args.shorthand:
 parser = bach.Parser(shorthand)
 
 # Get the standard input binary buffer and wrap it in a file-object so that it
-# decodes into a stream of Unicode characters from the specified encoding.
-fp = io.TextIOWrapper(sys.stdin.buffer, encoding=args.input_encoding)
+# decodes into a stream of Unicode characters from the specified encoding,
+# decompressing it on a helper thread first if it's compressed.
+fp = bach.compressed.textStream(sys.stdin.buffer, encoding=args.input_encoding)
 
-document = parser.parse(fp)
+document = parser.parse(fp, prefetch=args.prefetch)
 tree = document.toElementTree(ET)
 xml = ET.tostring(tree, encoding=args.output_encoding, pretty_print=True, xml_declaration=True)
 
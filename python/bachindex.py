@@ -0,0 +1,86 @@
+"""
+Builds a sidecar index of the top-level subdocuments ("records") of a Bach
+file e.g. file.bach.idx for file.bach, and prints records by number or label
+by seeking straight to them (see bach.sidecar).
+
+Example Usage:
+    python3 bachindex.py file.bach                  # (re)build file.bach.idx
+    python3 bachindex.py file.bach -n 41 -1         # print records 41 and the last
+    python3 bachindex.py file.bach -l entry         # print every "entry" record
+    python3 bachindex.py file.bach --list           # print the label of each record
+    python3 bachindex.py file.bach --verify -n 0    # check the checksum first
+
+Records are printed as their source text, one per line, unless --check is
+given, in which case each is parsed, and nothing is printed unless there's an
+error.
+"""
+
+import argparse
+import bach
+import bach.sidecar
+import sys
+
+
+
+ap = argparse.ArgumentParser(
+    description='Builds a sidecar index of the records of a Bach file, or reads records with it')
+ap.add_argument('file',
+    help='the Bach file')
+ap.add_argument('-x', '--index',
+    help='the index file (defaults to the Bach file name + ".idx")')
+ap.add_argument('-n', '--number', type=int, nargs='+', default=[],
+    help='print the records with these numbers (counting from 0, or from -1 for the last)')
+ap.add_argument('-l', '--label', nargs='+', default=[],
+    help='print the records with these labels')
+ap.add_argument('--list', action='store_true',
+    help='print the number and label of every record')
+ap.add_argument('--check', action='store_true',
+    help='parse each record selected instead of printing it')
+ap.add_argument('--verify', action='store_true',
+    help='compare the checksum of the whole file to the index before reading it')
+ap.add_argument('--quick', action='store_true',
+    help='when building, only check the syntax outside records')
+ap.add_argument('-i', '--input-encoding', default='utf-8',
+    help='specify the input character encoding (defaults to utf-8)')
+ap.add_argument('-s', '--shorthand', nargs="+", default=[],
+    help='add shorthand attribute mappings e.g. --shorthand ".class" "#id" "?flag"')
+
+args = ap.parse_args()
+
+shorthand = {}
+
+for i in args.shorthand:
+    assert len(i) >= 2, "Shorthand attribute mapping option must contain at least one symbol and at least one character"
+    symbol, expansion = i[0], i[1:]
+    assert not symbol in shorthand, "Shorthand attribute symbol already configured"
+    shorthand[symbol] = expansion
+
+parser = bach.Parser(shorthand)
+indexPath = args.file + '.idx' if args.index is None else args.index
+
+try:
+    if not (args.number or args.label or args.list):
+        index = bach.sidecar.create(args.file, indexPath, parser, check=not args.quick,
+            encoding=args.input_encoding)
+        print("%s: %d records, %d labels" % (indexPath, len(index), len(index.labelNames)))
+        sys.exit(0)
+
+    with bach.sidecar.IndexedFile(args.file, indexPath, parser, args.verify, args.input_encoding) as f:
+
+        if args.list:
+            for n, label in enumerate(f.index.labels):
+                print(n, label)
+
+        numbers = list(args.number)
+        for label in args.label:
+            numbers.extend(f.index.find(label))
+
+        for n in numbers:
+            if args.check:
+                f.record(n)
+            else:
+                print(f.sourceText(n))
+
+except (bach.ParseError, ValueError, IndexError, OSError) as e:
+    print(e, file=sys.stderr)
+    sys.exit(1)
@@ -0,0 +1,235 @@
+
+"""
+Benchmarks each stage of the Bach parser against seeded synthetic documents
+and optionally compares the results with a stored JSON baseline.
+
+Example Usage (from the python directory):
+    python3 -m benchmarks
+    python3 -m benchmarks --size 500000 --shape deep --shape literal
+    python3 -m benchmarks --save baseline.json
+    python3 -m benchmarks --compare baseline.json --threshold 0.10
+
+With --compare, exits with a non-zero status if any stage is slower than the
+baseline by more than the threshold (a fraction, e.g. 0.10 for 10%).
+"""
+
+import argparse
+import bach
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from benchmarks.generate import SHAPES
+
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+    lxml = False
+else:
+    lxml = True
+
+
+BACH2XML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bach2xml.py')
+
+
+# Each stage is a function of (parser, src) => a callable that runs the stage
+# once. Anything that isn't part of the stage (e.g. parsing the document for
+# toElementTree) is done up front, outside of the timed callable.
+
+def stageReader(parser, src):
+    def run():
+        for c in bach.io.reader(src, bach.io.DEFAULT_BUFFER_SIZE)():
+            pass
+    return run
+
+def stagePairwise(parser, src):
+    def run():
+        for c in bach.io.pairwise(bach.io.reader(src, bach.io.DEFAULT_BUFFER_SIZE)()):
+            pass
+    return run
+
+def stageValidate(parser, src):
+    def run():
+        assert parser.validate(src) is None
+    return run
+
+def stageLex(parser, src):
+    def run():
+        for token in parser.lex(bach.io.reader(src, bach.io.DEFAULT_BUFFER_SIZE)()):
+            pass
+    return run
+
+def stageParse(parser, src):
+    def run():
+        parser.parse(src)
+    return run
+
+def stagePipelined(parser, src):
+    # lexing on a helper thread, whether or not Python is free-threaded, to
+    # show the speed-up (or, with the GIL, the overhead) of parse(threads=True)
+    def run():
+        parser.build(bach.pipeline.threaded(parser.lex(src)), bach.Document())
+    return run
+
+def stageElementTree(parser, src):
+    document = parser.parse(src)
+    def run():
+        document.toElementTree(ET)
+    return run
+
+def stageBach2xml(parser, src):
+    data = src.encode('utf-8')
+    args = [sys.executable, BACH2XML]
+    if parser.shorthands:
+        args.append('--shorthand')
+        args.extend(k + v for k, v in parser.shorthands.items())
+    def run():
+        subprocess.run(args, input=data, stdout=subprocess.DEVNULL, check=True)
+    return run
+
+
+STAGES = [
+    ('reader',        stageReader),
+    ('pairwise',      stagePairwise),
+    ('validate',      stageValidate),
+    ('lex',           stageLex),
+    ('parse',         stageParse),
+    ('pipelined',     stagePipelined),
+    ('toElementTree', stageElementTree),
+    ('bach2xml',      stageBach2xml), # end to end, includes interpreter startup
+]
+
+
+def best(run, repeat):
+    # Best of `repeat` wall-clock timings, in seconds
+    results = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        run()
+        results.append(time.perf_counter() - start)
+    return min(results)
+
+
+def peak(run):
+    # Peak memory allocated by Python during one run, in bytes
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(shapes, stages, size, seed, repeat):
+    results = {}
+
+    for name in shapes:
+        generator, shorthands = SHAPES[name]
+        src = generator(random.Random(seed), size)
+        parser = bach.Parser(shorthands)
+
+        numBytes = len(src.encode('utf-8'))
+        numTokens = sum(1 for token in parser.lex(src))
+
+        results[name] = {}
+        for stage, setup in STAGES:
+            if stage not in stages: continue
+            if stage == 'bach2xml' and not lxml: continue
+
+            run = setup(parser, src)
+            seconds = best(run, repeat)
+            results[name][stage] = {
+                'seconds':      seconds,
+                'mb_per_s':     numBytes / seconds / (1024 * 1024),
+                'tokens_per_s': numTokens / seconds,
+                # memory of a subprocess isn't visible to tracemalloc
+                'peak_bytes':   None if stage == 'bach2xml' else peak(run),
+            }
+
+            report(name, stage, results[name][stage])
+
+    return results
+
+
+def report(shape, stage, r):
+    peakBytes = '-' if r['peak_bytes'] is None else "%.1f MB" % (r['peak_bytes'] / (1024 * 1024))
+    print("%-12s %-14s %9.4fs %9.3f MB/s %12.0f tokens/s %10s peak" % \
+        (shape, stage, r['seconds'], r['mb_per_s'], r['tokens_per_s'], peakBytes))
+
+
+def compare(results, baseline, threshold):
+    # Returns a list of (shape, stage, ratio) for each stage slower than the
+    # baseline by more than threshold
+
+    regressions = []
+
+    for shape in results:
+        for stage in results[shape]:
+            try:
+                before = baseline['results'][shape][stage]['seconds']
+            except KeyError:
+                continue
+            ratio = results[shape][stage]['seconds'] / before
+            status = 'REGRESSION' if ratio > 1.0 + threshold else 'ok'
+            print("%-12s %-14s %6.2fx baseline %s" % (shape, stage, ratio, status))
+            if status != 'ok':
+                regressions.append((shape, stage, ratio))
+
+    return regressions
+
+
+ap = argparse.ArgumentParser(
+    description='Benchmarks the Bach parser against synthetic documents')
+ap.add_argument('--shape', action='append', choices=sorted(SHAPES),
+    help='document shape to benchmark (may be repeated; defaults to all)')
+ap.add_argument('--stage', action='append', choices=[x for x, _ in STAGES],
+    help='stage to benchmark (may be repeated; defaults to all)')
+ap.add_argument('--size', type=int, default=100000,
+    help='approximate size of each generated document, in characters')
+ap.add_argument('--seed', type=int, default=1,
+    help='seed for the document generators')
+ap.add_argument('--repeat', type=int, default=3,
+    help='time each stage this many times and keep the best')
+ap.add_argument('--save', metavar='FILE',
+    help='write the results to FILE as a JSON baseline')
+ap.add_argument('--compare', metavar='FILE',
+    help='compare the results with the JSON baseline in FILE')
+ap.add_argument('--threshold', type=float, default=0.10,
+    help='allowed slowdown relative to the baseline (defaults to 0.10)')
+
+args = ap.parse_args()
+
+if not lxml:
+    print("# lxml not found: toElementTree uses xml.etree, bach2xml is skipped", file=sys.stderr)
+
+results = benchmark(
+    args.shape or sorted(SHAPES),
+    args.stage or [x for x, _ in STAGES],
+    args.size, args.seed, args.repeat)
+
+if args.save:
+    with open(args.save, 'w') as f:
+        json.dump({
+            'python':  platform.python_version(),
+            'machine': platform.machine(),
+            'size':    args.size,
+            'seed':    args.seed,
+            'results': results,
+        }, f, indent=4, sort_keys=True)
+
+if args.compare:
+    with open(args.compare, 'r') as f:
+        baseline = json.load(f)
+
+    if (baseline['size'], baseline['seed']) != (args.size, args.seed):
+        print("# warning: baseline used --size %d --seed %d" % \
+            (baseline['size'], baseline['seed']), file=sys.stderr)
+
+    if compare(results, baseline, args.threshold):
+        sys.exit(1)
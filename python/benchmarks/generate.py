@@ -0,0 +1,126 @@
+
+# Seeded generators of synthetic Bach documents for stress-testing the parser
+
+# Each generator takes a random.Random instance and an approximate size in
+# characters and returns a str holding a complete Bach document. The same seed
+# and size always produce the same document.
+
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing",
+    "elit", "proin", "laoreet", "velit", "non", "nisl", "rhoncus", "auctor"]
+
+# A mix of 2-, 3- and 4-byte UTF-8 characters
+UNICODE = "£¹²³äöüßéèçñøåæœ€αβγδεζηθλμπσωЖЗИЙКЛМНОПあいうえおかきくけこ中文字漢字🎵🎶🐘"
+
+SHORTHANDS = {'.': 'class', '#': 'id'}
+
+
+def words(rng, n, alphabet=WORDS):
+    return ' '.join(rng.choice(alphabet) for i in range(n))
+
+
+def quote(text):
+    # Quote text as a "double"-quoted literal
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def deep(rng, size, depth=200):
+    # Chains of subdocuments nested `depth` levels deep
+    chain = []
+    for i in range(depth):
+        chain.append("(n%d " % (i % 10))
+    chain.append(quote(words(rng, 3)))
+    chain.append(")" * depth)
+    chain = ''.join(chain)
+
+    result = ["deep\n"]
+    total = 0
+    while total < size:
+        result.append(chain)
+        result.append("\n")
+        total += len(chain) + 1
+    return ''.join(result)
+
+
+def wide(rng, size):
+    # A single subdocument with a very large number of small children
+    result = ["wide\n(list\n"]
+    total = 0
+    while total < size:
+        child = "  (item %s)\n" % quote(rng.choice(WORDS))
+        result.append(child)
+        total += len(child)
+    result.append(")\n")
+    return ''.join(result)
+
+
+def literal(rng, size):
+    # One huge literal, with the occasional escape sequence
+    result = ["literal\n\""]
+    total = 0
+    while total < size:
+        chunk = words(rng, 16) + (' \\" ' if rng.random() < 0.1 else ' ')
+        result.append(chunk)
+        total += len(chunk)
+    result.append("\"\n")
+    return ''.join(result)
+
+
+def attributes(rng, size, perNode=32):
+    # Subdocuments carrying many attributes each, some repeated
+    result = ["attributes\n"]
+    total = 0
+    while total < size:
+        node = ["(node"]
+        for i in range(perNode):
+            name = "a%d" % rng.randrange(perNode)
+            if rng.random() < 0.2:
+                node.append(" %s" % name)
+            else:
+                node.append(" %s=%s" % (name, quote(rng.choice(WORDS))))
+        node.append(")\n")
+        node = ''.join(node)
+        result.append(node)
+        total += len(node)
+    return ''.join(result)
+
+
+def shorthand(rng, size):
+    # Subdocuments dense with .class and #id shorthand attributes
+    # (parse with the SHORTHANDS mapping)
+    result = ["shorthand .root #top\n"]
+    total = 0
+    while total < size:
+        node = ["(div"]
+        for i in range(rng.randrange(2, 8)):
+            node.append(" %s%s" % (rng.choice('.#'), rng.choice(WORDS)))
+        node.append(" (span.%s %s))\n" % (rng.choice(WORDS), quote(words(rng, 2))))
+        node = ''.join(node)
+        result.append(node)
+        total += len(node)
+    return ''.join(result)
+
+
+def unicode(rng, size):
+    # Labels, attributes and literals made mostly of non-ASCII characters
+    alphabet = list(UNICODE)
+    result = ["документ\n"]
+    total = 0
+    while total < size:
+        label = ''.join(rng.choice(alphabet[:40]) for i in range(6))
+        text = ''.join(rng.choice(alphabet) for i in range(48))
+        node = "(%s значение=%s %s)\n" % (label, quote(text[:8]), quote(text))
+        result.append(node)
+        total += len(node)
+    return ''.join(result)
+
+
+# name => (generator, parser shorthands)
+SHAPES = {
+    'deep':       (deep,       {}),
+    'wide':       (wide,       {}),
+    'literal':    (literal,    {}),
+    'attributes': (attributes, {}),
+    'shorthand':  (shorthand,  SHORTHANDS),
+    'unicode':    (unicode,    {}),
+}
@@ -1,17 +1,36 @@
 """
-Parses a Bach document from stdin - does nothing if there's no error
+Parses a Bach document from stdin - does nothing if there's no error. The
+document may be compressed with gzip, xz or bzip2.
+
+Example Usage:
+    cat input.bach | python3 check.py
+    curl -s https://example.com/input.bach | python3 check.py --prefetch 4
 """
 
-import io
+import argparse
 import sys
 import bach
+import bach.compressed
+
+
+
+ap = argparse.ArgumentParser(
+    description='Checks that the bach document on stdin is valid, printing the error if not')
+ap.add_argument('--prefetch', type=int, default=0, metavar='N',
+    help='read up to N buffers of input ahead on a helper thread, e.g. from a slow pipe (defaults to 0, reading as needed)')
+
+args = ap.parse_args()
 
 # Get the standard input binary buffer and wrap it in a file-object so that it
 # decodes into a stream of Unicode characters from the specified encoding. We
 # do this without Python translating any linebreaks (omit the newline argument
-# if you like the default behaviour; the parser can cope with either).
-fp = io.TextIOWrapper(sys.stdin.buffer, encoding=sys.stdin.encoding)
-
-tree = bach.Parser().parse(fp)
+# if you like the default behaviour; the parser can cope with either). If it's
+# compressed, it's decompressed on a helper thread as it's read.
+fp = bach.compressed.textStream(sys.stdin.buffer, encoding=sys.stdin.encoding)
 
+# Only the syntax is checked, so there is no need to build a document tree
+error = bach.Parser().validate(fp, prefetch=args.prefetch)
 
+if error is not None:
+    print(error, file=sys.stderr)
+    sys.exit(1)
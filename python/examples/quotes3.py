@@ -0,0 +1,67 @@
+# Example of parsing a Bach document and querying it natively, without
+# converting it to an XML tree first (compare with quotes2.py)
+
+# with thanks to AdrianKoshka for the example documents
+
+
+import bach
+import random
+from collections import namedtuple
+
+
+Quote = namedtuple('Quote', ['text', 'author', 'date'])
+
+structured_quotes = '''
+
+list
+
+(quote
+  (author "Franklin Delano Roosevelt")
+  (date "1933-03-04")
+  (text "Only Thing We Have to Fear Is Fear Itself.")
+)
+
+(quote
+  (author "George W. Bush")
+  (date "2004-04-13")
+  (text "I believe that freedom is the deepest need of every human soul.")
+)
+
+(quote lang="de"
+  (author "Gerhard Schröder")
+  (date "1999-03-24")
+  (text "We don't wage war, but we are called upon to impose a peaceful solution.")
+)
+'''
+
+
+parser = bach.Parser()
+document = parser.parse(structured_quotes)
+
+# An index is built lazily, once, and makes repeated lookups cheap
+index = bach.query.Index(document)
+
+def field(quote, label):
+    # first child of quote with the given label, e.g. (author "...")
+    return next(quote.iter(label)).children[0]
+
+quotes = []
+
+for quote in index.label('quote'):
+    quotes.append(Quote(
+        text=field(quote, 'text'),
+        author=field(quote, 'author'),
+        date=field(quote, 'date')))
+
+
+print("\nRandomly selected quote")
+quote = random.choice(quotes)
+print("%s\nBy %s on %s" % (quote.text, quote.author, quote.date))
+
+print("\nQuotes in German")
+for quote in index.attribute('lang', 'de'):
+    print("%s\nBy %s" % (field(quote, 'text'), field(quote, 'author')))
+
+print("\nThe parent of every author")
+for author in index.label('author'):
+    print(index.parent(author).label, '>', author.label)
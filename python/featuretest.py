@@ -0,0 +1,1026 @@
+"""
+Behaviour tests of the parse modes and the tools built on bach.Parser. Where
+a feature has a plain-parse equivalent, its results are compared with a plain
+parse of the same documents, both valid and invalid.
+
+Example Usage (from the python directory):
+    python3 ./featuretest.py
+    python3 ./featuretest.py validate lazy    # only tests with these in their names
+"""
+
+import argparse
+import bach
+import glob
+import random
+import sys
+import time
+import traceback
+
+from benchmarks.generate import SHAPES
+
+
+
+SHORTHANDS = {'.': 'class', '#': 'id'}
+
+# Documents to parse with SHORTHANDS: the test data, some edge cases, and a
+# few of each shape of synthetic document
+VALID = [open(x, encoding='utf-8').read() for x in sorted(glob.glob('testdata/valid/*.input.bach'))] + [
+    'doc\n',
+    '# comment\n\ndoc a b="c"\n',
+    'doc a ="x" .c #i b\n',
+    'doc (a) (b (c "x") [y]) \'z\'\n',
+    'doc\n(sec (p "one") (p "two"))\n',
+    'doc "a \\" \\\\ b" [c \\] d] \'e \\\' f\'\n',
+    'doc (a)\n',
+]
+
+for shape in sorted(SHAPES):
+    generator, _ = SHAPES[shape]
+    for seed in range(3):
+        VALID.append(generator(random.Random(seed), 2000))
+
+INVALID = [
+    '',
+    'doc',
+    'doc .a="x"\n',
+    'doc (s .b="y")\n',
+    'doc ="x"\n',
+    'doc "l" ="x"\n',
+    'doc (s) ="x"\n',
+    'doc\n"x"',
+    'doc (a "x")',
+    'doc [x\\]',
+    'doc (a\n',
+    'doc )\n',
+    'doc (a))\n',
+    'doc "unterminated\n',
+    'doc a=\n',
+    'doc (a b=)\n',
+    'doc a=(b)\n',
+    # a misplaced assignment, and then an error in the token after it
+    'doc =b (x "y")',
+    'doc "x" ="y',
+]
+
+
+
+TESTS = []
+
+def test(function):
+    TESTS.append(function)
+    return function
+
+
+def outcome(function, *args, **kwargs):
+    # ('ok', result) or ('error', reason of the ParseError raised)
+    try:
+        return ('ok', function(*args, **kwargs))
+    except bach.ParseError as e:
+        return ('error', e.reason)
+
+
+def sameOutcome(a, b):
+    # outcomes of parses that are both the same tree, or both the same error
+    if a[0] != b[0]:
+        return False
+    if a[0] == 'error':
+        return a[1] == b[1]
+    return a[1].equals(b[1])
+
+
+def documents(document):
+    # every Document in a tree, in document order, found recursively as a
+    # reference for bach.query
+    result = [document]
+    for child in document.children:
+        if not isinstance(child, str):
+            result.extend(documents(child))
+    return result
+
+
+def checkModes(mode, sources=VALID + INVALID, parser=None):
+    # mode(parser, src) gives the same outcome as parser.parse(src) for each
+    # of sources
+    if parser is None:
+        parser = bach.Parser(SHORTHANDS)
+    for src in sources:
+        expected = outcome(parser.parse, src)
+        actual = outcome(mode, parser, src)
+        assert sameOutcome(actual, expected), \
+            "%r: got %r, expected %r" % (src[:60], actual, expected)
+
+
+
+@test
+def validate():
+    import subprocess
+
+    def error(function, *args):
+        try:
+            function(*args)
+        except bach.ParseError as e:
+            return str(e)
+
+    # the same error as parse(), with the same position, from validate(),
+    # tokenizeColumns() and check.py
+    parser = bach.Parser(SHORTHANDS)
+    for src in VALID + INVALID:
+        expected = error(parser.parse, src)
+        actual = parser.validate(src)
+        assert (actual if actual is None else str(actual)) == expected, \
+            "%r: got %s, expected %s" % (src[:60], actual, expected)
+        assert error(lambda src: list(parser.tokenizeColumns(src)), src) == expected, src[:60]
+
+    for src in INVALID[-2:]:
+        result = subprocess.run([sys.executable, 'check.py'], input=src.encode('utf-8'), capture_output=True)
+        assert result.stderr.decode('utf-8').strip() == error(bach.Parser().parse, src), src
+
+
+@test
+def query():
+    import bach.query
+    parser = bach.Parser(SHORTHANDS)
+
+    for src in VALID:
+        root = parser.parse(src)
+        everything = documents(root)
+        index = bach.query.Index(root)
+
+        assert list(root.walk()) == everything
+        parents = dict((id(d), p) for p in everything for d in p.children if not isinstance(d, str))
+        assert all(p is parents.get(id(d)) for d, p in bach.query.walkWithParents(root))
+
+        for label in set(d.label for d in everything):
+            expected = [d for d in everything if d.label == label]
+            assert list(root.iter(label)) == expected
+            assert index.label(label) == expected
+
+        for d in everything:
+            assert index.parent(d) is parents.get(id(d))
+            for name, value in d.attributes.items():
+                assert index.attribute(name) == [x for x in everything if name in x.attributes]
+                assert index.attribute(name, value) == [x for x in everything if x.attributes.get(name) == value]
+                for word in value.split():
+                    assert index.word(name, word) == \
+                        [x for x in everything if word in x.attributes.get(name, '').split()]
+
+    # without recursion
+    depth = 20000
+    root = parser.parse('doc ' + '(a ' * depth + ')' * depth + '\n')
+    assert len(list(root.walk())) == depth + 1
+    leaf = list(root.walk())[-1]
+    assert len(list(bach.query.Index(root).ancestors(leaf))) == depth
+
+
+SELECTORS = '''html
+(body
+    (sec .intro #s1 (pp "a") (pp "b") (x) (pp .note "c"))
+    (sec lang="en-GB" (pp "d") (div (pp "e"))))
+'''
+
+def names(documents):
+    # e.g. ["pp:a", "sec"], for comparing selections
+    return ['%s:%s' % (d.label, d.children[0]) if d.children and isinstance(d.children[0], str) \
+        else d.label for d in documents]
+
+
+@test
+def css():
+    import bach.css
+    import bach.query
+    root = bach.Parser(SHORTHANDS).parse(SELECTORS)
+    index = bach.query.Index(root)
+
+    expected = {
+        'pp':               ['pp:a', 'pp:b', 'pp:c', 'pp:d', 'pp:e'],
+        'sec > pp':         ['pp:a', 'pp:b', 'pp:c', 'pp:d'],
+        'sec pp':           ['pp:a', 'pp:b', 'pp:c', 'pp:d', 'pp:e'],
+        'body > * > pp':    ['pp:a', 'pp:b', 'pp:c', 'pp:d'],
+        'pp + pp':          ['pp:b'],
+        'pp ~ pp':          ['pp:b', 'pp:c'],
+        'sec > pp + pp':    ['pp:b'],
+        'x + pp':           ['pp:c'],
+        'x ~ pp, div pp':   ['pp:c', 'pp:e'],
+        '.note':            ['pp:c'],
+        '#s1 > .note':      ['pp:c'],
+        'sec.intro#s1':     ['sec'],
+        '[lang]':           ['sec'],
+        '[lang|=en]':       ['sec'],
+        '[lang^=en]':       ['sec'],
+        '[lang$="GB"]':     ['sec'],
+        '[lang*=n-G]':      ['sec'],
+        '[lang=en]':        [],
+        '[class~=note]':    ['pp:c'],
+        'pp, sec > pp':     ['pp:a', 'pp:b', 'pp:c', 'pp:d', 'pp:e'],
+        'html > sec':       [],
+        '*':                ['html', 'body', 'sec', 'pp:a', 'pp:b', 'x', 'pp:c', 'sec', 'pp:d', 'div', 'pp:e'],
+    }
+
+    for selector, result in expected.items():
+        assert names(bach.select(root, selector)) == result, selector
+        assert names(bach.select(root, selector, index)) == result, selector
+
+    # an index only changes how candidates are found
+    for src in VALID[:12]:
+        root = bach.Parser(SHORTHANDS).parse(src)
+        index = bach.query.Index(root)
+        for selector in ('*', 'n1 > n2', 'a ~ b', 'x + y', '.a', '#b', '[x]', 'p, q a'):
+            assert bach.select(root, selector) == bach.select(root, selector, index)
+
+    for selector in ('', 'a >', '[a', '[a=b', 'a..b', 'a,', '[a b]', '"a"'):
+        try:
+            bach.css.compile(selector)
+        except bach.css.SelectorError:
+            continue
+        raise AssertionError("%r compiled" % selector)
+
+
+
+@test
+def extract():
+    import bach.path
+    parser = bach.Parser(SHORTHANDS)
+
+    # the whole tree matches "*", so it's built in full
+    checkModes(lambda parser, src: list(parser.extract(src, ['*']))[0][1])
+
+    expected = {
+        'html/body/sec/pp':                         ['pp:a', 'pp:b', 'pp:c', 'pp:d'],
+        '/html/body/*/pp':                          ['pp:a', 'pp:b', 'pp:c', 'pp:d'],
+        'html/body/sec[@lang]/pp':                  ['pp:d'],
+        'html/body/sec[@lang="en-GB"]/div/pp':      ['pp:e'],
+        "html/body/sec[@class='intro'][@id]/pp":    ['pp:a', 'pp:b', 'pp:c'],
+        'html/body/sec[@lang="fr"]/pp':             [],
+        'html/body/sec/pp[@class]':                 ['pp:c'],
+        'html/*':                                   ['body'],
+    }
+    for path, result in expected.items():
+        matches = list(parser.extract(SELECTORS, [path]))
+        assert all(p == path for p, _ in matches)
+        assert names(x for _, x in matches) == result, path
+
+    texts = parser.extract(SELECTORS, ['html/body/sec/pp/text()', 'html/body/sec/div/pp/text()'])
+    assert sorted(x for _, x in texts) == ['a', 'b', 'c', 'd', 'e']
+
+    for path in ('', 'a//b', 'text()', 'a/text()/b', 'a[b]', 'a[@b=c]', 'a[@b]x'):
+        try:
+            bach.path.compile(path)
+        except bach.path.PathError:
+            continue
+        raise AssertionError("%r compiled" % path)
+
+
+def materialize(document):
+    for d in document.walk(): pass
+    return document
+
+
+@test
+def lazy():
+    checkModes(lambda parser, src: materialize(parser.parse(src, lazy=True)))
+
+    # only the top level is lexed up front, so an error in a subdocument is
+    # raised when it's first accessed
+    parser = bach.Parser(SHORTHANDS)
+    root = parser.parse('doc (a "x") (b (c b=)) "y"\n', lazy=True)
+    a, b, _ = root.children
+    assert isinstance(a, bach.bach.LazyDocument) and a._children is None
+    assert (a.label, b.label) == ('a', 'b')
+    assert a.children == ['x'] and b._children is None
+    c, = b.children
+    assert outcome(lambda: c.children) == ('error', 'Unexpected input 0x29, 0x29 in state 17')
+
+    # and that of the top level is raised up front
+    for src in ('doc (a "x")', 'doc (a\n', 'doc (a "x"\n', 'doc (a) b=\n'):
+        assert outcome(parser.parse, src, lazy=True) == outcome(parser.parse, src), src
+
+
+def project(document, keep):
+    # the reference for parse(src, keep=keep): (a copy of document with only
+    # the subdocuments with a kept label and those leading to them, True if
+    # there are any)
+    if document.label in keep:
+        return document, True
+    result = bach.Document()
+    result.setLabel(document.label)
+    result.splitAttributes = document.splitAttributes
+    found = False
+    for child in document.children:
+        if isinstance(child, str):
+            result.addChild(child)
+            continue
+        child, kept = project(child, keep)
+        if kept:
+            result.addChild(child)
+            found = True
+    return result, found
+
+
+@test
+def keep():
+    parser = bach.Parser(SHORTHANDS)
+
+    for src in VALID:
+        root = parser.parse(src)
+        labels = sorted(set(d.label for d in root.walk()))
+        for keep in [set(), set(labels[:1]), set(labels[1::2]), {root.label}]:
+            assert parser.parse(src, keep=keep).equals(project(root, keep)[0]), (src[:60], keep)
+
+    # kept subdocuments are checked in full
+    checkModes(lambda parser, src: parser.parse(src, keep={'a', 's'}), INVALID)
+
+    # others are only matched up by parentheses
+    root = parser.parse('doc (x b=) (y (p "z"))\n', keep={'p'})
+    assert names(root.walk()) == ['doc', 'y', 'p:z']
+
+
+@test
+def spans():
+    checkModes(lambda parser, src: parser.parse(src, spans=True))
+
+    # the source of each subtree and literal parses back to the same
+    parser = bach.Parser(SHORTHANDS)
+    for src in VALID:
+        root = parser.parse(src, spans=True)
+        assert root.sourceText() == src
+        for d in root.walk():
+            if d is not root:
+                assert parser.parse('x ' + d.sourceText() + '\n').children[0].equals(d)
+            for child in d.children:
+                if isinstance(child, str):
+                    assert isinstance(child, bach.Literal)
+                    assert parser.parse('x ' + child.sourceText() + '\n').children == [child]
+
+
+def same(a, b):
+    # structural equality, found recursively as a reference for bach.compare
+    if isinstance(a, str) or isinstance(b, str):
+        return isinstance(a, str) and isinstance(b, str) and a == b
+    return a.label == b.label and a.attributes == b.attributes and \
+        len(a.children) == len(b.children) and all(map(same, a.children, b.children))
+
+
+@test
+def compare():
+    import bach.compare
+    parser = bach.Parser(SHORTHANDS)
+    trees = [parser.parse(src) for src in VALID]
+
+    for i, a in enumerate(trees):
+        assert a.equals(parser.parse(VALID[i]))
+        assert a.structuralHash() == parser.parse(VALID[i]).structuralHash()
+        assert list(bach.compare.diff(a, parser.parse(VALID[i]))) == []
+        for b in trees[i + 1:]:
+            assert a.equals(b) == same(a, b)
+
+    assert parser.parse('doc a="1" b="2"\n').equals(parser.parse('doc  b="2"\n\ta="1"\n'))
+    assert not parser.parse('doc "x" (a)\n').equals(parser.parse('doc (a) "x"\n'))
+
+    a = parser.parse('doc (p "one") (p "two") (q x="1" "z")\n')
+    b = parser.parse('doc (p "one") (r) (p "two") (q x="2" "y")\n')
+    differences = [(path, getattr(old, 'label', old), getattr(new, 'label', new)) \
+        for path, old, new in bach.compare.diff(a, b)]
+    assert differences == [((1,), None, 'r'), ((2,), 'q', 'q'), ((2, 0), 'z', 'y')], differences
+    assert [x[0] for x in bach.compare.diff(b, a)] == [(1,), (3,), (3, 0)]
+
+    # a tree changed after it's compared is compared as it is now
+    a = parser.parse('doc (p "one") (q x="1")\n')
+    b = parser.parse('doc (p "one") (q x="1")\n')
+    assert a.equals(b) and a.structuralHash() == b.structuralHash()
+    b.children[0].addChild('two')
+    assert not a.equals(b) and a.structuralHash() != b.structuralHash()
+    assert [x[0] for x in bach.compare.diff(a, b)] == [(0, 1)]
+    a.children[0].addChild('two')
+    b.children[1].addAttribute(None, 'x', '2', None, None)
+    assert not a.equals(b)
+    assert [x[0] for x in bach.compare.diff(a, b)] == [(1,)]
+    b.children[1] = parser.parse('q x="1"\n')
+    assert a.equals(b)
+
+    # without recursion
+    depth = 20000
+    src = 'doc ' + '(a ' * depth + ')' * depth + '\n'
+    assert parser.parse(src).equals(parser.parse(src))
+    assert parser.parse(src, frozen=True).equals(parser.parse(src))
+
+
+@test
+def frozen():
+    import bach.query
+    checkModes(lambda parser, src: parser.parse(src, frozen=True))
+
+    parser = bach.Parser(SHORTHANDS)
+    src = 'doc\n(sec (pp "a") (pp "a") (x)) (sec (pp "a") (pp "a") (x))\n'
+    root = parser.parse(src, frozen=True)
+    first, second = root.children
+    assert first is second and first.children[0] is first.children[1]
+    for change in (lambda: root.addChild('x'), lambda: first.setLabel('y'), lambda: root.children.append('x')):
+        try:
+            change()
+        except (TypeError, AttributeError):
+            continue
+        raise AssertionError("a frozen tree was modified")
+
+    # a shared Document is found at each of its positions in the tree, and
+    # only has a parent by position
+    plain = parser.parse(src)
+    assert names(root.walk()) == names(plain.walk())
+    index = bach.query.Index(root)
+    assert len(index.label('pp')) == 4
+    documents, parents, previous = index.structure()
+    assert [documents[i].label if i is not None else None for i in parents] == \
+        [None, 'doc', 'sec', 'sec', 'sec', 'doc', 'sec', 'sec', 'sec']
+    assert previous == [None, None, None, 2, 3, 1, None, 6, 7]
+    try:
+        index.parent(first)
+        raise AssertionError("found one parent of a shared Document")
+    except ValueError:
+        pass
+
+    for src in [src, SELECTORS] + VALID[:12]:
+        root, plain = parser.parse(src, frozen=True), parser.parse(src)
+        for selector in ('sec > pp + pp', 'pp ~ x', 'sec pp', 'pp', '*', 'n1 > n2', 'a ~ b', 'x + y', 'p, q a'):
+            expected = names(bach.select(plain, selector))
+            assert names(bach.select(root, selector)) == expected, (src[:60], selector)
+            assert names(bach.select(root, selector, bach.query.Index(root))) == expected, (src[:60], selector)
+
+
+@test
+def columns():
+    parser = bach.Parser(SHORTHANDS)
+
+    def tokens(parser, src):
+        # (semantic, lexeme, source) of each token, from batches of 7
+        result = []
+        for batch in parser.tokenizeColumns(src, batchSize=7):
+            assert 0 < len(batch) <= 7
+            for i in range(len(batch)):
+                start, end = batch.offsets[2 * i:2 * i + 2]
+                result.append((batch.semantics[i], batch.lexemes[i], src[start:end]))
+        return result
+
+    for src in VALID + INVALID:
+        actual, expected = outcome(tokens, parser, src), outcome(parser.parse, src)
+        assert actual[0] == expected[0] and (actual[0] == 'ok' or actual[1] == expected[1]), src[:60]
+
+    for src in VALID:
+        expected = [(x.semantic.value, x.lexeme) for x in parser.lex(src)]
+        actual = tokens(parser, src)
+        assert [x[:2] for x in actual] == expected, src[:60]
+        for semantic, lexeme, source in actual:
+            if semantic == bach.bach.CaptureSemantic.literal.value:
+                assert parser.parse('x ' + source + '\n').children == [lexeme]
+            else:
+                assert source == lexeme
+
+
+@test
+def preindex():
+    checkModes(lambda parser, src: parser.parse(src, preindex=True))
+
+    # literals that end the source, or a subdocument, or hold the other quotes
+    checkModes(lambda parser, src: parser.parse(src, preindex=True), [
+        'doc\n"x"', 'doc "x"', "doc 'x'", 'doc [x]', 'doc "x"\n', 'doc (a "x")\n', 'doc (a "x"',
+        'doc "x\\"', 'doc "x\\""\n', 'doc [x\\]]\n', 'doc "[(\'" \'"]\' [")\\]"]\n', 'doc a="x"b\n',
+    ])
+
+
+@test
+def structural():
+    import bach.structural
+
+    def same(a, b):
+        return (a.literals, a.headerEnd) == (b.literals, b.headerEnd)
+
+    sources = VALID + INVALID + ['doc "a\\\\" \'(\\\'\' [\\]\\\\] (x)\n', 'doc "unterminated (\n']
+    for src in sources:
+        expected = bach.structural.indexRegex(src)
+        if bach.structural.numpy is not None:
+            assert same(bach.structural.indexNumpy(src), expected), src[:60]
+        assert same(bach.structural.index(src), expected), src[:60]
+
+    # index() picks NumPy or not by the shape of the text, with the same result
+    src = 'doc\n' + '(a "x")\n' * 1000
+    assert same(bach.structural.index(src), bach.structural.indexRegex(src))
+    assert same(bach.structural.index(src + "[x]\n"), bach.structural.indexRegex(src + "[x]\n"))
+
+
+@test
+def stream():
+    import io
+    parser = bach.Parser(SHORTHANDS)
+
+    def check(records, delimiter, join):
+        for bufsize in (1, 2, 7, 4096):
+            stream = io.StringIO(join.join(records))
+            actual = list(parser.parseStream(stream, delimiter, bufsize))
+            assert len(actual) == len(records), (bufsize, len(actual))
+            for a, src in zip(actual, records):
+                assert a.equals(parser.parse(src)), (bufsize, src[:60])
+
+    check(VALID, '\x1e', '\x1e')
+    check(VALID, '\n---\n', '\n---\n')
+
+    # concatenated, where only a label begins a line at the top level
+    records = [
+        'log level="info"\n    "Started"\n',
+        'log level="warn"\n"Low disk space" (disk\nfree="2%")\n\n',
+        'book\n\ntitle="The Big Book"\nsubtitle ="Of Aardvarks"\n(chapter\n"x")\n',
+        'note\n  draft\n.a #b\n\'c\'\n[d]\n',
+    ]
+    check(records, None, '')
+
+    # literals read over many reads, with escapes and quotes split between
+    # them, scanned once each
+    body = 'ab\\\\c\\"d(\n' * 3000
+    records = ['log\n  "%s"\n(a [%s] \'%s\')\n' % (body, body.replace('"', ']'), body.replace('"', "'")),
+        'log "b"\n']
+    check(records, None, '')
+    check(records, '\x1e', '\x1e')
+
+    text = 'log\n  "%s"\n(a)\nlog "b"\n' % ('x' * (4 << 20))
+    started = time.perf_counter()
+    split = list(bach.stream.records(io.StringIO(text), 4096))
+    assert time.perf_counter() - started < 5
+    assert [x[:2] for x in split] == [(text[:-8], 1), ('log "b"\n', 4)]
+    assert split[0][2] == {6: len(text) - 13}
+
+    # errors report the line in the whole stream, and a likely mis-split
+    stream = 'log\n"a"\ndraft ()\n'
+    error = outcome(lambda: list(parser.parseStream(stream)))
+    assert error[0] == 'error' and 'split' in error[1] and 'line 3' in error[1], error
+    try:
+        list(parser.parseStream('log\n"a"\nlog\n (a b=)\n'))
+        raise AssertionError("parsed")
+    except bach.ParseError as e:
+        assert e.end.line == 4 and 'split' not in e.reason, e
+
+    assert list(parser.parseStream('')) == list(parser.parseStream(' \n\x1e\n', '\x1e')) == []
+
+
+def subdocuments(document):
+    return [x for x in document.children if not isinstance(x, str)]
+
+
+@test
+def follow():
+    import os
+    import tempfile
+    parser = bach.Parser(SHORTHANDS)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'log.bach')
+        checkpoint = os.path.join(directory, 'log.checkpoint')
+
+        def append(data):
+            with open(path, 'ab') as fp:
+                fp.write(data)
+
+        # appended in pieces, splitting characters, followed from a checkpoint
+        # after each, gives the subdocuments of a plain parse
+        sources = VALID + ['# header\n# (not a subdocument\nlog\n(é "(ü)\\"")\n(b [\\]]) (c)\n']
+        for src in sources:
+            data = src.encode('utf-8')
+            for bufsize in (1, 3, 4096):
+                open(path, 'wb').close()
+                if os.path.exists(checkpoint):
+                    os.remove(checkpoint)
+                actual = []
+                for cut in range(0, len(data), max(len(data) // 7, 1)):
+                    append(data[cut:cut + max(len(data) // 7, 1)])
+                    actual.extend(bach.follow(path, parser, checkpoint, wait=False, bufsize=bufsize))
+                expected = subdocuments(parser.parse(src))
+                assert len(actual) == len(expected), (src[:60], bufsize)
+                assert all(a.equals(e) for a, e in zip(actual, expected)), (src[:60], bufsize)
+
+        # errors in complete subdocuments are those of a plain parse
+        for src in ['doc (s .b="y")\n', 'doc (a))\n', 'doc (a b=)\n', 'doc (a "x" (b c="d"\n) ="e")\n',
+                'doc .a="x"\n(b)\n', 'doc (a) ="x"\n(b)\n']:
+            with open(path, 'w') as fp:
+                fp.write(src)
+            expected = outcome(parser.parse, src)
+            actual = outcome(lambda: list(bach.follow(path, parser, wait=False)))
+            assert expected[0] == actual[0] == 'error' and expected[1] == actual[1], (src, actual)
+
+        # a replaced file is followed from its start
+        with open(path, 'w') as fp:
+            fp.write('log\n(a) (b)\n')
+        assert len(list(bach.follow(path, parser, checkpoint, wait=False))) == 2
+        with open(path + '.new', 'w') as fp:
+            fp.write('log\n(c)\n')
+        os.replace(path + '.new', path)
+        assert names(bach.follow(path, parser, checkpoint, wait=False)) == ['c']
+
+        # a large subdocument read a few bytes at a time
+        src = 'log\n(a "%s")\n(b)\n' % ('x' * 200000)
+        with open(path, 'w') as fp:
+            fp.write(src)
+        actual = list(bach.follow(path, parser, wait=False, bufsize=16))
+        assert len(actual) == 2 and actual[0].equals(subdocuments(parser.parse(src))[0])
+
+
+
+@test
+def sidecar():
+    import bach.sidecar
+    import os
+    import tempfile
+    parser = bach.Parser(SHORTHANDS)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'records.bach')
+
+        sources = VALID + ['# header\n# (not a record\nlog\n(é "(ü)\\"")\n(b [\\]]) (c)\n']
+        for src in sources:
+            with open(path, 'w', encoding='utf-8') as fp:
+                fp.write(src)
+            expected = subdocuments(parser.parse(src))
+
+            for bufsize in (1, 3, 4096):
+                for check in (True, False):
+                    index = bach.sidecar.create(path, parser=parser, check=check, bufsize=bufsize)
+                    assert len(index) == len(expected), (src[:60], bufsize)
+                    assert index.labels == [x.label for x in expected], (src[:60], bufsize)
+
+            with bach.sidecar.IndexedFile(path, parser=parser, verify=True) as f:
+                assert len(f) == len(expected)
+                for n, e in enumerate(expected):
+                    assert f.record(n).equals(e), (src[:60], n)
+                    assert parser.parse('x ' + f.sourceText(n) + '\n').children[0].equals(e)
+                if expected:
+                    assert f.record(-1).equals(expected[-1])
+                    label = expected[-1].label
+                    assert all(a.equals(e) for a, e in \
+                        zip(f.find(label), [x for x in expected if x.label == label]))
+
+        # the whole document is checked as for a plain parse, and with
+        # check=False errors inside records are when they're read
+        for src in INVALID + ['doc (a b=)\n(c)\n']:
+            with open(path, 'w', encoding='utf-8') as fp:
+                fp.write(src)
+            expected = outcome(parser.parse, src)
+            actual = outcome(bach.sidecar.build, path, parser, bufsize=3)
+            assert expected[0] == actual[0] == 'error' and expected[1] == actual[1], (src, actual)
+
+        with open(path, 'w') as fp:
+            fp.write('doc (a b=)\n(c)\n')
+        bach.sidecar.create(path, parser=parser, check=False)
+        with bach.sidecar.IndexedFile(path, parser=parser) as f:
+            assert outcome(f.record, 0)[0] == 'error' and f.record(1).label == 'c'
+
+        # an index of the file as it was
+        with open(path, 'a') as fp:
+            fp.write(' ')
+        for verify in (False, True):
+            try:
+                bach.sidecar.IndexedFile(path, parser=parser, verify=verify)
+                raise AssertionError("opened")
+            except ValueError:
+                pass
+
+
+
+@test
+def compressed():
+    import bach.compressed
+    import bz2
+    import gzip
+    import io
+    import lzma
+    import os
+    import tempfile
+    import threading
+    import time
+    parser = bach.Parser(SHORTHANDS)
+
+    compressors = {'gzip': gzip.compress, 'xz': lzma.compress, 'bz2': bz2.compress, None: bytes}
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'doc.bach')
+
+        for compression, compress in compressors.items():
+            for src in VALID[::4] + INVALID + ['doc "é ü ≠"\n' * 3000]:
+                data = compress(src.encode('utf-8'))
+                assert bach.compressed.detect(io.BufferedReader(io.BytesIO(data))) == compression
+
+                for threads in (True, False):
+                    text = bach.compressed.textStream(io.BufferedReader(io.BytesIO(data)),
+                        bufsize=5, threads=threads)
+                    assert text.read() == src, (compression, threads, src[:60])
+
+                # a stream of whole characters, however the bytes are split
+                with open(path, 'wb') as fp:
+                    fp.write(data)
+                expected = outcome(parser.parse, src)
+                assert sameOutcome(outcome(parser.parseFile, path, bufsize=3), expected), \
+                    (compression, src[:60])
+                with bach.compressed.openText(path, threads=False) as fp:
+                    assert sameOutcome(outcome(parser.parse, fp), expected), (compression, src[:60])
+
+        # closing the text stream early stops the helper thread
+        with open(path, 'wb') as fp:
+            fp.write(gzip.compress(b'doc "x"\n' * 100000))
+        threads = threading.active_count()
+        with bach.compressed.openText(path, bufsize=64, queueSize=1) as fp:
+            assert fp.read(8) == 'doc "x"\n'
+        for _ in range(100):
+            if threading.active_count() == threads:
+                break
+            time.sleep(0.01)
+        assert threading.active_count() == threads
+
+
+
+def fromEvents(events):
+    # the tree of Parser.events(), reading each literal given in chunks or
+    # spilled as it comes
+    stack = []
+    for event, value in events:
+        if event == 'start':
+            document = bach.Document()
+            document.setLabel(value)
+            if stack:
+                stack[-1].addChild(document)
+            stack.append(document)
+        elif event == 'attribute':
+            stack[-1].addAttribute(None, value[0], value[1], None, None)
+        elif event == 'literal':
+            if isinstance(value, str):
+                stack[-1].addChild(value)
+            elif hasattr(value, 'read'):
+                with value:
+                    stack[-1].addChild(value.read())
+            else:
+                stack[-1].addChild(''.join(value))
+        else:
+            root = stack.pop()
+    return root
+
+
+@test
+def events():
+    import io
+    checkModes(lambda parser, src: fromEvents(parser.events(src)))
+    checkModes(lambda parser, src: fromEvents(parser.events(io.StringIO(src), bufsize=3)))
+
+    # literals split across buffers and chunks everywhere
+    sources = VALID[::5] + INVALID
+    for threshold in (1, 2, 5):
+        checkModes(lambda parser, src: fromEvents(parser.events(src, threshold=threshold)), sources)
+        checkModes(lambda parser, src: fromEvents(parser.events(io.StringIO(src), bufsize=3,
+            threshold=threshold)), sources)
+    checkModes(lambda parser, src: fromEvents(parser.events(src, threshold=3, spill=True)), sources)
+
+    # a literal of about 300KB, in chunks of about the threshold
+    parser = bach.Parser(SHORTHANDS)
+    body = 'abc\\"def\n' * 30000
+    src = 'doc a="x" "%s" (b)\n' % body.replace('\\', '\\\\').replace('"', '\\"')
+    expected = parser.parse(src)
+    it = parser.events(io.StringIO(src), bufsize=4096, threshold=1000)
+    sizes = []
+    for event, value in it:
+        if event == 'literal':
+            chunks = list(value)
+            sizes.extend(len(x) for x in chunks)
+            assert ''.join(chunks) == expected.children[0]
+    assert len(sizes) > 250 and max(sizes) <= 1010, (len(sizes), max(sizes))
+
+    # a literal left unconsumed is skipped
+    events = [(e, v) for e, v in parser.events(src, threshold=1000) if e != 'literal']
+    assert events == [('start', 'doc'), ('attribute', ('a', 'x')), ('start', 'b'), ('end', 'b'),
+        ('end', 'doc')], events
+
+
+
+@test
+def profile():
+    import io
+    import json
+    parser = bach.Parser(SHORTHANDS, profile=True)
+    checkModes(lambda _, src: parser.parse(src))
+
+    # each character lexed is counted once, in its state and by its rule
+    parser.profile.reset()
+    src = VALID[-1]
+    parser.parse(src)
+    profile = parser.profile
+    tokens = len(list(bach.Parser(SHORTHANDS).lex(iter(src))))
+    assert (profile.characters, profile.tokens) == (len(src), tokens)
+    assert sum(profile.stateVisits) == sum(map(sum, profile.productionHits)) == len(src)
+    assert all(tried >= visits for tried, visits in zip(profile.rulesTried, profile.stateVisits))
+
+    fp = io.StringIO()
+    profile.dump(fp)
+    assert json.loads(fp.getvalue())['characters'] == len(src)
+
+    # the lexers that look up transitions count the same, but for what they
+    # jump over
+    counts = (profile.characters, profile.tokens, profile.stateVisits, profile.rulesTried,
+        profile.productionHits)
+    for lex in (parser.validate, lambda src: list(parser.parse(src, lazy=True).walk())):
+        parser.profile.reset()
+        lex(src)
+        assert (profile.characters, profile.tokens, profile.stateVisits, profile.rulesTried,
+            profile.productionHits) == counts
+
+    for lex in (lambda src: parser.parse(src, preindex=True), lambda src: list(parser.events(src))):
+        parser.profile.reset()
+        lex(src)
+        assert profile.tokens == tokens
+        assert sum(profile.stateVisits) == sum(map(sum, profile.productionHits)) == profile.characters
+        assert 0 < profile.characters < len(src)
+
+
+
+class SlowStream():
+    # A text stream over a str, that isn't in memory as far as bach.io can
+    # tell, recording the threads that read it and how much they've read
+
+    def __init__(self, text):
+        self.text = text
+        self.offset = 0
+        self.threads = set()
+
+    def read(self, size=-1):
+        import threading
+        self.threads.add(threading.current_thread())
+        end = len(self.text) if size < 0 else self.offset + size
+        data = self.text[self.offset:end]
+        self.offset += len(data)
+        return data
+
+
+@test
+def prefetch():
+    import io
+    import threading
+    parser = bach.Parser(SHORTHANDS)
+    main = {threading.current_thread()}
+
+    def plain(document):
+        # a tree as nested tuples, that compare equal if the trees do
+        return (document.label, repr(document.attributes),
+            [x if isinstance(x, str) else plain(x) for x in document.children])
+
+    modes = {
+        'parse': lambda parser, src, **options: plain(parser.parse(src, **options)),
+        'validate': lambda parser, src, **options: repr(parser.validate(src, **options)),
+        'events': lambda parser, src, **options: list(parser.events(src, **options)),
+        'extract': lambda parser, src, **options: [(path, plain(x)) for path, x in \
+            parser.extract(src, ['*/*'], **options)],
+        'parseStream': lambda parser, src, **options: [plain(x) for x in \
+            parser.parseStream(src, '\x1e', **options)],
+    }
+
+    for name, mode in modes.items():
+        for src in VALID[::3] + INVALID:
+            expected = outcome(mode, parser, src)
+
+            # by default, a stream is read on this thread
+            stream = SlowStream(src)
+            assert outcome(mode, parser, stream, bufsize=7) == expected, (name, src[:60])
+            assert stream.threads <= main, name
+
+            # and with prefetch, on a helper thread, unless it's in memory
+            stream = SlowStream(src)
+            assert outcome(mode, parser, stream, bufsize=7, prefetch=2) == expected, (name, src[:60])
+            assert not src or stream.threads and not stream.threads & main, name
+            assert outcome(mode, parser, io.StringIO(src), prefetch=2) == expected, (name, src[:60])
+
+    # only about as much of a stream is read as is consumed
+    stream = SlowStream('doc\n' + '(a "x")\n' * 10000)
+    for _, event in zip(range(5), parser.events(stream, bufsize=64)):
+        pass
+    assert stream.offset <= 128, stream.offset
+    stream = SlowStream('doc\n' + '(a "x")\n' * 10000)
+    assert next(parser.extract(stream, ['doc/a'], bufsize=64))[1].label == 'a'
+    assert stream.offset <= 128, stream.offset
+
+    # a CLI, with and without prefetch
+    import subprocess
+    for options in ([], ['--prefetch', '3']):
+        for src, code in (('doc (a)\n', 0), ('doc (a\n', 1)):
+            result = subprocess.run([sys.executable, 'check.py'] + options, input=src.encode('utf-8'),
+                capture_output=True)
+            assert result.returncode == code, (options, src, result.stderr)
+
+
+
+@test
+def limits():
+    import io
+
+    def expectError(result):
+        if result is not None:
+            raise result
+
+    modes = {
+        'parse':       lambda parser, src: parser.parse(src),
+        'stream':      lambda parser, src: parser.parse(io.StringIO(src), bufsize=5),
+        'spans':       lambda parser, src: parser.parse(src, spans=True),
+        'frozen':      lambda parser, src: parser.parse(src, frozen=True),
+        'preindex':    lambda parser, src: parser.parse(src, preindex=True),
+        'threads':     lambda parser, src: parser.parse(src, threads=True),
+        'columns':     lambda parser, src: list(parser.tokenizeColumns(src)),
+        'events':      lambda parser, src: list(parser.events(io.StringIO(src), bufsize=5)),
+        'chunked':     lambda parser, src: list(parser.events(src, threshold=2)),
+        'extract':     lambda parser, src: list(parser.extract(src, ['*'])),
+        'validate':    lambda parser, src: expectError(parser.validate(src)),
+        'validateStream': lambda parser, src: expectError(parser.validate(io.StringIO(src), bufsize=5)),
+        'parseStream': lambda parser, src: list(parser.parseStream(src, '\x1e')),
+    }
+    levels = {
+        'lazy':        lambda parser, src: materialize(parser.parse(src, lazy=True)),
+        'keep':        lambda parser, src: parser.parse(src, keep=labels(src)),
+    }
+
+    def labels(src):
+        # every label in src, to keep
+        try:
+            return {x.label for x in bach.Parser(SHORTHANDS).parse(src).walk()}
+        except bach.ParseError:
+            return set()
+
+    def result(mode, limit, value, src):
+        # 'ok', the limit raised, or the reason of another ParseError
+        parser = bach.Parser(SHORTHANDS, limits={limit: value})
+        try:
+            mode(parser, src)
+            return 'ok'
+        except bach.LimitError as e:
+            return e.limit
+        except bach.ParseError as e:
+            return e.reason
+
+    sources = [x for x in VALID if len(x) < 2000] + [
+        'doc a="xyz" .c #d (e (f "ghi") (g)) \'a long literal\' [x\\]y]\n',
+        'doc (a (b (c (d (e)))))\n',
+        'doc a b c d e f g h (x a b c d e)\n',
+        'doc "%s"\n' % ('\\"' * 20),
+    ]
+
+    for limit in ('maxDepth', 'maxStack', 'maxLiteral', 'maxAttributes', 'maxNodes', 'maxInput'):
+        for src in sources:
+            # the least value a plain parse accepts, which every mode must
+            # accept too, and one less, which every mode must reject
+            value = 0
+            while result(modes['parse'], limit, value, src) != 'ok':
+                assert result(modes['parse'], limit, value, src) == limit
+                value += 1
+            checked = dict(modes)
+            if limit in ('maxLiteral', 'maxAttributes', 'maxInput'):
+                checked.update(levels)
+            for name, mode in checked.items():
+                assert result(mode, limit, value, src) == 'ok', (name, limit, value, src[:60])
+                if value > 0:
+                    assert result(mode, limit, value - 1, src) == limit, (name, limit, value, src[:60])
+
+    # invalid documents are rejected as by a plain parse, within the limits
+    # (but parseStream() skips an empty record)
+    for src in INVALID:
+        expected = result(modes['parse'], 'maxNodes', 10000, src)
+        for name, mode in modes.items():
+            if src or name != 'parseStream':
+                assert result(mode, 'maxNodes', 10000, src) == expected, (name, src)
+
+    # a long token is stopped as soon as it's too long
+    parser = bach.Parser(limits={'maxLiteral': 10})
+    for src in ('doc "%s"\n' % ('x' * 5000000), 'doc%s\n' % ('x' * 5000000)):
+        for name, mode in modes.items():
+            started = time.perf_counter()
+            assert result(mode, 'maxLiteral', 10, src) == 'maxLiteral', name
+            assert time.perf_counter() - started < 1, name
+
+    # limits that lazy and keep can't enforce
+    for limit in ('maxDepth', 'maxStack', 'maxNodes'):
+        for name, mode in levels.items():
+            try:
+                mode(bach.Parser(limits={limit: 100}), 'doc\n')
+                raise AssertionError("%s parsed with %s" % (name, limit))
+            except ValueError:
+                pass
+
+
+
+ap = argparse.ArgumentParser(
+    description='Runs behaviour tests of the parse modes and tools built on the parser')
+ap.add_argument('names', nargs='*',
+    help='only run tests with any of these in their names')
+
+args = ap.parse_args()
+
+failures = 0
+selected = [x for x in TESTS if not args.names or any(n in x.__name__ for n in args.names)]
+
+for function in selected:
+    try:
+        function()
+    except Exception:
+        failures += 1
+        print("FAIL %s" % function.__name__, file=sys.stderr)
+        traceback.print_exc()
+
+print("%d tests: %d failures" % (len(selected), failures))
+
+if failures:
+    sys.exit(1)
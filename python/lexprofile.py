@@ -0,0 +1,78 @@
+"""
+Lexes Bach documents with an instrumented parser and prints a report of which
+states of the automaton and which production rules are the hottest.
+
+Example Usage:
+    cat input.bach | python3 lexprofile.py
+    python3 lexprofile.py corpus/*.bach --dump profile.json
+    python3 lexprofile.py corpus/*.bach -s ".class" "#id"
+    python3 lexprofile.py archive/*.bach.gz archive/*.bach.xz
+    python3 lexprofile.py corpus/*.bach --mode validate
+
+The dumped JSON profile can be given to cgrammar.py to order production rules
+by frequency (see cgrammar.py --profile).
+"""
+
+import argparse
+import bach
+import bach.compressed
+import sys
+
+
+
+ap = argparse.ArgumentParser(
+    description='Profiles the Bach lexer over documents given as files or on stdin')
+ap.add_argument('files', nargs='*',
+    help='documents to lex, which may be compressed with gzip, xz or bzip2 (defaults to stdin)')
+ap.add_argument('-i', '--input-encoding',  default='utf-8',
+    help='specify the input character encoding (defaults to utf-8)')
+ap.add_argument('-s', '--shorthand', nargs="+", default=[],
+    help='add shorthand attribute mappings e.g. --shorthand ".class" "#id" "?flag"')
+ap.add_argument('-m', '--mode', default='parse',
+    choices=['parse', 'validate', 'preindex', 'lazy', 'events'],
+    help='the lexer to profile: that of parse() (the default), validate(), parse() with preindex=True or lazy=True (the whole tree), or events()')
+ap.add_argument('--dump', metavar='FILE',
+    help='also write the counters to FILE as JSON')
+ap.add_argument('--prefetch', type=int, default=0, metavar='N',
+    help='read up to N buffers of input ahead on a helper thread, e.g. from a slow pipe (defaults to 0, reading as needed)')
+
+args = ap.parse_args()
+
+shorthand = {}
+
+for i in args.shorthand:
+    assert len(i) >= 2, "Shorthand attribute mapping option must contain at least one symbol and at least one character"
+    symbol, expansion = i[0], i[1:]
+    assert not symbol in shorthand, "Shorthand attribute symbol already configured"
+    shorthand[symbol] = expansion
+
+parser = bach.Parser(shorthand, profile=True)
+
+def lex(fp):
+    if args.mode == 'validate':
+        error = parser.validate(fp, prefetch=args.prefetch)
+        if error is not None:
+            raise error
+    elif args.mode == 'preindex':
+        parser.parse(fp, preindex=True)
+    elif args.mode == 'lazy':
+        for _ in parser.parse(fp, lazy=True).walk():
+            pass
+    elif args.mode == 'events':
+        for _ in parser.events(fp, prefetch=args.prefetch):
+            pass
+    else:
+        parser.parse(fp, prefetch=args.prefetch)
+
+if args.files:
+    for path in args.files:
+        with bach.compressed.openText(path, args.input_encoding) as fp:
+            lex(fp)
+else:
+    lex(bach.compressed.textStream(sys.stdin.buffer, encoding=args.input_encoding))
+
+print(parser.profileReport())
+
+if args.dump:
+    with open(args.dump, 'w', encoding='utf-8') as fp:
+        parser.profile.dump(fp)
@@ -13,3 +13,10 @@ function testvalid {
 
 
 testvalid "0001"
+testvalid "0002"
+
+echo "TEST threadtest.py"
+$PY ./threadtest.py --documents 1000
+
+echo "TEST featuretest.py"
+$PY ./featuretest.py
@@ -0,0 +1,4 @@
+('document', {}, [
+    ('escapes', {}, [
+        "single ' \\ quote", 'double " \\ quote', 'bracket ] \\ quote'])
+])
@@ -0,0 +1,85 @@
+"""
+Stress test of sharing Parsers between threads: parses thousands of seeded
+synthetic documents concurrently, in a pool of threads, through one shared
+Parser per set of shorthands, and checks that each result matches a parse of
+the same document on a single thread.
+
+Example Usage (from the python directory):
+    python3 ./threadtest.py
+    python3 ./threadtest.py --threads 32 --documents 10000 --size 5000
+"""
+
+import argparse
+import bach
+import concurrent.futures
+import random
+import sys
+
+from benchmarks.generate import SHAPES
+
+
+# each document is parsed concurrently in one of these ways, with a function
+# returning a (fully materialized) tree to compare
+MODES = {
+    'parse':    lambda parser, src: parser.parse(src),
+    'frozen':   lambda parser, src: parser.parse(src, frozen=True),
+    'spans':    lambda parser, src: parser.parse(src, spans=True),
+    'preindex': lambda parser, src: parser.parse(src, preindex=True),
+    'lazy':     lambda parser, src: materialize(parser.parse(src, lazy=True)),
+}
+
+
+def materialize(document):
+    for d in document.walk(): pass
+    return document
+
+
+
+ap = argparse.ArgumentParser(
+    description='Parses many documents concurrently with shared parsers and checks the results')
+ap.add_argument('--threads', type=int, default=8,
+    help='number of threads (defaults to 8)')
+ap.add_argument('--documents', type=int, default=2000,
+    help='number of documents to parse (defaults to 2000)')
+ap.add_argument('--size', type=int, default=300,
+    help='maximum size of each document, in characters (defaults to 300)')
+ap.add_argument('--seed', type=int, default=1,
+    help='seed for the document generators')
+
+args = ap.parse_args()
+rng = random.Random(args.seed)
+
+# one shared parser per set of shorthands
+parsers = {}
+jobs = []
+
+for i in range(args.documents):
+    shape = rng.choice(sorted(SHAPES))
+    generator, shorthands = SHAPES[shape]
+    key = tuple(sorted(shorthands.items()))
+    if key not in parsers:
+        parsers[key] = bach.Parser(shorthands)
+
+    src = generator(random.Random(rng.random()), rng.randint(1, args.size))
+    jobs.append((parsers[key], src, rng.choice(sorted(MODES))))
+
+# on a single thread, with separate parsers
+expected = [bach.Parser(dict(parser.shorthands)).parse(src) for parser, src, mode in jobs]
+
+def run(job):
+    parser, src, mode = job
+    assert parser.validate(src) is None
+    return MODES[mode](parser, src)
+
+with concurrent.futures.ThreadPoolExecutor(args.threads) as executor:
+    results = list(executor.map(run, jobs))
+
+failures = [i for i, (a, b) in enumerate(zip(results, expected)) if not a.equals(b)]
+
+print("%d documents, %d threads, %d parsers: %d failures" % \
+    (len(jobs), args.threads, len(parsers), len(failures)))
+
+if failures:
+    for i in failures[:10]:
+        print("FAIL document %d (%s)" % (i, jobs[i][2]), file=sys.stderr)
+    sys.exit(1)